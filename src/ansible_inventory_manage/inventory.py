@@ -1,8 +1,28 @@
+import binascii
+import bisect
+import fnmatch
+import functools
+import hashlib
 import itertools
-import copy
+import json
+from array import array
+import mmap
+import multiprocessing
+import re
+import sys
+import weakref
+from collections import OrderedDict
+try:
+    from collections.abc import MutableSet, Set
+except ImportError:  # Python 2
+    from collections import MutableSet, Set
 
 
-from past.builtins import basestring    # pip install future
+from past.builtins import basestring, intern    # pip install future
+
+from ansible_inventory_manage.jsonstream import JSONBufferReader
+from ansible_inventory_manage.jsonstream import JSONStreamReader
+from ansible_inventory_manage.snapshot import SnapshotReader, SnapshotWriter
 
 def is_valid_name(name=None):
     if name and isinstance(name, basestring):
@@ -20,59 +40,845 @@ def is_valid_host(name=None):
         return False
 
 
+# A range in a host name: [01:50], [a:f], or with a step, [0:20:2].
+_HOST_RANGE = re.compile(
+    r'\[([0-9]+|[a-zA-Z]):([0-9]+|[a-zA-Z])(?::([0-9]+))?\]')
+
+
+def _parse_host_range(name):
+    """
+    Splits a host range name, like web[01:50].example.com, into
+    its segments: the literal strings, and for each range a tuple
+    (start, end, step, width), width being 0 for unpadded numbers
+    and None for letters.
+    Raises ValueError if name is not a valid host range.
+    """
+    if not is_valid_name(name):
+        raise ValueError("Not a valid host range")
+    segments, position = [], 0
+    for match in _HOST_RANGE.finditer(name):
+        start, end, step = match.groups()
+        if start.isdigit() != end.isdigit():
+            raise ValueError("Mixed range bounds in %s" % name)
+        if start.isdigit():
+            width = len(start) if start[0] == '0' and len(start) > 1 else 0
+            if width and len(end) != width:
+                raise ValueError("Padded bounds differ in length in %s"
+                                 % name)
+            start, end = int(start), int(end)
+        else:
+            width = None
+            start, end = ord(start), ord(end)
+        step = int(step) if step else 1
+        if end < start or step < 1:
+            raise ValueError("Empty range in %s" % name)
+        segments.append(name[position:match.start()])
+        segments.append((start, end, step, width))
+        position = match.end()
+    if not position:
+        raise ValueError("No range in %s" % name)
+    segments.append(name[position:])
+    first = ''.join(segment if isinstance(segment, basestring)
+                    else _format_range_value(segment[0], segment[3])
+                    for segment in segments)
+    if not is_valid_host(first):
+        raise ValueError("Invalid host name %s" % first)
+    return segments
+
+
+def _format_range_value(value, width):
+    if width is None:
+        return chr(value)
+    return '%0*d' % (width, value)
+
+
+def is_valid_host_range(name=None):
+    try:
+        _parse_host_range(name)
+    except ValueError:
+        return False
+    return True
+
+
 def mergedicts(dict1, dict2, prios=(0, 0)):
     """
     Merges dict2 into dict1 together.
     In case of ties, prios (dict1, dict2) determines the winner.
     Prios are integer.
     A prio of -999 "nein nein nein" means dropping the var.
+    Yields the (key, value) of the merged dict.
+    """
+    for item in _mergedicts(dict1, dict2, prios).items():
+        yield item
+
+
+def mergedicts_many(sources):
     """
-    if not isinstance(prios[0], int) or not isinstance(prios[1], int):
-        raise TypeError("Prios must be integers")
-    if prios[0] == -999:
-        dict1 = {}
-    if prios[1] == -999:
-        dict2 = {}
-    for k in set(dict1.keys()).union(dict2.keys()):
-        if k in dict1 and k in dict2:
-            if isinstance(dict1[k], dict) and isinstance(dict2[k], dict):
-                yield (k, dict(mergedicts(dict1[k], dict2[k], prios)))
+    Merges together all the dicts of sources, a sequence of
+    (dict, prio) pairs, in a single pass.
+    For each key, the values which are all dicts are merged further,
+    the values which are all lists are concatenated in order,
+    and in other cases the value with the highest prio wins.
+    In case of ties, the first source wins.
+    As for mergedicts, a prio of -999 means dropping the dict.
+    Yields the (key, value) of the merged dict.
+    """
+    for item in _mergedicts_many(sources).items():
+        yield item
+
+
+def _mergedicts(dict1, dict2, prios=(0, 0)):
+    """
+    Returns the merge of dict2 into dict1, as a new dict,
+    following the rules of mergedicts.
+    """
+    return _mergedicts_many(((dict1, prios[0]), (dict2, prios[1])))
+
+
+def _mergedicts_many(sources):
+    """
+    Returns the merge of sources, as a new dict,
+    following the rules of mergedicts_many.
+    The merge is iterative, walks every key once, and shares the
+    values which don't need merging (copy-on-write): only the dicts
+    along the conflicting keys are copied, and merged lists are new
+    lists of the same items. Never modify the merged values in place.
+    """
+    layers = []
+    for source, prio in sources:
+        if not isinstance(prio, int):
+            raise TypeError("Prios must be integers")
+        if prio != -999 and source:
+            if isinstance(source, _LazyVars):
+                # update() would skip the overrides on Python 2.
+                source = source._load()
+            layers.append((source, prio))
+    merged = {}
+    stack = [(merged, layers)]
+    while stack:
+        target, layers = stack.pop()
+        if len(layers) == 1:
+            target.update(layers[0][0])
+            continue
+        candidates = _ordereddict()
+        for source, prio in layers:
+            for key, value in source.items():
+                if key in candidates:
+                    candidates[key].append((value, prio))
+                else:
+                    candidates[key] = [(value, prio)]
+        for key, values in candidates.items():
+            if len(values) == 1:
+                target[key] = values[0][0]
+            elif all(isinstance(value, dict) for value, _ in values):
+                values = [(value, prio) for value, prio in values if value]
+                if len(values) > 1:
+                    target[key] = {}
+                    stack.append((target[key], values))
+                else:
+                    target[key] = values[0][0] if values else {}
+            elif all(isinstance(value, list) for value, _ in values):
+                # We can merge further, by merging lists.
+                target[key] = list(itertools.chain.from_iterable(
+                    value for value, _ in values))
             else:
-                if isinstance(dict1[k], list) and isinstance(dict2[k], list):
-                    # We can merge further, by merging lists.
-                    list1 = copy.deepcopy(dict1[k])
-                    list1.extend(copy.deepcopy(dict2[k]))
-                    yield (k, list1)
                 # If one of the values is not a dict, you can't
                 # continue merging it.
                 # Take the one who has the higher prio.
-                elif prios[0] < prios[1]:
-                    yield (k, dict2[k])
-                else:
-                    yield (k, dict1[k])
-        elif k in dict1:
-            yield (k, dict1[k])
-        else:
-            yield (k, dict2[k])
+                winner, winner_prio = values[0]
+                for value, prio in values[1:]:
+                    if prio > winner_prio:
+                        winner, winner_prio = value, prio
+                target[key] = winner
+    return merged
+
+
+def _layer_vars(merged, prios, variables, prio, newprios=None):
+    """
+    Merges in place the vars of a layer, at prio, over merged,
+    the vars of the layers below it, for variable inheritance.
+    prios maps each key of merged to the (prio, prios) of its value:
+    the prio of the layer which won it (the highest, for merged
+    values), and for a merged dict, the prios of its keys, None when
+    they all have the same prio. The highest prio wins, and unlike
+    mergedicts, the last layer wins the ties. Lists are concatenated,
+    from the least to the most specific layer. As for mergedicts,
+    a prio of -999 means dropping the layer.
+    The prios of the merged keys are written to newprios if given,
+    leaving prios intact, when they aren't needed afterwards.
+    """
+    if prio == -999:
+        return
+    if newprios is None:
+        newprios = prios
+    for key, value in variables.items():
+        if key not in merged:
+            merged[key] = value
+            newprios[key] = (prio, None)
+            continue
+        current = merged[key]
+        currentprio, subprios = prios[key]
+        if isinstance(current, dict) and isinstance(value, dict):
+            if subprios is None:
+                subprios = dict.fromkeys(current, (currentprio, None))
+            else:
+                subprios = subprios.copy()
+            # The merged values are shared: merge into copies.
+            current = current.copy()
+            _layer_vars(current, subprios, value, prio)
+            merged[key] = current
+            newprios[key] = (max(currentprio, prio), subprios)
+        elif isinstance(current, list) and isinstance(value, list):
+            merged[key] = current + value
+            newprios[key] = (max(currentprio, prio), None)
+        elif prio >= currentprio:
+            merged[key] = value
+            newprios[key] = (prio, None)
+
+
+def _merge_layers(layers):
+    """
+    Returns the (vars, prios) merge of layers, a sequence of
+    (vars, prio) ordered from the least to the most specific,
+    see _layer_vars.
+    """
+    merged, prios = {}, {}
+    for variables, prio in layers:
+        _layer_vars(merged, prios, variables, prio)
+    return merged, prios
+
+
+def _inherit_layers(layers, bases):
+    """
+    Adds to the ordered dict layers the layers inherited from
+    bases, resolved groups, keeping the first occurrence of each:
+    the ancestors shared by several bases are merged once, before
+    all their descendants.
+    """
+    for base in bases:
+        for owner, layer in base._resolved[0].items():
+            if owner not in layers:
+                layers[owner] = layer
+    return layers
+
+
+# dict keeps the insertion order since Python 3.7, and is
+# lighter than an OrderedDict.
+if sys.version_info >= (3, 7):
+    _ordereddict = dict
+else:
+    _ordereddict = OrderedDict
+
+
+class OrderedSet(MutableSet):
+    """
+    A set which remembers the insertion order of its items.
+    Membership tests, additions and removals are O(1).
+    Positional operations (indexing, insert, pop with an index)
+    are O(n), but they are only needed for the rare reordering
+    operations, which is why the set still mimics a list for those.
+    """
+
+    __slots__ = ['_items']
+
+    def __init__(self, iterable=()):
+        self._items = _ordereddict.fromkeys(iterable)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, list(self))
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self._items)
+        if not 0 <= index < len(self._items):
+            raise IndexError("OrderedSet index out of range")
+        return next(itertools.islice(self._items, index, None))
+
+    def __eq__(self, other):
+        if isinstance(other, (OrderedSet, list, tuple)):
+            return list(self) == list(other)
+        return Set.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def add(self, item):
+        self._items[item] = None
+
+    def update(self, iterable):
+        """ Adds the items of iterable, in bulk """
+        self._items.update(_ordereddict.fromkeys(iterable))
+
+    def discard(self, item):
+        self._items.pop(item, None)
+
+    def clear(self):
+        self._items.clear()
+
+    def index(self, item):
+        if item not in self._items:
+            raise ValueError("%r is not in OrderedSet" % (item,))
+        for index, member in enumerate(self._items):
+            if member is item:
+                return index
+
+    def pop(self, index=-1):
+        item = self[index]
+        self.discard(item)
+        return item
+
+    def insert(self, index, item):
+        items = [member for member in self._items if member is not item]
+        items.insert(index, item)
+        self._items = _ordereddict.fromkeys(items)
+
+
+class NamedOrderedSet(OrderedSet):
+    """
+    An OrderedSet of inventory objects, which also indexes its
+    members by name, making lookups by name O(1).
+    The index is kept in sync by the members themselves when
+    they are renamed (see InventoryObject.name).
+    """
+
+    __slots__ = ['_names']
+
+    def __init__(self, iterable=()):
+        super(NamedOrderedSet, self).__init__(iterable)
+        self._names = dict((item.name, item) for item in self._items)
+
+    def add(self, item):
+        if item not in self._items:
+            self._items[item] = None
+            self._names[item.name] = item
+
+    def update(self, iterable):
+        items = [item for item in iterable if item not in self._items]
+        super(NamedOrderedSet, self).update(items)
+        self._names.update((item.name, item) for item in items)
+
+    def discard(self, item):
+        if item in self._items:
+            del self._items[item]
+            if self._names.get(item.name) is item:
+                del self._names[item.name]
+
+    def clear(self):
+        self._items.clear()
+        self._names.clear()
+
+    def insert(self, index, item):
+        super(NamedOrderedSet, self).insert(index, item)
+        self._names[item.name] = item
+
+    def has_name(self, name):
+        return name in self._names
+
+    def get_by_name(self, name, default=None):
+        return self._names.get(name, default)
+
+    def _rename(self, item, oldname):
+        if self._names.get(oldname) is item:
+            del self._names[oldname]
+        self._names[item.name] = item
+
+
+class _FrozenDict(dict):
+    """ A read-only dict, used as shared empty vars """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("%s is read-only" % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+
+class _FrozenNamedOrderedSet(NamedOrderedSet):
+    """ A read-only NamedOrderedSet, used as shared empty groups """
+
+    __slots__ = []
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("%s is read-only" % self.__class__.__name__)
+
+    add = insert = update = _readonly
+
+
+# Most hosts have no vars of their own, and some have no group:
+# they all share those, until written.
+_EMPTY_VARS = _FrozenDict()
+_EMPTY_GROUPS = _FrozenNamedOrderedSet()
+
+
+class _SharedVars(_FrozenDict):
+    """ Read-only vars, shared by all the objects having equal vars """
+
+    __slots__ = ['_pool']
+
+    def __reduce__(self):
+        # Copies are private, and can be modified.
+        return dict, (dict(self),)
+
+
+class _VarsPool(object):
+    """
+    Hash-consing of vars: equal vars are replaced by a single
+    _SharedVars, found by the hash of their content.
+    Unused _SharedVars are dropped from the pool.
+    """
+
+    def __init__(self):
+        self._shared = weakref.WeakValueDictionary()
+
+    def share(self, variables):
+        """
+        Returns the _SharedVars equal to variables, or variables
+        themselves if they can't be hashed.
+        """
+        if isinstance(variables, _LazyVars) and not variables.loaded:
+            return variables
+        if not variables:
+            return _EMPTY_VARS
+        if isinstance(variables, _SharedVars) and variables._pool is self:
+            return variables
+        try:
+            key = hash(json.dumps(variables, sort_keys=True))
+        except (TypeError, ValueError):
+            return variables
+        shared = self._shared.get(key)
+        if shared is None:
+            shared = _SharedVars(variables)
+            shared._pool = self
+            self._shared[key] = shared
+        elif shared != variables:
+            # Hash collision: keep the vars private.
+            return variables
+        return shared
+
+
+class _LazyVars(_FrozenDict):
+    """
+    Read-only vars, kept as the bytes of their json in buf, between
+    the offsets start and end, until they are read: they are then
+    decoded in place.
+    """
+
+    __slots__ = ['_source']
+
+    def __init__(self, buf, start, end):
+        super(_LazyVars, self).__init__()
+        self._source = (buf, start, end)
+
+    @property
+    def loaded(self):
+        return self._source is None
+
+    def raw(self):
+        """ Returns the json of the vars, if they weren't decoded yet """
+        if self._source is None:
+            return None
+        buf, start, end = self._source
+        return buf[start:end].decode('utf-8')
+
+    def _load(self):
+        if self._source is not None:
+            decoded = json.loads(self.raw())
+            self._source = None
+            dict.update(self, decoded)
+        return self
+
+    def __len__(self):
+        return dict.__len__(self._load())
+
+    def __iter__(self):
+        return dict.__iter__(self._load())
+
+    def __contains__(self, key):
+        return dict.__contains__(self._load(), key)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self._load(), key)
+
+    def __eq__(self, other):
+        return dict.__eq__(self._load(), other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return dict.__repr__(self._load())
+
+    def __reduce__(self):
+        return dict, (dict(self._load()),)
+
+    def get(self, key, default=None):
+        return dict.get(self._load(), key, default)
+
+    def keys(self):
+        return dict.keys(self._load())
+
+    def values(self):
+        return dict.values(self._load())
+
+    def items(self):
+        return dict.items(self._load())
+
+    def copy(self):
+        return dict(self._load())
+
+
+class _OwnedVars(dict):
+    """
+    The vars of an object, as handed out by InventoryObject.vars:
+    modifying them marks the object as changed. A copy of read-only
+    vars (shared, or not decoded yet) only replaces them in the
+    object when first modified, so that reading doesn't unshare them.
+    """
+
+    __slots__ = ['_owner', '_base']
+
+    def __init__(self, owner, variables, base=None):
+        super(_OwnedVars, self).__init__(variables)
+        self._owner = owner
+        self._base = base
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+    def _modified(self):
+        owner = self._owner
+        if self._base is not None:
+            if owner._vars is self._base:
+                owner._vars = self
+            self._base = None
+        # Unless the vars of the object were replaced since
+        if owner._vars is self:
+            owner._invalidate()
+            owner._changed(structure=False)
+
+    def _modifier(method):
+        def modifier(self, *args, **kwargs):
+            self._modified()
+            return method(self, *args, **kwargs)
+        modifier.__name__ = method.__name__
+        return modifier
+
+    __setitem__ = _modifier(dict.__setitem__)
+    __delitem__ = _modifier(dict.__delitem__)
+    clear = _modifier(dict.clear)
+    pop = _modifier(dict.pop)
+    popitem = _modifier(dict.popitem)
+    setdefault = _modifier(dict.setdefault)
+    update = _modifier(dict.update)
+    del _modifier
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+
+def _intern(string):
+    """ Interns a name, if possible (Python 2 can't intern unicode) """
+    try:
+        return intern(string)
+    except TypeError:
+        return string
+
+
+def _intern_keys(variables):
+    """
+    Returns a copy of the dict variables, with all the keys
+    (including the keys of nested dicts) interned.
+    """
+    interned = {}
+    stack = [(interned, variables)]
+    while stack:
+        target, source = stack.pop()
+        for key, value in source.items():
+            if isinstance(key, basestring):
+                key = _intern(key)
+            if isinstance(value, dict):
+                target[key] = {}
+                stack.append((target[key], value))
+            else:
+                target[key] = value
+    return interned
+
+
+def _journaled(method, queued=False, flushes=True):
+    """
+    Records the calls of method into the journal of the inventory, if
+    any (see InventoryJournal). The calls made by another journaled
+    method are part of the entry of that method.
+    In a batch (see InventoryBatch), the calls of the queued methods
+    are queued, and the other calls apply the queued ones first,
+    unless they don't depend on them.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def journaled(self, *args, **kwargs):
+        inventory = self._inventory if isinstance(self, InventoryObject) \
+            else self
+        if inventory is None or inventory._journal is None:
+            return method(self, *args, **kwargs)
+        if inventory._batch is not None:
+            if queued:
+                return inventory._batch._queues[name](self, *args, **kwargs)
+            if flushes:
+                inventory._batch.flush()
+        if inventory._journal._entry is not None:
+            return method(self, *args, **kwargs)
+        return inventory._journal._record_call(self, method, args, kwargs)
+    return journaled
+
+
+def _batched(method):
+    """ Journals method, whose calls are queued in a batch """
+    return _journaled(method, queued=True)
+
+
+def _additive(method):
+    """
+    Journals method, which only adds objects and queues changes,
+    so that it doesn't need to apply the changes queued in a batch.
+    """
+    return _journaled(method, flushes=False)
 
 
 class InventoryObject(object):
+
+    __slots__ = ['_name', '_vars', '_priority', '_resolved', '_inventory',
+                 '_digest']
+
     def __init__(self, name=None):
+        # The Inventory this object belongs to, if any.
+        self._inventory = None
+        # Cache of the content hash, see Inventory.content_hash
+        self._digest = None
         self.name = name
-        self.vars = {}
+        self._vars = _EMPTY_VARS
+        # Cache of the resolved (flattened) vars, None when dirty.
+        self._resolved = None
         # For VARIABLE precedence resolving, we introduce a priority.
         self.priority = 0
 
     def __repr__(self):
         return ("%s(name='%s')" % (self.__class__.__name__, self.name))
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, newname):
+        """
+        Renaming an object must update the name indexes
+        of all the sets this object is member of.
+        """
+        oldname = getattr(self, '_name', None)
+        if oldname is not None and oldname != newname:
+            self._record()
+        self._name = newname
+        if oldname is not None and oldname != newname:
+            for memberset in self._membersets():
+                memberset._rename(self, oldname)
+            self._changed()
+            # Their content lists the name of this object.
+            for container in self._containers():
+                container._changed()
+
+    def _membersets(self):
+        """ Returns the NamedOrderedSets containing this object """
+        return []
+
+    def _containers(self):
+        """ Returns the groups having this object as child or host """
+        return []
+
+    @property
+    def vars(self):
+        """
+        The vars of the object, as a dict that can be modified in place:
+        modifying it marks the object as changed, for the resolved
+        vars, the rendered output and the content hash (but isn't
+        journaled: use set_var/set_vars for that).
+        Internally, _vars is used instead, to not copy the shared
+        vars (copy-on-write): they are only copied when modified.
+        """
+        variables = self._vars
+        if isinstance(variables, _OwnedVars) and variables._owner is self:
+            return variables
+        if isinstance(variables, _FrozenDict):
+            if isinstance(variables, _LazyVars):
+                # Copying would skip the _LazyVars overrides on
+                # Python 2: decode them first.
+                variables._load()
+            return _OwnedVars(self, variables, variables)
+        self._vars = _OwnedVars(self, variables)
+        return self._vars
+
+    @vars.setter
+    @_journaled
+    def vars(self, newvars):
+        self._record()
+        self._vars = newvars
+        self._share_vars()
+        self._invalidate()
+        self._changed(structure=False)
+
+    def _share_vars(self):
+        """
+        When the inventory deduplicates vars, replaces the vars of
+        the object by the shared vars having the same content.
+        """
+        if self._inventory is not None and \
+                self._inventory._vars_pool is not None:
+            self._vars = self._inventory._vars_pool.share(self._vars)
+
+    def has_same_vars(self, other):
+        """
+        Returns True if the vars of other are equal to the vars of this
+        object. When the inventory deduplicates vars, it's O(1).
+        """
+        if self._vars is other._vars:
+            return True
+        if isinstance(self._vars, _SharedVars) and \
+                isinstance(other._vars, _SharedVars) and \
+                self._vars._pool is other._vars._pool:
+            return False
+        return self._vars == other._vars
+
+    @property
+    def priority(self):
+        return self._priority
+
+    @priority.setter
+    @_journaled
+    def priority(self, prio):
+        self._record()
+        self._priority = prio
+        self._invalidate()
+        self._changed(structure=False)
+
+    def _record(self):
+        """
+        Saves the state of this object into the journal entry being
+        recorded, if any, before it's modified.
+        """
+        if self._inventory is not None and \
+                self._inventory._journal is not None:
+            self._inventory._journal._save(self)
+
+    def _capture(self):
+        """ Returns the state of this object, see _rewind """
+        variables = self._vars
+        if not isinstance(variables, _FrozenDict):
+            # set_var modifies the vars in place.
+            variables = dict(variables)
+        return (self._name, variables, self._priority, self._inventory)
+
+    def _rewind(self, state):
+        """
+        Restores the state returned by _capture. The resolved vars
+        and the name indexes are updated by the InventoryJournal.
+        """
+        self._name, self._vars, self._priority, self._inventory = state[:4]
+
+    def _changed(self, structure=True):
+        """
+        Bumps the generation of the inventory this object belongs to,
+        so that the inventory caches know they are outdated, and
+        marks the content hash of this object as outdated.
+        Unless only its vars or its priority changed (not structure),
+        bumps the structure generation of the inventory too.
+        """
+        if self._inventory is not None:
+            self._inventory._generation += 1
+            if structure:
+                self._inventory._structure += 1
+            self._inventory._mark_stale(self)
+
+    def _content(self):
+        """ Returns what the content hash of this object covers """
+        return [self.__class__.__name__, self._name, _plain_vars(self._vars)]
+
+    def _content_digest(self):
+        return _digest(self._content())
+
+    def content_hash(self):
+        """
+        Returns the sha256 (hex) of the content of this object, as
+        rendered: its name and its vars, and for a group, the names
+        of its children and of its hosts, with the host ranges
+        expanded. A host range hashes as the sum of its members,
+        each like a Host. Within an inventory, it's only computed
+        again after the object changed, see Inventory.content_hash.
+        """
+        if self._inventory is None:
+            return '%064x' % self._content_digest()
+        self._inventory._refresh_digests()
+        return '%064x' % self._digest
+
+    def _heirs(self):
+        """ Returns the objects inheriting vars from this object """
+        return []
+
+    def _invalidate(self):
+        """
+        Marks the resolved vars of this object, and of all the objects
+        inheriting from it, as dirty.
+        An object can only be resolved after all its ancestors, so
+        the descendants of a dirty object are dirty too: the walk
+        stops there, and doesn't cost anything for repeated edits.
+        """
+        stack = [self]
+        while stack:
+            current = stack.pop()
+            if current._resolved is not None:
+                current._resolved = None
+                stack.extend(current._heirs())
+
+    @_journaled
     def set_var(self, varname, value):
+        self._record()
         self.vars[varname] = value
+        self._share_vars()
+        self._invalidate()
+        self._changed(structure=False)
 
+    @_batched
     def set_vars(self, newvars, prio=0):
-        self.vars = dict(
-            mergedicts(self.vars, newvars, (self.priority, prio))
-        )
+        self.set_layered_vars(((newvars, prio),))
+
+    @_batched
+    def set_layered_vars(self, layers):
+        """
+        Merges in one pass all the vars of layers, a sequence
+        of (newvars, prio) pairs, into the vars of this object.
+        See mergedicts_many for the merging rules.
+        """
+        self._record()
+        self._vars = _mergedicts_many(
+            itertools.chain(((self._vars, self.priority),), layers))
+        self._share_vars()
+        self._invalidate()
+        self._changed(structure=False)
 
     @staticmethod
     def change_element_index(listname, oldindex, newindex):
@@ -91,95 +897,184 @@ class InventoryObject(object):
 class Group(InventoryObject):
     """ A group of hosts, groups, and/or vars"""
 
-    __slots__ = ['name', 'vars', 'children', 'parents',
-                 'hosts', 'priority']
+    __slots__ = ['children', 'parents', 'hosts', 'host_ranges', '_order']
+
+    # Sources of the topological orders of the groups.
+    _orders = itertools.count()
+    _lowest_orders = itertools.count(-1, -1)
 
     def __init__(self, name=None):
         if not is_valid_name(name):
             raise Exception("Not a valid name")
         else:
             super(Group, self).__init__(name)
-        self.children = []
+        self.children = NamedOrderedSet()
         # Parents is not an ansible information, but it's useful for
         # global loop avoidance when deleting/renaming things.
-        self.parents = []
-        self.hosts = []
+        self.parents = NamedOrderedSet()
+        self.hosts = NamedOrderedSet()
+        # The HostRanges among the hosts, to look up their members.
+        self.host_ranges = OrderedSet()
+        # Every parent has a lower order than its children.
+        self._order = next(Group._orders)
+
+    @staticmethod
+    def _check_hierarchy(parent, child):
+        """
+        Ensures adding child to parent doesn't create a cycle, by
+        maintaining the topological order of the groups (Pearce-Kelly
+        algorithm). In the common case, where parent already has a
+        lower order than child, there is nothing to do.
+        A parent without parents (or a child without children) can't
+        be part of a cycle, and can simply be moved first (or last).
+        That's the case when loading hierarchies, whatever the order
+        in which the groups are defined.
+        Else, only the groups whose order is between the orders of
+        child and parent are visited, and reordered.
+        """
+        lower, upper = child._order, parent._order
+        if lower < upper:
+            if child in parent.children:
+                return
+            if not parent.parents:
+                parent._order = next(Group._lowest_orders)
+                return
+            if not child.children:
+                child._order = next(Group._orders)
+                return
+            # Descendants of child which need to move after parent
+            forward, stack, seen = [], [child], set([child])
+            while stack:
+                group = stack.pop()
+                forward.append(group)
+                for descendant in group.children:
+                    if descendant is parent:
+                        raise Exception(
+                            "Adding %s as child of %s would create a cycle"
+                            % (child, parent))
+                    if descendant._order < upper and descendant not in seen:
+                        seen.add(descendant)
+                        stack.append(descendant)
+            # Ancestors of parent which need to move before child
+            backward, stack, seen = [], [parent], set([parent])
+            while stack:
+                group = stack.pop()
+                backward.append(group)
+                for ancestor in group.parents:
+                    if ancestor._order > lower and ancestor not in seen:
+                        seen.add(ancestor)
+                        stack.append(ancestor)
+            forward.sort(key=lambda group: group._order)
+            backward.sort(key=lambda group: group._order)
+            affected = backward + forward
+            orders = sorted(group._order for group in affected)
+            for group, order in zip(affected, orders):
+                group._record()
+                group._order = order
 
+    @_batched
     def add_parent(self, parent):
         if parent is self:
             raise Exception("Cannot add yourself as parent")
         if not isinstance(parent, Group):
             raise TypeError("%s is not a group" % parent)
-        if parent not in self.parents:
-            self.parents.append(parent)
-        if self not in parent.children:
-            parent.children.append(self)
+        self._record()
+        parent._record()
+        self._check_hierarchy(parent, self)
+        self.parents.add(parent)
+        parent.children.add(self)
+        self._invalidate()
+        self._changed()
+        parent._changed()
 
+    @_journaled
     def del_parent(self, parent):
         if not isinstance(parent, Group):
             raise TypeError("%s is not a group" % parent)
-        if parent in self.parents:
-            self.parents.remove(parent)
-        if self in parent.children:
-            parent.children.remove(self)
+        self._record()
+        parent._record()
+        self.parents.discard(parent)
+        parent.children.discard(self)
+        self._invalidate()
+        self._changed()
+        parent._changed()
 
+    @_journaled
     def replace_parent(self, oldparent, newparent):
         """ Switch parents to change inheritence """
         oldparent.del_child(self)
         newparent.add_child(self)
 
+    @_batched
     def add_child(self, child):
         if not isinstance(child, Group):
             raise TypeError("%s is not a group" % child)
         if child is self:
             raise Exception("Cannot add yourself as child")
-        if child not in self.children:
-            self.children.append(child)
-        if self not in child.parents:
-            child.parents.append(self)
+        self._record()
+        child._record()
+        self._check_hierarchy(self, child)
+        self.children.add(child)
+        child.parents.add(self)
+        child._invalidate()
+        self._changed()
 
+    @_journaled
     def del_child(self, child):
         if not isinstance(child, Group):
             raise TypeError("%s is not a group" % child)
-        if child in self.children:
-            self.children.remove(child)
-        if self in child.parents:
-            child.parents.remove(self)
+        self._record()
+        child._record()
+        self.children.discard(child)
+        child.parents.discard(self)
+        child._invalidate()
+        self._changed()
 
+    @_journaled
     def replace_child(self, oldchild, newchild):
         oldchild.del_parent(self)
         newchild.add_parent(self)
 
+    @_batched
     def add_host(self, host):
         if not isinstance(host, Host):
             raise TypeError("%s is not a host" % host)
-        if host not in self.hosts:
-            self.hosts.append(host)
-        if self not in host.groups:
-            host.groups.append(self)
+        self._record()
+        host._record()
+        self.hosts.add(host)
+        host._link_group(self)
+        host._invalidate()
+        self._changed()
 
+    @_journaled
     def del_host(self, host):
         if not isinstance(host, Host):
             raise TypeError("%s is not a host" % host)
-        if host in self.hosts:
-            self.hosts.remove(host)
-        if self in host.groups:
-            host.groups.remove(self)
+        self._record()
+        host._record()
+        self.hosts.discard(host)
+        host._unlink_group(self)
+        host._invalidate()
+        self._changed()
 
+    @_journaled
     def reorder_children(self, oldindex, newindex):
         """
-        The children are a list, and
+        The children are an ordered set, and
         remember the order of inclusion.
         """
+        self._record()
         self.children = self.change_element_index(
             self.children,
             oldindex,
             newindex
         )
+        self._changed()
 
+    @_journaled
     def reorder_parents(self, oldindex, newindex):
         """
-        The parents are a list, and
+        The parents are an ordered set, and
         remember the order of inclusion.
         This method is used to modify the order of
         the parents, changing an item position from
@@ -189,114 +1084,1918 @@ class Group(InventoryObject):
         rendering values when doing the last
         host flattening (Last match wins if tie).
         """
+        self._record()
         self.parents = self.change_element_index(
             self.parents,
             oldindex,
             newindex
         )
+        self._invalidate()
+        self._changed()
 
+    @_journaled
     def delete(self, reparent_groups=False,
                reparent_hosts=False, reparent_vars=False):
         """
         Wipes a group of the surface of the earth.
         Allow extreme kindness by reparenting data if
         necessary.
+        Each member is unlinked once, and reparented once
+        to each parent: with N members and P parents,
+        this is O(N*P).
         """
-
-        while len(self.hosts) != 0:
-            if reparent_hosts:
-                for parent in self.parents:
-                    self.hosts[0].add_group(parent)
-            self.hosts[0].del_group(self)
+        parents = list(self.parents)
+        hosts = list(self.hosts)
+        children = list(self.children)
+        if reparent_hosts:
+            for host in hosts:
+                for parent in parents:
+                    host.add_group(parent)
         if reparent_vars:
-            for parent in self.parents:
-                parent.set_vars(self.vars, self.priority)
-        while len(self.children) != 0:
-            if reparent_groups:
-                for parent in self.parents:
-                    self.children[0].add_parent(parent)
-            self.children[0].del_parent(self)
-        while len(self.parents) != 0:
-            self.parents[0].del_child(self)
+            for parent in parents:
+                parent.set_vars(self._vars, self.priority)
+        if reparent_groups:
+            for child in children:
+                for parent in parents:
+                    child.add_parent(parent)
+
+        self._record()
+        self.hosts.clear()
+        self.host_ranges.clear()
+        for host in hosts:
+            host._record()
+            host._unlink_group(self)
+            host._invalidate()
+        self.children.clear()
+        for child in children:
+            child._record()
+            child.parents.discard(self)
+            child._invalidate()
+        self.parents.clear()
+        for parent in parents:
+            parent._record()
+            parent.children.discard(self)
+            parent._changed()
+        self._invalidate()
+        self._changed()
 
     def has_host(self, hostname):
-        return any([True for host in self.hosts if host.name == hostname])
+        """
+        Returns True if hostname is a host of this group, or a member
+        of one of its HostRanges. The hosts of 'ungrouped' are the
+        hosts in no other group, as rendered (see
+        Inventory._host_groups).
+        """
+        inventory = self._inventory
+        if inventory is not None and \
+                inventory.groups.get(u'ungrouped') is self:
+            host = inventory.hosts.get(hostname)
+            if host is None:
+                host = inventory.host_ranges.get(hostname)
+            if host is None:
+                host = inventory.find_host_range(hostname)
+            return host is not None and self in inventory._host_groups(host)
+        return (self.hosts.has_name(hostname) or
+                any(hostname in hostrange for hostrange in self.host_ranges))
 
     def has_group(self, groupname):
-        return any([True for group in self.children + self.parents if group.name == groupname])
+        return (self.children.has_name(groupname) or
+                self.parents.has_name(groupname))
+
+    def _containers(self):
+        return self.parents
+
+    def _content(self):
+        children = [child.name for child in self.children]
+        if self._name == u'all' and u'ungrouped' not in children:
+            children.append(u'ungrouped')
+        if self._name == u'ungrouped':
+            # Rendered from the memberships of the other groups
+            hosts = []
+        else:
+            hosts = sorted(_member_names(self.hosts))
+        return super(Group, self)._content() + [sorted(children), hosts]
+
+    def _capture(self):
+        return super(Group, self)._capture() + (
+            list(self.children), list(self.parents), list(self.hosts),
+            self._order)
+
+    def _rewind(self, state):
+        super(Group, self)._rewind(state)
+        children, parents, hosts, self._order = state[4:]
+        self.children = NamedOrderedSet(children)
+        self.parents = NamedOrderedSet(parents)
+        self.hosts = NamedOrderedSet(hosts)
+        self.host_ranges = OrderedSet(
+            host for host in hosts if isinstance(host, HostRange))
+
+    def _membersets(self):
+        return itertools.chain(
+            (child.parents for child in self.children),
+            (parent.children for parent in self.parents),
+            (host.groups for host in self.hosts))
+
+    def _heirs(self):
+        return itertools.chain(self.children, self.hosts)
 
 class Host(InventoryObject):
 
-    __slots__ = ['name', 'groups', 'vars', 'priority']
+    __slots__ = ['_groups']
 
     def __init__(self, name=None):
         if not is_valid_host(name):
             raise Exception("Invalid host name")
         else:
             super(Host, self).__init__(name)
-        self.groups = []
+        self._groups = _EMPTY_GROUPS
+
+    @classmethod
+    def _restore(cls, name, priority, inventory):
+        """
+        Returns a new host of inventory, without validating its name
+        nor bumping the generation, for loading snapshots.
+        """
+        host = cls.__new__(cls)
+        host._name = name
+        host._vars = _EMPTY_VARS
+        host._resolved = None
+        host._priority = priority
+        host._inventory = inventory
+        host._digest = None
+        host._groups = _EMPTY_GROUPS
+        return host
+
+    @property
+    def groups(self):
+        """
+        The groups of the host. Use add_group/del_group
+        (or Group.add_host/del_host) to modify them.
+        """
+        return self._groups
+
+    def _link_group(self, group):
+        if self._groups is _EMPTY_GROUPS:
+            self._groups = NamedOrderedSet()
+            if self._inventory is not None:
+                self._inventory._groupless.pop(self, None)
+        self._groups.add(group)
 
+    def _unlink_group(self, group):
+        self._groups.discard(group)
+        if not self._groups:
+            self._groups = _EMPTY_GROUPS
+            if self._inventory is not None:
+                self._inventory._groupless[self] = None
+
+    @_batched
     def add_group(self, group):
         group.add_host(self)
 
+    @_journaled
     def del_group(self, group):
         group.del_host(self)
 
+    @_journaled
     def reorder_groups(self, oldindex, newindex):
-        self.groups = self.change_element_index(
-            self.groups,
+        self._record()
+        self._groups = self.change_element_index(
+            self._groups,
             oldindex,
             newindex
         )
+        self._invalidate()
+        self._changed()
 
+    @_journaled
     def delete(self):
         while len(self.groups) != 0:
             group = self.groups[0]
             group.del_host(self)
 
     def has_group(self, groupname):
-        return any([True for group in self.groups if group.name == groupname])
+        return self.groups.has_name(groupname)
 
+    def _capture(self):
+        return super(Host, self)._capture() + (list(self._groups),)
 
-class Inventory(object):
-    def __init__(self):
-        self.groups = {}
-        self.hosts = {}
+    def _rewind(self, state):
+        super(Host, self)._rewind(state)
+        groups = state[4]
+        self._groups = NamedOrderedSet(groups) if groups else _EMPTY_GROUPS
 
-    def add_special_groups(self):
-        self.add_group('ungrouped')
-        self.add_group('all')
-        self.groups['all'].add_child(self.groups['ungrouped'])
+    def _membersets(self):
+        return (group.hosts for group in self.groups)
 
-    def load_inventoryjson(self, jsoncontent):
-        # _meta is the only information outside group data
-        hosts_metadata = jsoncontent.pop('_meta')
-        for hostname, hostvars in hosts_metadata['hostvars'].items():
-            self.create_host(hostname, hostvars)
+    def _containers(self):
+        return self.groups
 
-        # Groups are created after hosts, so that
-        # group/host membership can be updated.
-        # group data is structured in json file as
-        # groupname: {"children":[], "hosts": [], "vars": {}}
-        for groupname, groupinfo in jsoncontent.items():
-            # Discover groups and their structure
-            self.add_group(groupname, groupinfo)
 
-    # refactor add group
-    # to be split into add, create, and update
-    def add_group(self, groupname, groupinfo=None, allow_update=True):
-        """ This adds a group with groupname.
-        By default it allows updating a new group groupname with
-        groupinfo. If allow_update=False, only new groups are allowed.
-        THe difference is useful for inventory serialization:
-        We can recursively add_groups on parents/children, but
-        care about their variables later.
-        """
-        is_new_group = False
-        if groupname not in self.groups.keys():
-            is_new_group = True
-        if is_new_group or allow_update:
-            self._process_groupadd(groupname, groupinfo, is_new_group)
+class HostRange(Host):
+    """
+    Many hosts declared at once, like web[01:50].example.com, sharing
+    their groups, vars and priority.
+    It's stored as a single record, and behaves like a set of the
+    names of its members, expanded lazily when iterated.
+    A member given vars of its own is materialized by the Inventory
+    into a real Host, which is then excluded from the range, but still
+    follows the range when it's added to or removed from a group.
+    """
+
+    __slots__ = ['_segments', '_regex', '_size', '_members']
+
+    def __init__(self, name=None):
+        self._segments = _parse_host_range(name)
+        InventoryObject.__init__(self, name)
+        self._groups = _EMPTY_GROUPS
+        pattern, self._size = [], 1
+        for segment in self._segments:
+            if isinstance(segment, basestring):
+                pattern.append(re.escape(segment))
+                continue
+            start, end, step, width = segment
+            if width is None:
+                pattern.append('([a-zA-Z])')
+            elif width:
+                pattern.append('([0-9]{%d})' % width)
+            else:
+                pattern.append('(0|[1-9][0-9]*)')
+            self._size *= (end - start) // step + 1
+        self._regex = re.compile(''.join(pattern) + '$')
+        # The names excluded from the range: the materialized ones,
+        # mapped to their Host, and the deleted ones, mapped to None.
+        self._members = {}
+
+    def __len__(self):
+        return self._size - len(self._members)
+
+    def __iter__(self):
+        choices = []
+        for segment in self._segments:
+            if isinstance(segment, basestring):
+                choices.append((segment,))
+            else:
+                start, end, step, width = segment
+                choices.append([_format_range_value(value, width)
+                                for value in range(start, end + 1, step)])
+        for parts in itertools.product(*choices):
+            name = ''.join(parts)
+            if name not in self._members:
+                yield name
+
+    def __contains__(self, name):
+        if not isinstance(name, basestring) or name in self._members:
+            return False
+        match = self._regex.match(name)
+        if match is None:
+            return False
+        ranges = (segment for segment in self._segments
+                  if not isinstance(segment, basestring))
+        for value, (start, end, step, width) in zip(match.groups(), ranges):
+            value = ord(value) if width is None else int(value)
+            if not start <= value <= end or (value - start) % step:
+                return False
+        return True
+
+    def _link_group(self, group):
+        super(HostRange, self)._link_group(group)
+        group.host_ranges.add(self)
+        for host in self.materialized_hosts():
+            group.add_host(host)
+
+    def _unlink_group(self, group):
+        super(HostRange, self)._unlink_group(group)
+        group.host_ranges.discard(self)
+        for host in self.materialized_hosts():
+            group.del_host(host)
+
+    def materialized_hosts(self):
+        return [host for host in self._members.values() if host is not None]
+
+    def _claim(self, host):
+        """ Excludes the materialized host from the range """
+        self._record()
+        self._members[host.name] = host
+        for group in self.groups:
+            group.add_host(host)
+        self._changed()
+
+    def _exclude(self, name):
+        """ Excludes the deleted member name from the range """
+        self._record()
+        self._members[name] = None
+        self._changed()
+        # The json of the groups lists the members of the range.
+        for group in self.groups:
+            group._changed()
+
+    def _content_digest(self):
+        """
+        Returns the sum of the digests of the members, each hashed
+        like a Host, as they are rendered: the same hosts hash the
+        same, whether in a range, materialized or not.
+        """
+        # The canonical json of [u'Host', name, vars], vars encoded once
+        encode = _CANONICAL_ENCODER.encode
+        suffix = (u',' + encode(_plain_vars(self._vars)) + u']').encode(
+            'utf-8')
+        digests = 0
+        for name in self:
+            encoded = (u'["Host",' + encode(name)).encode('utf-8') + suffix
+            digests += int(hashlib.sha256(encoded).hexdigest(), 16)
+        return digests % _DIGEST_MODULUS
+
+    def _capture(self):
+        return super(HostRange, self)._capture() + (dict(self._members),)
+
+    def _rewind(self, state):
+        super(HostRange, self)._rewind(state)
+        self._members = state[5]
+
+    def overlaps(self, other):
+        """ Returns True if other has members in common with this range """
+        smaller, larger = sorted((self, other), key=len)
+        return any(name in larger for name in smaller)
+
+
+class HostRangeMember(object):
+    """
+    A member of a HostRange, as returned by Inventory.select, without
+    materializing it into a Host: a read-only view of the range under
+    the name of the member. Modifying it (set_var, add_group, ...)
+    materializes it into a Host first (see Inventory.get_host), whose
+    other attributes and methods it then forwards to.
+    """
+
+    __slots__ = ['name', 'hostrange', '_inventory']
+
+    def __init__(self, inventory, hostrange, name):
+        self._inventory = inventory
+        self.hostrange = hostrange
+        self.name = name
+
+    def __repr__(self):
+        return ("%s(name='%s')" % (self.__class__.__name__, self.name))
+
+    @property
+    def vars(self):
+        """ The vars of the range, read-only """
+        variables = self.hostrange._vars
+        if not isinstance(variables, _FrozenDict):
+            variables = _FrozenDict(variables)
+        return variables
+
+    @vars.setter
+    def vars(self, newvars):
+        self.materialize().vars = newvars
+
+    @property
+    def priority(self):
+        return self.hostrange.priority
+
+    @priority.setter
+    def priority(self, prio):
+        self.materialize().priority = prio
+
+    @property
+    def groups(self):
+        return self.hostrange.groups
+
+    def has_group(self, groupname):
+        return self.hostrange.has_group(groupname)
+
+    def materialize(self):
+        """ Returns the Host this member is (or was) materialized into """
+        return self._inventory.get_host(self.name)
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        return getattr(self.materialize(), attribute)
+
+
+def _member_names(hosts):
+    """ Yields the names of hosts, expanding the host ranges """
+    for host in hosts:
+        if isinstance(host, HostRange):
+            for name in host:
+                yield name
+        else:
+            yield host.name
+
+
+def _first(item):
+    return item[0]
+
+
+_CANONICAL_ENCODER = json.JSONEncoder(sort_keys=True, separators=(',', ':'))
+# The content hashes are 256 bits ints, summed modulo _DIGEST_MODULUS.
+_DIGEST_MODULUS = 1 << 256
+
+
+def _plain_vars(variables):
+    """
+    Returns variables, or for _LazyVars never read, a dict decoded
+    from their json, without loading them.
+    """
+    if isinstance(variables, _LazyVars) and not variables.loaded:
+        return json.loads(variables.raw())
+    return variables
+
+
+def _digest(content):
+    """ Returns the sha256 of the canonical json of content, as an int """
+    encoded = _CANONICAL_ENCODER.encode(content).encode('utf-8')
+    return int(hashlib.sha256(encoded).hexdigest(), 16)
+
+
+# The positions of the bits set in each byte value.
+_BYTE_BITS = [tuple(bit for bit in range(8) if byte >> bit & 1)
+              for byte in range(256)]
+
+
+def _bitset_from_ids(ids, size):
+    """ Returns the int having the bits of ids set """
+    buf = bytearray((size + 7) // 8)
+    for index in ids:
+        buf[index >> 3] |= 1 << (index & 7)
+    if hasattr(int, 'from_bytes'):
+        return int.from_bytes(bytes(buf), 'little')
+    # Python 2
+    return int(binascii.hexlify(bytes(buf[::-1])) or b'0', 16)
+
+
+def _ids_from_bitset(bits):
+    """ Returns the sorted positions of the bits set in bits """
+    if hasattr(bits, 'to_bytes'):
+        buf = bytearray(bits.to_bytes((bits.bit_length() + 7) // 8, 'little'))
+    else:
+        # Python 2
+        hexa = '%x' % bits
+        buf = bytearray(binascii.unhexlify('0' * (len(hexa) % 2) + hexa))
+        buf.reverse()
+    ids = []
+    for index, byte in enumerate(buf):
+        if byte:
+            base = index << 3
+            ids.extend(base + bit for bit in _BYTE_BITS[byte])
+    return ids
+
+
+def _split_pattern(pattern):
+    """
+    Splits an ansible host pattern into its terms, on ':' or ',',
+    except between brackets (web[1:3] is a single term).
+    """
+    terms, term, depth = [], [], 0
+    for char in pattern:
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char in ':,' and depth == 0:
+            terms.append(''.join(term).strip())
+            term = []
+            continue
+        term.append(char)
+    terms.append(''.join(term).strip())
+    return [term for term in terms if term]
+
+
+# A term ending with [x] or [x:y] (or [x-y]) selects
+# a subset of the hosts it matches.
+_SUBSCRIPTED_TERM = re.compile(
+    r'''^(.+)\[(?:(-?[0-9]+)|([0-9]+)([:-])([0-9]*))\]$''')
+_GLOB_CHARS = '*?['
+_REGEX_CHARS = '.^$*+?{}[]\\|()'
+
+
+def _split_subscript(term):
+    """
+    Returns the term without its subscript, and the subscript
+    as (start, end), end being inclusive, or None.
+    """
+    if term[0] == '~':
+        return term, None
+    match = _SUBSCRIPTED_TERM.match(term)
+    if not match:
+        return term, None
+    name, index, start, _, end = match.groups()
+    if index is not None:
+        return name, (int(index), None)
+    return name, (int(start), int(end) if end else -1)
+
+
+def _literal_prefix(term):
+    """
+    Returns the literal prefix of a glob, or of a ~regex term:
+    all the names it matches start with it.
+    """
+    if term[0] != '~':
+        for index, char in enumerate(term):
+            if char in _GLOB_CHARS:
+                return term[:index]
+        return term
+    regex = term[1:]
+    escaped = False
+    for char in regex:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '|':
+            # The alternatives can have any prefix.
+            return ''
+    for index, char in enumerate(regex):
+        if char in _REGEX_CHARS:
+            # A quantifier makes the previous char optional.
+            if char in '*?{' and index:
+                index -= 1
+            return regex[:index]
+    return regex
+
+
+def _order_pattern(terms):
+    """
+    Like ansible, evaluates the union terms first, then the
+    intersections (&), then the exclusions (!).
+    With only intersections or exclusions, starts from 'all'.
+    """
+    unions = [term for term in terms if term[0] not in '&!']
+    intersections = [term for term in terms if term[0] == '&']
+    exclusions = [term for term in terms if term[0] == '!']
+    if not unions:
+        unions = [u'all']
+    return unions + intersections + exclusions
+
+
+def _csr_row(csr, index):
+    """ Returns the ids of the row index of csr, (offsets, targets) """
+    offsets, targets = csr
+    return targets[offsets[index]:offsets[index + 1]]
+
+
+def _dump_vars(variables):
+    """ Returns the utf-8 json of variables, or b'' if empty """
+    if isinstance(variables, _LazyVars) and not variables.loaded:
+        return variables.raw().encode('utf-8')
+    if not variables:
+        return b''
+    return json.dumps(variables).encode('utf-8')
+
+
+def _csr(nodes, neighbours, ids):
+    """
+    Returns the adjacency of nodes in compressed sparse row format:
+    the ids of the neighbours of the node i are
+    targets[offsets[i]:offsets[i + 1]].
+    Neighbours without id (not in the inventory) are skipped.
+    """
+    offsets, targets = array('i', [0]), array('i')
+    for node in nodes:
+        targets.extend(ids[neighbour] for neighbour in neighbours(node)
+                       if neighbour in ids)
+        offsets.append(len(targets))
+    return offsets, targets
+
+
+class InventoryGraph(object):
+    """
+    A compact, read-only view of the graph of an inventory.
+    Hosts and groups are numbered with dense integer ids, and their
+    relationships are stored as arrays of ids, so that traversals are
+    loops over integers instead of objects.
+    Group ids follow the topological order of the groups: a parent
+    always has a lower id than its children.
+    Each member of a HostRange has its own host id, and the range
+    itself as entry in hosts.
+    Get it with Inventory.get_graph(), which rebuilds it when the
+    structure of the inventory changed.
+    """
+
+    def __init__(self, inventory):
+        self.structure = inventory._structure
+        self.groups = sorted(inventory.groups.values(),
+                             key=lambda group: group._order)
+        self.hosts, self.host_names = [], []
+        for hostname, hostdata in inventory._iter_hosts():
+            self.hosts.append(hostdata)
+            self.host_names.append(hostname)
+        self.group_ids = dict((group.name, groupid)
+                              for groupid, group in enumerate(self.groups))
+        self.host_ids = dict((hostname, hostid)
+                             for hostid, hostname in enumerate(self.host_names))
+        groupids = dict((group, groupid)
+                        for groupid, group in enumerate(self.groups))
+        hostids = self.host_ids
+        # The members of 'ungrouped' are the hosts in no other group,
+        # as rendered (see Inventory._host_groups).
+        ungrouped = inventory.groups.get(u'ungrouped')
+
+        def group_hosts(group):
+            if group is ungrouped:
+                return inventory._ungrouped_hostnames()
+            return _member_names(group.hosts)
+        self.children_offsets, self.children = _csr(
+            self.groups, lambda group: group.children, groupids)
+        self.parents_offsets, self.parents = _csr(
+            self.groups, lambda group: group.parents, groupids)
+        self.hosts_offsets, self.group_hosts = _csr(
+            self.groups, group_hosts, hostids)
+        self.groups_offsets, self.host_groups = _csr(
+            self.hosts, inventory._host_groups, groupids)
+        self._group_bitsets = None
+        self._sorted_groupnames = None
+        self._sorted_hostnames = None
+
+    def children_of(self, groupid):
+        return self.children[
+            self.children_offsets[groupid]:self.children_offsets[groupid + 1]]
+
+    def parents_of(self, groupid):
+        return self.parents[
+            self.parents_offsets[groupid]:self.parents_offsets[groupid + 1]]
+
+    def hosts_of(self, groupid):
+        return self.group_hosts[
+            self.hosts_offsets[groupid]:self.hosts_offsets[groupid + 1]]
+
+    def groups_of(self, hostid):
+        return self.host_groups[
+            self.groups_offsets[hostid]:self.groups_offsets[hostid + 1]]
+
+    def descendant_groups(self, groupid):
+        """ Returns the ids of groupid and all its descendants, sorted """
+        seen = bytearray(len(self.groups))
+        seen[groupid] = 1
+        stack, found = [groupid], [groupid]
+        children, offsets = self.children, self.children_offsets
+        while stack:
+            current = stack.pop()
+            for index in range(offsets[current], offsets[current + 1]):
+                child = children[index]
+                if not seen[child]:
+                    seen[child] = 1
+                    found.append(child)
+                    stack.append(child)
+        found.sort()
+        return found
+
+    def descendant_hosts(self, groupid):
+        """
+        Returns the ids of the hosts of groupid and of
+        all its descendants, sorted.
+        """
+        seen = bytearray(len(self.hosts))
+        found = []
+        hosts, offsets = self.group_hosts, self.hosts_offsets
+        for current in self.descendant_groups(groupid):
+            for index in range(offsets[current], offsets[current + 1]):
+                host = hosts[index]
+                if not seen[host]:
+                    seen[host] = 1
+                    found.append(host)
+        found.sort()
+        return found
+
+    @property
+    def all_hosts_bitset(self):
+        return (1 << len(self.hosts)) - 1
+
+    def group_bitset(self, groupid):
+        """
+        Returns the hosts of groupid, including the hosts of its
+        descendants, as a bitset: the bit hostid is set for each host.
+        The bitsets of all groups are computed at once, bottom up.
+        """
+        if self._group_bitsets is None:
+            bitsets = [0] * len(self.groups)
+            # Children always have a higher id than their parents.
+            for current in range(len(self.groups) - 1, -1, -1):
+                bits = _bitset_from_ids(self.hosts_of(current), len(self.hosts))
+                for child in self.children_of(current):
+                    bits |= bitsets[child]
+                bitsets[current] = bits
+            self._group_bitsets = bitsets
+        return self._group_bitsets[groupid]
+
+    def _match_names(self, term, sorted_names):
+        """
+        Returns the names of sorted_names matching a glob or ~regex term.
+        Only the names starting with the literal prefix of the term
+        are tested, found by bisecting sorted_names.
+        """
+        if term[0] == '~':
+            matcher = re.compile(term[1:]).match
+        else:
+            matcher = re.compile(fnmatch.translate(term)).match
+        prefix = _literal_prefix(term)
+        matches = []
+        for index in range(bisect.bisect_left(sorted_names, prefix),
+                           len(sorted_names)):
+            name = sorted_names[index]
+            if not name.startswith(prefix):
+                break
+            if matcher(name):
+                matches.append(name)
+        return matches
+
+    def _matching_bitset(self, term):
+        """
+        Returns the bitset of the hosts matching a term without subscript.
+        Like ansible, the groups are matched first, and the hosts
+        are only matched if no group did, or for globs and regexes.
+        """
+        if term in (u'all', u'*'):
+            return self.all_hosts_bitset
+        if term[0] != '~' and not any(char in term for char in _GLOB_CHARS):
+            if term in self.group_ids:
+                return self.group_bitset(self.group_ids[term])
+            if term == u'ungrouped':
+                # Not defined, but rendered: the hosts without groups
+                offsets = self.groups_offsets
+                return _bitset_from_ids(
+                    [hostid for hostid in range(len(self.hosts))
+                     if offsets[hostid] == offsets[hostid + 1]],
+                    len(self.hosts))
+            if term in self.host_ids:
+                return 1 << self.host_ids[term]
+            return 0
+        if self._sorted_groupnames is None:
+            self._sorted_groupnames = sorted(self.group_ids)
+            self._sorted_hostnames = sorted(self.host_ids)
+        bits = 0
+        for groupname in self._match_names(term, self._sorted_groupnames):
+            bits |= self.group_bitset(self.group_ids[groupname])
+        hostids = [self.host_ids[hostname] for hostname in
+                   self._match_names(term, self._sorted_hostnames)]
+        return bits | _bitset_from_ids(hostids, len(self.hosts))
+
+    def term_bitset(self, term):
+        """
+        Returns the bitset of the hosts matching a single pattern term:
+        'all' or '*', a group or host name, a glob (web*), a regex
+        (~web\\d+), optionally followed by a subscript ([0], [-1],
+        [1:3], [2:]) selecting some of those hosts, in id order.
+        """
+        term, subscript = _split_subscript(term)
+        bits = self._matching_bitset(term)
+        if subscript is None or not bits:
+            return bits
+        hostids = _ids_from_bitset(bits)
+        start, end = subscript
+        if end is None:
+            try:
+                return 1 << hostids[start]
+            except IndexError:
+                return 0
+        if end == -1:
+            end = len(hostids) - 1
+        return _bitset_from_ids(hostids[start:end + 1], len(self.hosts))
+
+    def pattern_bitset(self, pattern):
+        """
+        Returns the bitset of the hosts matching an ansible host
+        pattern, like 'web:&prod:!canary'. Each term is evaluated
+        with term_bitset, then combined with bitwise operations.
+        """
+        bits = 0
+        for term in _order_pattern(_split_pattern(pattern)):
+            if term[0] == '&':
+                bits &= self.term_bitset(term[1:])
+            elif term[0] == '!':
+                bits &= ~self.term_bitset(term[1:])
+            else:
+                bits |= self.term_bitset(term)
+        return bits
+
+    def hostnames(self, bits):
+        """ Returns the names of the hosts of a bitset, in id order """
+        return [self.host_names[hostid] for hostid in _ids_from_bitset(bits)]
+
+
+def _vars_digest(variables):
+    """
+    Returns a hash of the content of variables,
+    or None if they can't be serialized.
+    """
+    try:
+        return hash(json.dumps(variables, sort_keys=True))
+    except (TypeError, ValueError):
+        return None
+
+
+def _vars_changes(oldvars, newvars):
+    """
+    Returns the changes of the top level keys from the vars oldvars
+    to newvars, as a dict with the 'added' and 'removed' keys and
+    values, and the 'changed' keys with their (old, new) values.
+    Returns None if the vars are equal.
+    """
+    if oldvars is newvars:
+        return None
+    if isinstance(oldvars, _LazyVars) and isinstance(newvars, _LazyVars) \
+            and not oldvars.loaded and not newvars.loaded \
+            and oldvars.raw() == newvars.raw():
+        return None
+    if oldvars == newvars:
+        return None
+    return {
+        'added': dict((key, value) for key, value in newvars.items()
+                      if key not in oldvars),
+        'removed': dict((key, value) for key, value in oldvars.items()
+                        if key not in newvars),
+        'changed': dict((key, (oldvars[key], value))
+                        for key, value in newvars.items()
+                        if key in oldvars and oldvars[key] != value),
+    }
+
+
+def _match_renames(removed, added, signature, renames):
+    """
+    Pairs the removed and added objects not renamed yet, which have
+    the same signature, adding them to renames, {oldname: newname}.
+    signature(inventoryobject, old) must name the relationships of
+    the old objects as they are renamed in new.
+    """
+    renamed = set(renames.values())
+    candidates = {}
+    for name, inventoryobject in added:
+        if name not in renamed:
+            candidates.setdefault(signature(inventoryobject, False),
+                                  []).append(name)
+    for name, inventoryobject in removed:
+        if name in renames:
+            continue
+        names = candidates.get(signature(inventoryobject, True))
+        if names:
+            renames[name] = names.pop(0)
+
+
+def _same_digest(oldobject, newobject):
+    """
+    Returns True if both objects have the same content hash, computed
+    by Inventory._refresh_digests.
+    """
+    return oldobject is not None and oldobject._digest is not None and \
+        oldobject._digest == newobject._digest
+
+
+def _mapped_names(names, mapping):
+    """ Returns the sorted names, renamed through mapping """
+    return tuple(sorted(mapping.get(name, name) for name in names))
+
+
+class InventoryDiff(object):
+    """
+    The structural differences from the inventory old to new:
+      - the names of the hosts and groups added or removed,
+      - the (oldname, newname) of the hosts and groups renamed, which
+        are removed objects matching an added object, by their vars
+        and relationships,
+      - the (group, child) children and (group, host) members
+        added or removed, named as in new,
+      - for the hosts and groups of both, the changes of their vars,
+        by name in new, see _vars_changes.
+    Objects are paired by name, and the ones with the same content
+    hash in both (see Inventory.content_hash) are skipped: only the
+    others have their vars and edges compared.
+    Get it with Inventory.diff(other).
+    """
+
+    def __init__(self, old, new):
+        old._refresh_digests()
+        new._refresh_digests()
+        oldhosts = _ordereddict(old._iter_hosts())
+        newhosts = _ordereddict(new._iter_hosts())
+        groups = self._removed_added(old.groups, new.groups)
+        hosts = self._removed_added(oldhosts, newhosts)
+        groupmap, hostmap = {}, {}
+        # The signatures of groups name their hosts, and the ones of
+        # hosts name their groups: match again once some are renamed,
+        # then only count the hosts of the groups, and the groups
+        # of the hosts, for the objects renamed together.
+        for strict in (True, True, False):
+            if groups[0] and groups[1]:
+                _match_renames(groups[0], groups[1], self._group_signature(
+                    groupmap, hostmap, strict), groupmap)
+            for hosts_strict in (True, strict):
+                if hosts[0] and hosts[1]:
+                    _match_renames(hosts[0], hosts[1], self._host_signature(
+                        groupmap, hosts_strict), hostmap)
+        self._set_names('groups', groups, groupmap)
+        self._set_names('hosts', hosts, hostmap)
+        # The groups hashing the same render the same children and hosts
+        unchanged = set(name for name, group in new.groups.items()
+                        if _same_digest(old.groups.get(name), group))
+        self.children_added, self.children_removed = self._diff_edges(
+            old.groups, new.groups, groupmap, unchanged,
+            lambda group: (child.name for child in group.children))
+        self.members_added, self.members_removed = self._diff_edges(
+            old.groups, new.groups, groupmap, unchanged,
+            lambda group: _member_names(group.hosts), hostmap)
+        self.groupvars_changed = self._diff_vars(old.groups, new.groups,
+                                                 groupmap)
+        self.hostvars_changed = self._diff_vars(oldhosts, newhosts, hostmap)
+
+    def __bool__(self):
+        return any((self.hosts_added, self.hosts_removed, self.hosts_renamed,
+                    self.groups_added, self.groups_removed,
+                    self.groups_renamed, self.children_added,
+                    self.children_removed, self.members_added,
+                    self.members_removed, self.groupvars_changed,
+                    self.hostvars_changed))
+
+    __nonzero__ = __bool__
+
+    @staticmethod
+    def _group_signature(groupmap, hostmap, strict):
+        def signature(group, isold):
+            members = _member_names(group.hosts)
+            return (_vars_digest(group._vars),
+                    _mapped_names((child.name for child in group.children),
+                                  groupmap if isold else {}),
+                    _mapped_names(members, hostmap if isold else {})
+                    if strict else sum(1 for _ in members))
+        return signature
+
+    @staticmethod
+    def _host_signature(groupmap, strict):
+        def signature(host, isold):
+            return (_vars_digest(host._vars),
+                    _mapped_names((group.name for group in host.groups),
+                                  groupmap if isold else {})
+                    if strict else len(host.groups))
+        return signature
+
+    @staticmethod
+    def _removed_added(oldobjects, newobjects):
+        """ Returns the (name, object) removed and added """
+        return ([(name, inventoryobject)
+                 for name, inventoryobject in oldobjects.items()
+                 if name not in newobjects],
+                [(name, inventoryobject)
+                 for name, inventoryobject in newobjects.items()
+                 if name not in oldobjects])
+
+    def _set_names(self, kind, removed_added, renames):
+        """ Sets the kind_removed, kind_added and kind_renamed attributes """
+        removed, added = removed_added
+        renamed = set(renames.values())
+        setattr(self, kind + '_removed',
+                [name for name, _ in removed if name not in renames])
+        setattr(self, kind + '_added',
+                [name for name, _ in added if name not in renamed])
+        setattr(self, kind + '_renamed', sorted(renames.items()))
+
+    @staticmethod
+    def _diff_edges(oldgroups, newgroups, groupmap, unchanged, neighbours,
+                    neighbourmap=None):
+        """
+        Returns the (group, neighbour) edges added and removed,
+        named as in new, neighbours(group) yielding the names
+        of the neighbours of a group. The groups named in unchanged
+        are skipped.
+        """
+        if neighbourmap is None:
+            neighbourmap = groupmap
+        oldedges = {}
+        for name, group in oldgroups.items():
+            name = groupmap.get(name, name)
+            if name not in unchanged:
+                oldedges[name] = [neighbourmap.get(neighbour, neighbour)
+                                  for neighbour in neighbours(group)]
+        added, removed = [], []
+        for name, group in newgroups.items():
+            if name in unchanged:
+                continue
+            edges = list(neighbours(group))
+            previous = oldedges.pop(name, [])
+            if edges == previous:
+                continue
+            previous_set, edges_set = set(previous), set(edges)
+            added.extend((name, neighbour) for neighbour in edges
+                         if neighbour not in previous_set)
+            removed.extend((name, neighbour) for neighbour in previous
+                           if neighbour not in edges_set)
+        for name, previous in oldedges.items():
+            removed.extend((name, neighbour) for neighbour in previous)
+        return added, removed
+
+    @staticmethod
+    def _diff_vars(oldobjects, newobjects, renames):
+        """ Returns {name: changes} for the objects whose vars changed """
+        changed = {}
+        # The vars shared by many hosts (ranges, dedup) are compared once
+        compared = {}
+        for oldname, oldobject in oldobjects.items():
+            name = renames.get(oldname, oldname)
+            newobject = newobjects.get(name)
+            if newobject is None or \
+                    name == oldname and _same_digest(oldobject, newobject):
+                continue
+            key = (id(oldobject._vars), id(newobject._vars))
+            if key not in compared:
+                compared[key] = _vars_changes(oldobject._vars,
+                                              newobject._vars)
+            if compared[key] is not None:
+                changed[name] = compared[key]
+        return changed
+
+
+def _journal_ref(target):
+    """ Returns the reference of an inventory object in a journal entry """
+    if isinstance(target, Group):
+        return [u'group', target.name]
+    if isinstance(target, Host):
+        return [u'host', target.name]
+    return [u'inventory', None]
+
+
+_MISSING = object()
+
+
+class _JournalEntry(object):
+    """
+    What's needed to undo a journal entry: the objects touched by
+    id, the states saved for those which existed before the entry,
+    and the values saved for the keys of each mapping.
+    """
+
+    __slots__ = ['objects', 'states', 'keys']
+
+    def __init__(self):
+        self.objects = {}
+        self.states = {}
+        self.keys = {}
+
+
+class InventoryJournal(object):
+    """
+    An append-only journal of the changes made to an inventory, see
+    Inventory.start_journal.
+    Each call of a mutating method of the inventory, of its groups or
+    of its hosts is an entry, referencing the objects by name, so that
+    the journal can be written as json lines, read back, and replayed
+    onto another inventory, like the snapshot of the inventory it
+    started from.
+    While recording an entry, the state of each object is saved before
+    it's first modified, so that the entries recorded can be undone
+    without copying the inventory. An entry failing with an exception
+    is undone, and not recorded.
+    Modifying the vars dicts in place isn't journaled: use
+    set_var/set_vars instead.
+    """
+
+    def __init__(self, fp=None):
+        """
+        When fp is given, the entries are also appended to this text
+        file object as they are recorded, with the undo markers.
+        """
+        self.fp = fp
+        # The Inventory recording into this journal, if any.
+        self.inventory = None
+        # The entries, as json lines.
+        self._entries = []
+        # For each entry, what's needed to undo it, or None.
+        self._undos = []
+        # The _JournalEntry being recorded, if any.
+        self._entry = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        """
+        Yields the entries, as dicts of the target and the op called
+        on it, the args and kwargs, and the refs: the args indexes
+        and kwargs names of the objects passed as arguments.
+        Targets and objects are [kind, name] pairs.
+        """
+        for line in self._entries:
+            yield json.loads(line)
+
+    def write(self, fp):
+        """ Writes the entries as json lines into the text file object fp """
+        for line in self._entries:
+            fp.write(line + u'\n')
+
+    @classmethod
+    def read(cls, fp):
+        """
+        Returns a journal of the entries read from the text file object
+        fp, as written by write, or appended as recorded. The entries
+        undone are skipped. They can be replayed, but not undone.
+        """
+        journal = cls()
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line)
+            if u'undo' in entry:
+                del journal._entries[len(journal._entries) - entry[u'undo']:]
+            else:
+                journal._entries.append(line)
+        journal._undos = [None] * len(journal._entries)
+        return journal
+
+    def replay(self, inventory, start=0):
+        """
+        Applies the entries, from the index start, onto inventory.
+        When inventory is journaled, they are recorded again.
+        """
+        for entry in itertools.islice(self, start, None):
+            target = self._resolve(inventory, entry[u'target'])
+            args, kwargs = entry[u'args'], entry[u'kwargs']
+            for ref in entry[u'refs']:
+                if isinstance(ref, int):
+                    args[ref] = self._resolve(inventory, args[ref])
+                else:
+                    kwargs[ref] = self._resolve(inventory, kwargs[ref])
+            kwargs = dict((str(key), value) for key, value in kwargs.items())
+            if isinstance(getattr(type(target), entry[u'op'], None),
+                          property):
+                setattr(target, entry[u'op'], *args)
+            else:
+                getattr(target, entry[u'op'])(*args, **kwargs)
+
+    @staticmethod
+    def _resolve(inventory, ref):
+        kind, name = ref
+        if kind == u'group':
+            return inventory.groups[name]
+        if kind == u'host':
+            if name in inventory.host_ranges:
+                return inventory.host_ranges[name]
+            return inventory.get_host(name)
+        return inventory
+
+    def undo(self, count=1):
+        """ Undoes the count last entries recorded by this journal """
+        if count > len(self._undos) or \
+                any(undo is None for undo in self._undos[-count:]):
+            raise Exception("Only the entries recorded by this "
+                            "journal can be undone")
+        for _ in range(count):
+            self._entries.pop()
+            self._rewind(self._undos.pop())
+        if self.fp is not None:
+            self.fp.write(json.dumps({u'undo': count}) + u'\n')
+
+    def _record_call(self, target, method, args, kwargs):
+        """ Calls method, recording the call as an entry """
+        refs = []
+
+        def encode(key, value):
+            if isinstance(value, InventoryObject):
+                refs.append(key)
+                return _journal_ref(value)
+            if isinstance(value, _LazyVars):
+                return value.copy()
+            return value
+        # Encoded before the call, in case the arguments are modified.
+        line = json.dumps({
+            u'target': _journal_ref(target),
+            u'op': method.__name__,
+            u'args': [encode(index, value)
+                      for index, value in enumerate(args)],
+            u'kwargs': dict((key, encode(key, value))
+                            for key, value in kwargs.items()),
+            u'refs': refs})
+        self._entry = _JournalEntry()
+        try:
+            result = method(target, *args, **kwargs)
+        except BaseException:
+            entry, self._entry = self._entry, None
+            self._rewind(entry)
+            raise
+        self._entries.append(line)
+        self._undos.append(self._entry)
+        self._entry = None
+        if self.fp is not None:
+            self.fp.write(line + u'\n')
+        return result
+
+    def _save(self, inventoryobject):
+        entry = self._entry
+        if entry is not None and id(inventoryobject) not in entry.objects:
+            entry.objects[id(inventoryobject)] = inventoryobject
+            entry.states[id(inventoryobject)] = inventoryobject._capture()
+
+    def _save_created(self, inventoryobject):
+        """
+        Nothing needs to be saved for the objects created by the
+        entry: undoing it removes them from the inventory.
+        """
+        if self._entry is not None:
+            self._entry.objects[id(inventoryobject)] = inventoryobject
+
+    def _save_key(self, mapping, key):
+        entry = self._entry
+        if entry is None:
+            return
+        if id(mapping) not in entry.keys:
+            entry.keys[id(mapping)] = (mapping, {})
+        saved = entry.keys[id(mapping)][1]
+        if key not in saved:
+            saved[key] = mapping.get(key, _MISSING)
+
+    def _rewind(self, entry):
+        """ Restores the objects and the keys saved for an entry """
+        renamed = []
+        for objectid, state in entry.states.items():
+            inventoryobject = entry.objects[objectid]
+            if inventoryobject.name != state[0]:
+                renamed.append((inventoryobject, inventoryobject.name))
+            inventoryobject._rewind(state)
+        for mapping, saved in entry.keys.values():
+            for key, value in saved.items():
+                if value is _MISSING:
+                    mapping.pop(key, None)
+                else:
+                    mapping[key] = value
+        # The name indexes of the sets not saved still have the new names.
+        for inventoryobject, name in renamed:
+            for memberset in inventoryobject._membersets():
+                memberset._rename(inventoryobject, name)
+            for container in inventoryobject._containers():
+                container._changed()
+        for objectid, inventoryobject in entry.objects.items():
+            if objectid in entry.states:
+                inventoryobject._invalidate()
+            else:
+                # Created by the entry, it's not part of the inventory
+                # anymore.
+                inventoryobject._inventory = None
+        inventory = self.inventory
+        if inventory is not None:
+            for inventoryobject in entry.objects.values():
+                inventory._mark_stale(inventoryobject)
+                if isinstance(inventoryobject, Host):
+                    inventory._track_groupless(inventoryobject)
+            inventory._generation += 1
+            inventory._structure += 1
+
+
+class InventoryBatch(object):
+    """
+    Queues the edges added to an inventory (add_child, add_parent,
+    add_host, add_group) and the vars merged (set_vars,
+    set_layered_vars), to apply them in bulk, see Inventory.batch.
+    The queued edges are deduplicated, and applied without the
+    bookkeeping of each call: the vars are merged once per object,
+    and the objects changed are invalidated once.
+    The other changes apply the queued ones first, so that the
+    order of the changes is kept, but the queued changes can't be
+    read until they are applied: when the batch exits, or by flush().
+    If an exception leaves the batch, or a queued edge would create
+    a cycle, the inventory is rolled back to its state before the
+    batch, like an InventoryJournal entry. A journaled inventory
+    can't be batched.
+    """
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+        # Ordered set of (parent, child)
+        self._edges = _ordereddict()
+        # The groups and the hosts added to them, as two lists, not
+        # to allocate a pair per membership.
+        self._members = ([], [])
+        # The vars layers of each object
+        self._layers = _ordereddict()
+        # The journal saving the state of the objects, for rollback
+        self._undo = None
+        # For each bulk pass, the previous number of groups of the
+        # hosts given new groups, and the previous vars of the
+        # objects, when they aren't saved by the journal.
+        self._applied = []
+        # The methods queuing the calls of the queued methods, by name
+        self._queues = {
+            'add_child': self._queue_add_child,
+            'add_parent': self._queue_add_parent,
+            'add_host': self._queue_add_host,
+            'add_group': self._queue_add_group,
+            'set_vars': self._queue_set_vars,
+            'set_layered_vars': self._queue_set_layered_vars,
+        }
+
+    def __enter__(self):
+        inventory = self.inventory
+        if inventory._journal is not None:
+            raise Exception("A journaled inventory can't be batched")
+        self._undo = InventoryJournal()
+        self._undo.inventory = inventory
+        self._undo._entry = _JournalEntry()
+        inventory._journal = self._undo
+        inventory._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        except BaseException:
+            self._rollback()
+            raise
+        else:
+            if exc_type is not None:
+                self._rollback()
+        finally:
+            self.inventory._journal = self.inventory._batch = None
+
+    def _rollback(self):
+        """
+        Restores the objects saved by the journal, then undoes the
+        changes of the bulk passes on the others.
+        """
+        self._edges.clear()
+        self._members = ([], [])
+        self._layers.clear()
+        self._undo._rewind(self._undo._entry)
+        while self._applied:
+            lengths, oldvars = self._applied.pop()
+            # The new groups were added last.
+            for host, length in lengths.items():
+                host._groups = NamedOrderedSet(host._groups[:length]) \
+                    if length else _EMPTY_GROUPS
+                self.inventory._track_groupless(host)
+                host._invalidate()
+            for inventoryobject, variables in oldvars.items():
+                inventoryobject._vars = variables
+                inventoryobject._invalidate()
+                self.inventory._mark_stale(inventoryobject)
+
+    def _queue_add_child(self, group, child):
+        if not isinstance(child, Group):
+            raise TypeError("%s is not a group" % child)
+        if child is group:
+            raise Exception("Cannot add yourself as child")
+        self._edges[(group, child)] = None
+
+    def _queue_add_parent(self, group, parent):
+        if parent is group:
+            raise Exception("Cannot add yourself as parent")
+        if not isinstance(parent, Group):
+            raise TypeError("%s is not a group" % parent)
+        self._edges[(parent, group)] = None
+
+    def _queue_add_host(self, group, host):
+        if not isinstance(host, Host):
+            raise TypeError("%s is not a host" % host)
+        self._members[0].append(group)
+        self._members[1].append(host)
+
+    def _queue_add_group(self, host, group):
+        if not isinstance(group, Group):
+            raise TypeError("%s is not a group" % group)
+        self._members[0].append(group)
+        self._members[1].append(host)
+
+    def _queue_set_vars(self, inventoryobject, newvars, prio=0):
+        self._queue_set_layered_vars(inventoryobject, ((newvars, prio),))
+
+    def _queue_set_layered_vars(self, inventoryobject, layers):
+        self._layers.setdefault(inventoryobject, []).extend(layers)
+
+    def flush(self):
+        """ Applies the changes queued """
+        # Linking a HostRange to a group queues its materialized hosts.
+        while self._edges or self._members[0] or self._layers:
+            edges, self._edges = self._edges, _ordereddict()
+            members, self._members = self._members, ([], [])
+            layers, self._layers = self._layers, _ordereddict()
+            self._apply(edges, members, layers)
+
+    def _apply(self, edges, members, layers):
+        """
+        Applies the changes queued in a bulk pass. Only the groups are
+        saved by the journal: the hosts, much more numerous, aren't
+        copied, see _rollback.
+        """
+        save = self._undo._save
+        saved = self._undo._entry.objects
+        groupless = self.inventory._groupless
+        mark_stale = self.inventory._mark_stale
+        changed = []
+        for parent, child in edges:
+            if child in parent.children:
+                continue
+            save(parent)
+            save(child)
+            mark_stale(parent)
+            Group._check_hierarchy(parent, child)
+            parent.children.add(child)
+            child.parents.add(parent)
+            changed.append(child)
+        # The new hosts of each group, in the order they were added,
+        # and the previous number of groups of the hosts.
+        grouphosts, lengths = _ordereddict(), _ordereddict()
+        for group, host in zip(*members):
+            hosts = grouphosts.get(group)
+            if hosts is None:
+                save(group)
+                mark_stale(group)
+                hosts = grouphosts[group] = _ordereddict()
+            if host in hosts or host in group.hosts._items:
+                continue
+            hosts[host] = None
+            if host not in lengths:
+                lengths[host] = len(host._groups)
+                changed.append(host)
+            if isinstance(host, HostRange):
+                host._link_group(group)
+                continue
+            # Like host._link_group(group), without the calls.
+            groups = host._groups
+            if groups is _EMPTY_GROUPS:
+                groups = host._groups = NamedOrderedSet()
+                groupless.pop(host, None)
+            groups._items[group] = None
+            groups._names[group.name] = group
+        for group, hosts in grouphosts.items():
+            group.hosts.update(hosts)
+        oldvars = {}
+        for inventoryobject, objectlayers in layers.items():
+            if id(inventoryobject) not in saved:
+                # Merging makes new vars: the old ones are left intact.
+                oldvars[inventoryobject] = inventoryobject._vars
+            inventoryobject._vars = _mergedicts_many(itertools.chain(
+                ((inventoryobject._vars, inventoryobject.priority),),
+                objectlayers))
+            inventoryobject._share_vars()
+            mark_stale(inventoryobject)
+            changed.append(inventoryobject)
+        for host in [host for host in lengths if id(host) in saved]:
+            del lengths[host]
+        self._applied.append((lengths, oldvars))
+        for inventoryobject in changed:
+            inventoryobject._invalidate()
+        self.inventory._generation += 1
+        if edges or members[0]:
+            self.inventory._structure += 1
+
+
+class Inventory(object):
+    def __init__(self, compact=False, dedup=False, partial_render=False):
+        """
+        In compact mode, meant for very large inventories, the
+        names of hosts and groups and the keys of their vars are
+        interned, to be shared instead of duplicated in memory.
+        In dedup mode, hosts and groups having equal vars share a
+        single read-only copy of them, copied on write (see vars).
+        In partial_render mode, the json of each host and group is
+        kept when rendered, so that rendering the inventory again
+        only renders the objects changed since (see write_output_bytes).
+        """
+        # Keep the order in which the groups and hosts are defined,
+        # for the patterns and the output.
+        self.groups = _ordereddict()
+        self.hosts = _ordereddict()
+        # The HostRanges, by name (web[01:50]), see add_host.
+        self.host_ranges = _ordereddict()
+        self.compact = compact
+        self._vars_pool = _VarsPool() if dedup else None
+        # Bumped on every modification, see InventoryObject._changed
+        self._generation = 0
+        # Bumped on the modifications of the groups and hosts, their
+        # names and their relationships, but not of their vars: the
+        # InventoryGraph doesn't depend on them.
+        self._structure = 0
+        self._graph = None
+        # The 'all' and 'ungrouped' groups, and their resolved vars,
+        # as they were when the implicit children of 'all' and
+        # members of 'ungrouped' were last resolved.
+        self._root_state = (None, None, None, None)
+        # The InventoryJournal recording the changes, see start_journal
+        self._journal = None
+        # The InventoryBatch queuing the changes, see batch
+        self._batch = None
+        # The hosts and HostRanges without any group, rendered as
+        # members of 'ungrouped'. Kept up to date as hosts gain or
+        # lose their groups, so that rendering doesn't scan the hosts.
+        self._groupless = _ordereddict()
+        # The objects changed, whose content hash and rendered json
+        # are outdated, until handed over by _drain_stale. Only
+        # tracked once there's a cache to update: in partial_render
+        # mode, or after the first content_hash.
+        self._stale = _ordereddict() if partial_render else None
+        # The sum of the content hashes of the groups and the hosts,
+        # and the objects whose hash is outdated, see content_hash.
+        # None until the first content_hash.
+        self._digests = 0
+        self._unhashed = None
+        # The json rendered for each host and group, in normal and
+        # in canonical mode, in partial_render mode.
+        self._pieces = ({}, {}) if partial_render else None
+        # The outputs rendered, by (format, canonical), with the
+        # generation they were rendered at.
+        self._rendered = {}
+
+    def _adopt(self, inventoryobject):
+        """ Makes inventoryobject belong to this inventory """
+        inventoryobject._inventory = self
+        if self._journal is not None:
+            self._journal._save_created(inventoryobject)
+        if isinstance(inventoryobject, Host):
+            self._track_groupless(inventoryobject)
+        self._mark_stale(inventoryobject)
+        self._generation += 1
+        self._structure += 1
+        return inventoryobject
+
+    def _disown(self, inventoryobject):
+        inventoryobject._record()
+        inventoryobject._inventory = None
+        self._groupless.pop(inventoryobject, None)
+        # Forget it right away, rather than keeping it until the
+        # next content_hash or render.
+        if self._stale is not None:
+            self._stale.pop(inventoryobject, None)
+        if self._unhashed is not None:
+            self._unhashed.pop(inventoryobject, None)
+        if self._pieces is not None:
+            for pieces in self._pieces:
+                pieces.pop(inventoryobject, None)
+        if inventoryobject._digest is not None:
+            self._digests = \
+                (self._digests - inventoryobject._digest) % _DIGEST_MODULUS
+            inventoryobject._digest = None
+        self._generation += 1
+        self._structure += 1
+
+    def _mark_stale(self, inventoryobject):
+        """ Marks the content hash and rendered json as outdated """
+        if self._stale is not None:
+            self._stale[inventoryobject] = None
+
+    def _track_groupless(self, host):
+        """ Updates _groupless, after the groups of host were replaced """
+        if host._groups or host._inventory is not self:
+            self._groupless.pop(host, None)
+        else:
+            self._groupless[host] = None
+
+    def _record_key(self, mapping, key):
+        """
+        Saves the value of key in mapping (groups, hosts or
+        host_ranges) into the journal entry being recorded, if any,
+        before it's modified.
+        """
+        if self._journal is not None:
+            self._journal._save_key(mapping, key)
+
+    def start_journal(self, journal=None):
+        """
+        Records the changes made to this inventory from now on into
+        journal, or into a new InventoryJournal, and returns it.
+        """
+        if self._journal is not None:
+            raise Exception("The inventory is already journaled")
+        if journal is None:
+            journal = InventoryJournal()
+        if journal.inventory is not None:
+            raise Exception("The journal already records an inventory")
+        journal.inventory = self
+        self._journal = journal
+        return journal
+
+    def batch(self):
+        """
+        Returns a context manager queuing the edges added and the
+        vars merged in the inventory, to apply them in bulk when it
+        exits, see InventoryBatch:
+
+            with inventory.batch():
+                inventory.load_inventoryjson(content)
+        """
+        return InventoryBatch(self)
+
+    def stop_journal(self):
+        """ Stops recording the changes, and returns the journal """
+        journal, self._journal = self._journal, None
+        if journal is not None:
+            journal.inventory = None
+        return journal
+
+    def _compact_name(self, name):
+        return _intern(name) if self.compact else name
+
+    def _compact_vars(self, variables):
+        return _intern_keys(variables) if self.compact and variables \
+            else variables
+
+    @_additive
+    def add_special_groups(self):
+        self.add_group('ungrouped')
+        self.add_group('all')
+        self.groups['all'].add_child(self.groups['ungrouped'])
+
+    @_additive
+    def load_inventoryjson(self, jsoncontent):
+        # _meta is the only information outside group data
+        hosts_metadata = jsoncontent.get('_meta', {})
+        for hostname, hostvars in hosts_metadata.get('hostvars', {}).items():
+            self.create_host(hostname, hostvars)
+
+        # Groups are created after hosts, so that
+        # group/host membership can be updated.
+        # group data is structured in json file as
+        # groupname: {"children":[], "hosts": [], "vars": {}}
+        for groupname, groupinfo in jsoncontent.items():
+            if groupname == '_meta':
+                continue
+            # Discover groups and their structure
+            self.add_group(groupname, groupinfo)
+
+    def load_inventory_stream(self, fp, chunk_size=65536):
+        """
+        Loads an inventory json from the file object fp.
+        Unlike load_inventoryjson, the document is never fully decoded
+        in memory: hosts and groups are created as they are read.
+        As _meta can come after the groups, hosts referenced by
+        a group are created on the fly, and their hostvars are
+        merged in when _meta is reached.
+        """
+        self._load_reader(JSONStreamReader(fp, chunk_size))
+
+    def load_inventory_mmap(self, path):
+        """
+        Loads the inventory json file at path, memory-mapped.
+        The groups are loaded as with load_inventory_stream, but the
+        vars of each host are kept as a range of bytes of the file,
+        only decoded when read. Writing the inventory with
+        write_output_stream copies the vars never read without
+        decoding them.
+        The file must not be modified while the inventory is used.
+        It can't be journaled: load the file before starting the journal.
+        """
+        self._check_unjournaled()
+        with open(path, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._load_reader(JSONBufferReader(buf), lazy_hostvars=True)
+
+    def _check_unjournaled(self):
+        if self._journal is not None:
+            raise Exception("This can't be done while the inventory "
+                            "is journaled or batched")
+
+    def _load_reader(self, reader, lazy_hostvars=False):
+        """
+        Loads an inventory json from a JSONStreamReader or a
+        JSONBufferReader. With lazy_hostvars, the hostvars
+        are _LazyVars of the buffer of the reader.
+        """
+        for key in reader.iter_items():
+            if key == '_meta':
+                for metakey in reader.iter_items():
+                    if metakey != 'hostvars':
+                        reader.read_value()
+                        continue
+                    for hostname in reader.iter_items():
+                        if lazy_hostvars:
+                            start, end = reader.skip_value()
+                            self._add_lazy_host(
+                                hostname, _LazyVars(reader.buf, start, end))
+                        else:
+                            self.add_host(hostname, reader.read_value())
+            else:
+                groupinfo = reader.read_value()
+                if isinstance(groupinfo, dict):
+                    for hostname in groupinfo.get('hosts', []):
+                        if not self.has_host(hostname):
+                            self.create_host(hostname)
+                self.add_group(key, groupinfo)
+
+    def _add_lazy_host(self, hostname, hostvars):
+        """
+        Like add_host, but keeps the _LazyVars hostvars undecoded when
+        the host has no vars yet, which is the case when loading.
+        """
+        if hostname not in self.hosts and not self.has_host(hostname):
+            self.create_host(hostname)
+            host = self.hosts.get(hostname, self.host_ranges.get(hostname))
+            # Nothing to invalidate yet
+            host._vars = hostvars
+            return
+        host = self.hosts.get(hostname, self.host_ranges.get(hostname))
+        if host is not None and not host._vars:
+            host.priority = 0
+            host.vars = hostvars
+        else:
+            self.add_host(hostname, hostvars)
+
+    def load_inventoryfiles(self, paths, priorities=None, processes=None):
+        """
+        Loads and merges the inventory json files at paths.
+        The files are parsed in parallel, in a pool of processes
+        (by default, one per CPU), each returning its partial graph.
+        The partial graphs are then merged in order into this inventory,
+        their vars merged with the matching priorities. By default,
+        the priority of each source is its index in paths, so that
+        the later sources win.
+        """
+        paths = list(paths)
+        if priorities is None:
+            priorities = range(len(paths))
+        if processes == 1 or len(paths) <= 1:
+            partials = [_load_partial_inventory(path) for path in paths]
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                partials = pool.map(_load_partial_inventory, paths)
+            finally:
+                pool.close()
+                pool.join()
+        self._merge_partials(partials, priorities)
+
+    def _export_partial(self):
+        """
+        Returns the inventory as a partial graph: (hosts, groups),
+        where hosts is a list of (hostname, hostvars), and groups
+        a list of (groupname, priority, groupvars, children, hosts),
+        referencing children and hosts by name.
+        """
+        hosts = [(hostname, hostdata._vars) for hostname, hostdata in
+                 itertools.chain(self.hosts.items(), self.host_ranges.items())]
+        groups = [(groupname, groupdata.priority, groupdata._vars,
+                   [child.name for child in groupdata.children],
+                   [host.name for host in groupdata.hosts])
+                  for groupname, groupdata in self.groups.items()]
+        return hosts, groups
+
+    def _merge_partials(self, partials, priorities):
+        """
+        Merges partial graphs (see _export_partial) in a linear pass.
+        The vars of every host and group are merged in one go,
+        across all the sources, with the priority of each source.
+        """
+        hostvars_layers = _ordereddict()
+        groupvars_layers = _ordereddict()
+        for (hosts, groups), priority in zip(partials, priorities):
+            for hostname, hostvars in hosts:
+                if not self.has_host(hostname):
+                    self.create_host(hostname)
+                hostvars_layers.setdefault(hostname, []).append(
+                    (self._compact_vars(hostvars), priority))
+            for groupname, grouppriority, groupvars, _, _ in groups:
+                if groupname not in self.groups:
+                    self.add_group(groupname, {'priority': grouppriority})
+                groupvars_layers.setdefault(groupname, []).append(
+                    (self._compact_vars(groupvars), priority))
+            for groupname, _, _, children, hostnames in groups:
+                group = self.groups[groupname]
+                for child in children:
+                    group.add_child(self.groups[child])
+                for hostname in hostnames:
+                    group.add_host(self._host_entry(hostname))
+        for hostname, layers in hostvars_layers.items():
+            self._host_entry(hostname).set_layered_vars(layers)
+        for groupname, layers in groupvars_layers.items():
+            self.groups[groupname].set_layered_vars(layers)
+
+    def save_snapshot(self, path):
+        """
+        Saves the inventory into the binary snapshot file path.
+        Its sections are, in order:
+          - the string table of the names
+          - the names (as string ids) and priorities of the groups,
+            in topological order
+          - the children, the parents and the hosts of the groups,
+            as compressed sparse rows of ids (see _csr)
+          - the names, priorities and kinds (0 for a Host, 1 for a
+            HostRange) of the hosts, then their groups
+          - the names excluded from each host range
+          - the vars of the groups, then of the hosts, as json blobs.
+        """
+        groups = sorted(self.groups.values(), key=lambda group: group._order)
+        hosts = list(itertools.chain(self.hosts.values(),
+                                     self.host_ranges.values()))
+        groupids = dict((group, groupid)
+                        for groupid, group in enumerate(groups))
+        hostids = dict((host, hostid) for hostid, host in enumerate(hosts))
+        strings, stringids = [], {}
+        for name in itertools.chain(
+                (group.name for group in groups),
+                (host.name for host in hosts),
+                *(host._members for host in hosts
+                  if isinstance(host, HostRange))):
+            if name not in stringids:
+                stringids[name] = len(strings)
+                strings.append(name)
+        with open(path, 'wb') as fp:
+            writer = SnapshotWriter(fp)
+            writer.write_strings(strings)
+            writer.write_array(stringids[group.name] for group in groups)
+            writer.write_array(group.priority for group in groups)
+            for members in (lambda group: group.children,
+                            lambda group: group.parents):
+                for values in _csr(groups, members, groupids):
+                    writer.write_array(values)
+            for values in _csr(groups, lambda group: group.hosts, hostids):
+                writer.write_array(values)
+            writer.write_array(stringids[host.name] for host in hosts)
+            writer.write_array(host.priority for host in hosts)
+            writer.write_array(int(isinstance(host, HostRange))
+                               for host in hosts)
+            for values in _csr(hosts, lambda host: host.groups, groupids):
+                writer.write_array(values)
+            for values in _csr(
+                    hosts, lambda host: getattr(host, '_members', ()),
+                    stringids):
+                writer.write_array(values)
+            for objects in (groups, hosts):
+                writer.write_blobs([_dump_vars(inventoryobject._vars)
+                                    for inventoryobject in objects])
+
+    def load_snapshot(self, path):
+        """
+        Loads the binary snapshot file path (see save_snapshot)
+        into this inventory, which must be empty.
+        The objects are built directly from the id arrays, without
+        validating or merging anything again, and their vars are
+        _LazyVars of the memory-mapped snapshot.
+        It can't be journaled: load the snapshot before starting the
+        journal.
+        """
+        self._check_unjournaled()
+        if self.groups or self.hosts or self.host_ranges:
+            raise Exception("Snapshots can only be loaded "
+                            "into an empty inventory")
+        with open(path, 'rb') as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        reader = SnapshotReader(buf)
+        strings = [self._compact_name(string)
+                   for string in reader.read_strings()]
+        groups = []
+        # Created in topological order, so their _order is right.
+        for nameid, priority in zip(reader.read_array(), reader.read_array()):
+            group = self._adopt(Group(name=strings[nameid]))
+            group._priority = priority
+            self.groups[group.name] = group
+            groups.append(group)
+        children = reader.read_array(), reader.read_array()
+        parents = reader.read_array(), reader.read_array()
+        grouphosts = reader.read_array(), reader.read_array()
+        hosts = []
+        for nameid, priority, kind in zip(reader.read_array(),
+                                          reader.read_array(),
+                                          reader.read_array()):
+            if kind:
+                host = self._adopt(HostRange(name=strings[nameid]))
+                self.host_ranges[host.name] = host
+            else:
+                host = Host._restore(strings[nameid], priority, self)
+                self.hosts[host.name] = host
+            host._priority = priority
+            hosts.append(host)
+        hostgroups = reader.read_array(), reader.read_array()
+        excluded = reader.read_array(), reader.read_array()
+        for groupid, group in enumerate(groups):
+            group.children = NamedOrderedSet(
+                groups[childid] for childid in _csr_row(children, groupid))
+            group.parents = NamedOrderedSet(
+                groups[parentid] for parentid in _csr_row(parents, groupid))
+            group.hosts = NamedOrderedSet(
+                hosts[hostid] for hostid in _csr_row(grouphosts, groupid))
+            group.host_ranges = OrderedSet(
+                host for host in group.hosts if isinstance(host, HostRange))
+        for hostid, host in enumerate(hosts):
+            row = _csr_row(hostgroups, hostid)
+            if len(row):
+                host._groups = NamedOrderedSet(groups[groupid]
+                                               for groupid in row)
+            for nameid in _csr_row(excluded, hostid):
+                host._members[strings[nameid]] = \
+                    self.hosts.get(strings[nameid])
+        for objects in (groups, hosts):
+            for inventoryobject, (start, end) in zip(objects,
+                                                     reader.read_blobs()):
+                if start != end:
+                    inventoryobject._vars = _LazyVars(buf, start, end)
+        self._groupless = _ordereddict.fromkeys(
+            host for host in hosts if not host._groups)
+        if self._stale is not None:
+            self._stale.update(_ordereddict.fromkeys(hosts))
+        self._generation += 1
+        self._structure += 1
+
+    # refactor add group
+    # to be split into add, create, and update
+    @_additive
+    def add_group(self, groupname, groupinfo=None, allow_update=True):
+        """ This adds a group with groupname.
+        By default it allows updating a new group groupname with
+        groupinfo. If allow_update=False, only new groups are allowed.
+        THe difference is useful for inventory serialization:
+        We can recursively add_groups on parents/children, but
+        care about their variables later.
+        """
+        is_new_group = False
+        if groupname not in self.groups.keys():
+            is_new_group = True
+        if is_new_group or allow_update:
+            self._process_groupadd(groupname, groupinfo, is_new_group)
         elif groupinfo:
             # The group exists AND the updates are not allowed
             raise ValueError
@@ -311,10 +3010,13 @@ class Inventory(object):
                 priority = 0
 
         if is_new_group:
-            self.groups[groupname] = Group(name=groupname)
+            groupname = self._compact_name(groupname)
+            group = Group(name=groupname)
             # Don't update priority when updating an existing group, unless
             # explicity told so in a separate function
-            self.set_group_priority(groupname, priority)
+            group.priority = priority
+            self._record_key(self.groups, groupname)
+            self.groups[groupname] = self._adopt(group)
 
         if groupinfo:
             for subgroup in itertools.chain(
@@ -323,26 +3025,50 @@ class Inventory(object):
                 self.add_group(subgroup)
 
             # Now proceed with hierarchy, merging the new (if any) to the existing.
+            group = self.groups[groupname]
             for child in groupinfo.get('children', []):
-                self.groups[groupname].add_child(self.groups[child])
+                group.add_child(self.groups[child])
             for parent in groupinfo.get('parents', []):
-                self.groups[groupname].add_parent(self.groups[parent])
-            for new_vars in \
-                    groupinfo.get('vars', {}), groupinfo.get('group_vars', {}):
-                self.groups[groupname].set_vars(new_vars, priority)
+                group.add_parent(self.groups[parent])
+            group.set_layered_vars((
+                (self._compact_vars(groupinfo.get('vars', {})), priority),
+                (self._compact_vars(groupinfo.get('group_vars', {})),
+                 priority)))
             for host in groupinfo.get('hosts',[]):
-                self.hosts[host].add_group(self.groups[groupname])
+                self._host_entry(host).add_group(group)
 
+    @_journaled
     def del_group(self, groupname, **kwargs):
         if groupname in self.groups:
+            self._record_key(self.groups, groupname)
             grouptodelete = self.groups.pop(groupname)
             grouptodelete.delete(**kwargs)
+            self._disown(grouptodelete)
+
+    @_journaled
+    def del_groups(self, groupnames, **kwargs):
+        """
+        Deletes the groups of the list groupnames, like del_group.
+        The groups are deleted parents first: with reparent_groups,
+        the members of a deleted group are moved once, directly to
+        the closest groups which are kept.
+        """
+        groups = [self.groups[groupname] for groupname in set(groupnames)
+                  if groupname in self.groups]
+        groups.sort(key=lambda group: group._order)
+        for group in groups:
+            self.del_group(group.name, **kwargs)
 
+    @_journaled
     def rename_group(self, groupname, newgroupname):
         if groupname in self.groups and newgroupname not in self.groups:
+            newgroupname = self._compact_name(newgroupname)
+            self._record_key(self.groups, newgroupname)
+            self._record_key(self.groups, groupname)
             self.groups[newgroupname] = self.groups.pop(groupname)
             self.groups[newgroupname].name = newgroupname
 
+    @_journaled
     def convert_group(self, groupname, newgroupname):
         """
         Convert is not a delete with reparent.
@@ -361,6 +3087,7 @@ class Inventory(object):
         self.del_group(groupname)
         self.add_group(newgroupname, groupinfo=groupinfo)
 
+    @_journaled
     def set_group_priority(self, groupname, priority):
         """ Allows the user to set a priority to a group, for variable
         merging purposes
@@ -368,49 +3095,184 @@ class Inventory(object):
         if groupname in self.groups:
             self.groups[groupname].priority = priority
 
+    @_additive
     def add_host(self, hostname, hostvars=None, prio=0):
-        if hostname in self.hosts:
+        if self.has_host(hostname):
             self.update_host(hostname, hostvars, prio)
         else:
             self.create_host(hostname, hostvars)
 
+    @_additive
     def create_host(self, hostname, hostvars=None):
-        if hostname in self.hosts:
+        """
+        Creates the host hostname, or, if hostname is a range like
+        web[01:50].example.com, a HostRange declaring all its hosts.
+        """
+        if self.has_host(hostname):
             raise Exception("Host already exists")
+        hostname = self._compact_name(hostname)
+        if not is_valid_host(hostname) and is_valid_host_range(hostname):
+            self._create_host_range(hostname)
         else:
-            self.hosts[hostname] = Host(name=hostname)
+            self._record_key(self.hosts, hostname)
+            self.hosts[hostname] = self._adopt(Host(name=hostname))
+            hostrange = self.find_host_range(hostname, excluded=True)
+            if hostrange is not None:
+                hostrange._claim(self.hosts[hostname])
         if hostvars:
-            self.hosts[hostname].set_vars(hostvars, 0)
+            self._host_entry(hostname).set_vars(
+                self._compact_vars(hostvars), 0)
+
+    def _create_host_range(self, rangename):
+        hostrange = HostRange(name=rangename)
+        for other in self.host_ranges.values():
+            if hostrange.overlaps(other):
+                raise Exception("Host range %s overlaps %s"
+                                % (rangename, other.name))
+        self._record_key(self.host_ranges, rangename)
+        self.host_ranges[rangename] = self._adopt(hostrange)
+        # The hosts already defined are materialized members.
+        for hostname, hostdata in self.hosts.items():
+            if hostname in hostrange:
+                hostrange._claim(hostdata)
+        return hostrange
 
     # Refactor this to have hostvars and prio optional, to
     # not always override prio
+    @_journaled
     def update_host(self, hostname, hostvars=None, prio=0):
-        """ Update host variables, and priority of a host"""
-        try:
-            self.hosts[hostname].priority = prio
-        except KeyError as exc:
-            raise Exception("Host %s does not exist. Traceback: %s" % (hostname,exc))
+        """
+        Update host variables, and priority of a host.
+        A member of a HostRange is materialized into a Host, unless
+        nothing changes for it.
+        """
+        host = self.hosts.get(hostname, self.host_ranges.get(hostname))
+        if host is None:
+            hostrange = self.find_host_range(hostname)
+            if hostrange is None:
+                raise Exception("Host %s does not exist" % hostname)
+            if not hostvars and prio == hostrange.priority:
+                return
+            host = self._materialize_host(hostrange, hostname)
+        host.priority = prio
         if hostvars:
-            self.hosts[hostname].set_vars(hostvars, prio)
+            host.set_vars(self._compact_vars(hostvars), prio)
 
+    @_journaled
     def del_host(self, hostname):
-        try:
+        """
+        Deletes the host hostname, or the HostRange hostname
+        (but not its materialized hosts).
+        A member of a HostRange is just excluded from the range.
+        """
+        if hostname in self.hosts:
             # No need to pass kwargs, removing host doesn't need
             # reparenting or anything.
             self.hosts[hostname].delete()
-            del self.hosts[hostname]
-        except KeyError:
-            pass
+            self._record_key(self.hosts, hostname)
+            self._disown(self.hosts.pop(hostname))
+            hostrange = self.find_host_range(hostname, excluded=True)
+            if hostrange is not None:
+                hostrange._exclude(hostname)
+        elif hostname in self.host_ranges:
+            self.host_ranges[hostname].delete()
+            self._record_key(self.host_ranges, hostname)
+            self._disown(self.host_ranges.pop(hostname))
+        else:
+            hostrange = self.find_host_range(hostname)
+            if hostrange is not None:
+                hostrange._exclude(hostname)
 
+    @_journaled
     def rename_host(self, hostname, newhostname):
-        if newhostname not in self.hosts:
-            self.hosts[newhostname] = self.hosts.pop(hostname)
-            self.hosts[newhostname].name = newhostname
-        else:
+        if self.has_host(newhostname):
             raise Exception("Host %s already exists" % (newhostname))
+        host = self.get_host(hostname)
+        hostrange = self.find_host_range(hostname, excluded=True)
+        if hostrange is not None:
+            hostrange._exclude(hostname)
+        newhostname = self._compact_name(newhostname)
+        self._record_key(self.hosts, newhostname)
+        self._record_key(self.hosts, hostname)
+        self.hosts[newhostname] = self.hosts.pop(hostname)
+        host.name = newhostname
+
+    def has_host(self, hostname):
+        """
+        Returns True if hostname is a host, a HostRange,
+        or a member of a HostRange.
+        """
+        return (hostname in self.hosts or hostname in self.host_ranges or
+                self.find_host_range(hostname) is not None)
+
+    def get_host(self, hostname):
+        """
+        Returns the Host hostname. A member of a HostRange is
+        materialized into a Host.
+        """
+        if hostname in self.hosts:
+            return self.hosts[hostname]
+        hostrange = self.find_host_range(hostname)
+        if hostrange is None:
+            raise KeyError(hostname)
+        return self._materialize_host(hostrange, hostname)
+
+    def find_host_range(self, hostname, excluded=False):
+        """
+        Returns the HostRange having hostname as member, or None.
+        With excluded, finds the range hostname was excluded from.
+        """
+        for hostrange in self.host_ranges.values():
+            if hostname in hostrange or (
+                    excluded and hostname in hostrange._members):
+                return hostrange
+        return None
+
+    def _materialize_host(self, hostrange, hostname):
+        """
+        Creates a Host for the member hostname of hostrange,
+        with the vars and the priority of the range, in its groups.
+        """
+        host = self._adopt(Host(name=self._compact_name(hostname)))
+        host.priority = hostrange.priority
+        if hostrange._vars:
+            host.set_vars(hostrange._vars, hostrange.priority)
+        self._record_key(self.hosts, host.name)
+        self.hosts[host.name] = host
+        hostrange._claim(host)
+        return host
+
+    def _host_entry(self, hostname):
+        """
+        Returns the Host or the HostRange named hostname.
+        A HostRange is declared if needed, and a member of a
+        HostRange is materialized into a Host (see get_host).
+        """
+        if hostname in self.hosts:
+            return self.hosts[hostname]
+        if hostname in self.host_ranges:
+            return self.host_ranges[hostname]
+        if not is_valid_host(hostname) and is_valid_host_range(hostname):
+            return self._create_host_range(self._compact_name(hostname))
+        hostrange = self.find_host_range(hostname)
+        if hostrange is None:
+            raise KeyError(hostname)
+        return self._materialize_host(hostrange, hostname)
+
+    def _iter_hosts(self):
+        """
+        Yields (hostname, hostdata) for each host, hostdata being
+        the Host, or the HostRange of the members of the ranges.
+        """
+        for item in self.hosts.items():
+            yield item
+        for hostrange in self.host_ranges.values():
+            for hostname in hostrange:
+                yield hostname, hostrange
 
     def count_hosts(self):
-        return len(self.hosts)
+        return len(self.hosts) + sum(
+            len(hostrange) for hostrange in self.host_ranges.values())
 
     def count_groups(self):
         """ Counts the amount of user defined groups.
@@ -418,41 +3280,518 @@ class Inventory(object):
         """
         return len(self.groups)-2
 
-    def write_output_json(self):
-        # Ensure special groups are present
-        self.add_special_groups()
+    def get_graph(self):
+        """
+        Returns the InventoryGraph of the inventory.
+        It's cached until the groups, the hosts, their names or their
+        relationships are modified (but not their vars).
+        """
+        if self._graph is None or self._graph.structure != self._structure:
+            self._graph = InventoryGraph(self)
+        return self._graph
+
+    def diff(self, other):
+        """
+        Returns the InventoryDiff from this inventory to other.
+        """
+        return InventoryDiff(self, other)
+
+    def get_group_hosts(self, groupname):
+        """
+        Returns the names of all the hosts of the group groupname,
+        including the hosts of its children, recursively.
+        """
+        graph = self.get_graph()
+        return [graph.host_names[hostid] for hostid in
+                graph.descendant_hosts(graph.group_ids[groupname])]
+
+    def select(self, pattern):
+        """
+        Returns the hosts matching the ansible host pattern, in a
+        stable order (the order of the inventory hosts).
+        The pattern terms can be group or host names, globs (web*),
+        regexes (~web\\d+), with subscripts (web[0], web[1:3]), and are
+        combined with ':' (union), ':&' (intersection), ':!' (exclusion).
+        See InventoryGraph.pattern_bitset.
+        The members of HostRanges are returned as HostRangeMembers,
+        only materialized into Hosts when modified: selecting doesn't
+        modify the inventory.
+        """
+        graph = self.get_graph()
+        hosts = []
+        for hostid in _ids_from_bitset(graph.pattern_bitset(pattern)):
+            host = graph.hosts[hostid]
+            if isinstance(host, HostRange):
+                host = HostRangeMember(self, host, graph.host_names[hostid])
+            hosts.append(host)
+        return hosts
+
+    def get_pattern_hosts(self, pattern):
+        """
+        Returns the names of the hosts matching the ansible host
+        pattern (see select).
+        """
+        graph = self.get_graph()
+        return graph.hostnames(graph.pattern_bitset(pattern))
+
+    def has_cycle(self):
+        """
+        Returns True if the group hierarchy has a cycle.
+        Group.add_child and Group.add_parent refuse cycles, so this
+        only checks the groups are still in topological order,
+        unless the hierarchy was modified by other means.
+        """
+        if all(group._order < child._order
+               for group in self.groups.values()
+               for child in group.children):
+            return False
+        # Kahn's algorithm: a cycle remains if some groups
+        # never lose all their parents.
+        groups = set(self.groups.values())
+        parents_count = dict(
+            (group, sum(1 for parent in group.parents if parent in groups))
+            for group in groups)
+        stack = [group for group, count in parents_count.items()
+                 if count == 0]
+        visited = 0
+        while stack:
+            group = stack.pop()
+            visited += 1
+            for child in group.children:
+                if child not in groups:
+                    continue
+                parents_count[child] -= 1
+                if parents_count[child] == 0:
+                    stack.append(child)
+        return visited != len(parents_count)
+
+    def resolve_host_vars(self, hostname):
+        """
+        Returns the effective variables of the host hostname,
+        flattening 'all', then the host groups and their ancestors,
+        then the host vars.
+        """
+        self._check_root()
+        host = self.hosts.get(hostname) or self.find_host_range(hostname)
+        if host is None:
+            raise KeyError(hostname)
+        return dict(self._resolve_host(host))
+
+    def resolve_all_hostvars(self):
+        """
+        Returns the effective variables of every host, as a dict
+        keyed by hostname. Each group is resolved only once, and
+        reused for all the hosts below it.
+        """
+        self._check_root()
+        combined = {}
+        return dict((hostname, dict(self._resolve_host(hostdata, combined)))
+                    for hostname, hostdata in self._iter_hosts())
+
+    def _check_root(self):
+        """
+        Groups without parents and hosts without groups inherit
+        from 'all' without being its children, and hosts without
+        groups from 'ungrouped' without being its members (see
+        _host_groups), so their resolved vars can't be invalidated
+        through those. Invalidate them here, when 'all' or
+        'ungrouped' changed since their resolution.
+        """
+        states = []
+        for groupname in (u'all', u'ungrouped'):
+            group = self.groups.get(groupname)
+            resolved = None
+            if group is not None:
+                resolved = self._resolve_group(group)
+            previous = self._root_state[len(states):len(states) + 2]
+            if group is not previous[0] or resolved is not previous[1]:
+                if groupname == u'all':
+                    for parentless in self.groups.values():
+                        if not parentless.parents and parentless is not group:
+                            parentless._invalidate()
+                for host in self._groupless:
+                    host._invalidate()
+            states.extend((group, resolved))
+        self._root_state = tuple(states)
+
+    def _host_groups(self, host):
+        """
+        Returns the groups of host, as rendered: a host is member of
+        'ungrouped', if defined, when it isn't member of other groups,
+        and only then.
+        """
+        groups = host.groups
+        ungrouped = self.groups.get(u'ungrouped')
+        if ungrouped is None:
+            return groups
+        if not groups:
+            return [ungrouped]
+        if len(groups) > 1 and ungrouped in groups:
+            return [group for group in groups if group is not ungrouped]
+        return groups
+
+    def _resolve_host(self, host, combined=None):
+        """
+        Merges the vars of the host groups, with the vars they
+        inherit, in order, then the host vars: the highest priority
+        wins, and the last one in case of ties. With a single group,
+        the host vars are merged over the resolved group in one pass.
+        The merges of several groups are kept in combined, by groups,
+        when given. The result is cached on the host until invalidated.
+        """
+        if host._resolved is not None:
+            return host._resolved
+        groups = self._host_groups(host)
+        if not groups and u'all' in self.groups:
+            groups = [self.groups[u'all']]
+        if len(groups) == 1:
+            merged, prios = self._resolve_group(groups[0])[1:]
+        else:
+            key = tuple(groups)
+            if combined is not None and key in combined:
+                merged, prios = combined[key]
+            else:
+                for group in groups:
+                    self._resolve_group(group)
+                merged, prios = _merge_layers(
+                    _inherit_layers(_ordereddict(), groups).values())
+                if combined is not None:
+                    combined[key] = (merged, prios)
+        if host._vars:
+            merged = merged.copy()
+            _layer_vars(merged, prios, host._vars, host.priority, {})
+        host._resolved = merged
+        return merged
+
+    def _resolve_group(self, group):
+        """
+        Returns the (layers, vars, prios) of a group: the ordered dict
+        of the (vars, priority) of the group and of its ancestors, by
+        object, and their merge (see _layer_vars). The parents are
+        inherited in order, and groups without parents inherit from
+        'all'. The prio of each var is kept along with the merged
+        vars, so that a group with a single parent, or a host with a
+        single group, only merges its own vars over them. The result
+        is cached on the group until invalidated.
+        Walks the ancestors iteratively, so that deep hierarchies
+        don't hit the recursion limit.
+        """
+        root = self.groups.get(u'all')
+        # The ancestors of 'all', if it was given parents, don't
+        # inherit from it, or the hierarchy would have a cycle.
+        above_root = set()
+        if root is not None:
+            pending = list(root.parents)
+            while pending:
+                ancestor = pending.pop()
+                if ancestor not in above_root:
+                    above_root.add(ancestor)
+                    pending.extend(ancestor.parents)
+        stack = [group]
+        while stack:
+            current = stack[-1]
+            if current._resolved is not None:
+                stack.pop()
+                continue
+            bases = list(current.parents)
+            if not bases and root is not None and current is not root \
+                    and current not in above_root:
+                bases.append(root)
+            pending = [base for base in bases if base._resolved is None]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            layers = _inherit_layers(_ordereddict(), bases)
+            if len(bases) == 1:
+                merged, prios = bases[0]._resolved[1:]
+            else:
+                merged, prios = _merge_layers(layers.values())
+            if current._vars:
+                layers[current] = (current._vars, current.priority)
+                merged, prios = merged.copy(), prios.copy()
+                _layer_vars(merged, prios, current._vars, current.priority)
+            current._resolved = (layers, merged, prios)
+        return group._resolved
+
+    def content_hash(self):
+        """
+        Returns the sha256 (hex) of the content of the inventory,
+        combining the content hashes of its groups and hosts (see
+        InventoryObject.content_hash), regardless of their order:
+        inventories rendered the same have the same hash, including
+        the special groups rendered without being defined, and the
+        host ranges, hashed as their members. Only the objects
+        changed since the last call are hashed again, including the
+        objects whose vars dict was modified in place (see
+        InventoryObject.vars).
+        """
+        self._refresh_digests()
+        digests = self._digests
+        for groupname, children in ((u'all', [u'ungrouped']),
+                                    (u'ungrouped', [])):
+            if groupname not in self.groups:
+                digests += _digest([u'Group', groupname, {}, children, []])
+        return '%064x' % (digests % _DIGEST_MODULUS)
+
+    def _drain_stale(self):
+        """
+        Hands the objects marked stale over to the caches depending
+        on them: the content hashes, and the rendered json.
+        """
+        if not self._stale:
+            return
+        stale, self._stale = self._stale, _ordereddict()
+        if self._unhashed is not None:
+            self._unhashed.update(stale)
+        if self._pieces is not None:
+            for pieces in self._pieces:
+                for inventoryobject in stale:
+                    pieces.pop(inventoryobject, None)
+
+    def _refresh_digests(self):
+        """ Hashes the stale objects again, and updates their sum """
+        if self._unhashed is None:
+            # First call: start tracking, and hash everything.
+            if self._stale is None:
+                self._stale = _ordereddict()
+            self._unhashed = _ordereddict.fromkeys(itertools.chain(
+                self.groups.values(), self.hosts.values(),
+                self.host_ranges.values()))
+        self._drain_stale()
+        stale, self._unhashed = self._unhashed, _ordereddict()
+        digests = self._digests
+        for inventoryobject in stale:
+            if inventoryobject._digest is not None:
+                digests -= inventoryobject._digest
+                inventoryobject._digest = None
+            if inventoryobject._inventory is self:
+                inventoryobject._digest = inventoryobject._content_digest()
+                digests += inventoryobject._digest
+        self._digests = digests % _DIGEST_MODULUS
+
+    def _cached_render(self, key, render):
+        """
+        Returns the output key, rendered by calling render,
+        and cached until the inventory is modified.
+        """
+        cached = self._rendered.get(key)
+        if cached is not None and cached[0] == self._generation:
+            return cached[1]
+        output = render()
+        self._rendered[key] = (self._generation, output)
+        return output
+
+    def write_output_json(self, canonical=False):
+        """
+        Returns the inventory as a dictionary, ready
+        to be dumped as an ansible json inventory.
+        In canonical mode, the hosts, the groups and their members
+        are sorted by name: equal inventories give the same json
+        when dumped with sort_keys.
+        The output is cached until the inventory is modified
+        (including through the vars dicts, see InventoryObject.vars):
+        the dictionary returned is a copy, but the values in it are
+        shared (as the vars are with the inventory).
+        """
+        return dict(self._cached_render((u'json', canonical),
+                                        lambda: self._render_json(canonical)))
 
-        # Prepare output dictionary
+    def _render_json(self, canonical):
+        hosts = self._iter_hosts()
+        groups = self._iter_output_groups(canonical)
+        if canonical:
+            hosts = sorted(hosts, key=_first)
+            groups = sorted(groups, key=_first)
         output = dict()
-        output[u'_meta'] = {u'hostvars': {}}
-        for hostname, hostdata in self.hosts.items():
-            # hostdata is the host object, containing variables as
-            # a dictionary ready to use
-            output[u'_meta'][u'hostvars'][hostname] = hostdata.vars
-            # In case of a valid but not standard inventory
-            # you might have no "ungrouped" group.
-            # So loading that would result in hosts not
-            # part of this group, but not part of any other
-            # group.
-            # For these hosts, make sure they are in ungrouped
-            if len(hostdata.groups) == 0:
-                hostdata.add_group(self.groups[u'ungrouped'])
-            # But also make sure ungrouped is not still present
-            # if additional groups were added
+        output[u'_meta'] = {u'hostvars': dict(
+            (hostname, hostdata._vars or {})
+            for hostname, hostdata in hosts)}
+        output.update(groups)
+        return output
+
+    def write_output_bytes(self, canonical=False):
+        """
+        Returns the inventory as a utf-8 json document, like
+        write_output_stream. It's cached until the inventory is
+        modified, and in partial_render mode, only the hosts and
+        groups changed since the last render are rendered again.
+        """
+        return self._cached_render(
+            (u'bytes', canonical),
+            lambda: u''.join(self._iter_output_json(canonical)).encode(
+                'utf-8'))
+
+    def write_output_stream(self, fp, chunk_size=1000, canonical=False):
+        """
+        Writes the inventory as json into the text file object fp.
+        The output is written in chunks of chunk_size items, as it
+        is rendered, without building the whole document in memory.
+        In canonical mode, everything is sorted, including the keys
+        of the vars: equal inventories give the same bytes.
+        """
+        pieces = []
+        for piece in self._iter_output_json(canonical):
+            pieces.append(piece)
+            if len(pieces) >= chunk_size:
+                fp.write(u''.join(pieces))
+                pieces = []
+        fp.write(u''.join(pieces))
+
+    def _iter_output_json(self, canonical=False):
+        """ Yields the pieces of the json document """
+        encode = json.JSONEncoder(sort_keys=canonical).encode
+        cache = None
+        if self._pieces is not None:
+            self._drain_stale()
+            cache = self._pieces[canonical]
+        hosts = self._iter_host_pieces(encode, canonical, cache)
+        groups = self._iter_group_pieces(encode, canonical, cache)
+        if canonical:
+            hosts = sorted(hosts, key=_first)
+            groups = sorted(groups, key=_first)
+        yield u'{"_meta": {"hostvars": {'
+        separator = u''
+        for _, piece in hosts:
+            yield separator + piece
+            separator = u', '
+        yield u'}}'
+        for _, piece in groups:
+            yield u', ' + piece
+        yield u'}'
+
+    def _iter_host_pieces(self, encode, canonical, cache=None):
+        """
+        Yields (hostname, json) for each host, taken from cache
+        when rendered already, see partial_render.
+        """
+        for hostdata in itertools.chain(self.hosts.values(),
+                                        self.host_ranges.values()):
+            pieces = None if cache is None else cache.get(hostdata)
+            if pieces is None:
+                pieces = self._render_host(hostdata, encode, canonical)
+                if cache is not None:
+                    cache[hostdata] = pieces
+            for item in pieces:
+                yield item
+
+    @staticmethod
+    def _render_host(hostdata, encode, canonical):
+        """
+        Returns the (hostname, json) of hostdata, a Host, or
+        a HostRange, for each of its members.
+        """
+        hostvars = hostdata._vars
+        if isinstance(hostvars, _LazyVars) and not hostvars.loaded:
+            if canonical:
+                rendered = encode(_plain_vars(hostvars))
             else:
-                hostdata.del_group(self.groups[u'ungrouped'])
-        # Now output group mapping
+                rendered = hostvars.raw()
+        else:
+            rendered = encode(hostvars)
+        if isinstance(hostdata, HostRange):
+            return [(hostname, encode(hostname) + u': ' + rendered)
+                    for hostname in hostdata]
+        return [(hostdata.name, encode(hostdata.name) + u': ' + rendered)]
+
+    def _iter_group_pieces(self, encode, canonical, cache=None):
+        """
+        Yields (groupname, json) for each group, taken from cache
+        when rendered already, see partial_render. 'ungrouped'
+        depends on all the hosts, and is always rendered again.
+        """
+        for groupname, groupdata in self.groups.items():
+            piece = None if cache is None else cache.get(groupdata)
+            if piece is None:
+                piece = encode(groupname) + u': ' + encode(
+                    self._output_group(groupname, groupdata, canonical))
+                if cache is not None and groupname != u'ungrouped':
+                    cache[groupdata] = piece
+            yield groupname, piece
+        for groupname, groupdata in self._missing_output_groups(canonical):
+            yield groupname, encode(groupname) + u': ' + encode(groupdata)
+
+    def _iter_output_groups(self, canonical=False):
+        """
+        Yields (groupname, groupdata) as they should be written.
+        This doesn't modify the inventory: the special groups
+        'all' and 'ungrouped' are always rendered, even if missing,
+        'ungrouped' is always a child of 'all', and 'ungrouped'
+        contains exactly the hosts that aren't in any other group.
+        In canonical mode, the members of the groups are sorted.
+        """
+        for groupname, groupdata in self.groups.items():
+            yield groupname, self._output_group(groupname, groupdata,
+                                                canonical)
+        for item in self._missing_output_groups(canonical):
+            yield item
+
+    def _output_group(self, groupname, groupdata, canonical):
         # Keep as value only ['children','vars', 'hosts']
         # of each group
-        for groupname, groupdata in self.groups.items():
-            output.update({groupname: {}})
-            kids = [ child.name for child in groupdata.children]
-            if kids:
-                output[groupname].update({u'children': kids})
-            machines = [host.name for host in groupdata.hosts]
-            if machines:
-                output[groupname].update({u'hosts': machines})
-            if groupdata.vars:
-                output[groupname].update({u'vars': groupdata.vars})
-            print(output)
+        children = [child.name for child in groupdata.children]
+        hosts = None
+        if groupname == u'all' and u'ungrouped' not in children:
+            children.append(u'ungrouped')
+        elif groupname == u'ungrouped':
+            hosts = self._ungrouped_hostnames()
+        if canonical:
+            children.sort()
+            if hosts is None:
+                hosts = list(_member_names(groupdata.hosts))
+            hosts.sort()
+        return self._render_group(groupdata, children, hosts)
+
+    def _missing_output_groups(self, canonical):
+        """ Yields the special groups rendered, while not defined """
+        if u'all' not in self.groups:
+            yield u'all', {u'children': [u'ungrouped']}
+        if u'ungrouped' not in self.groups:
+            hosts = self._ungrouped_hostnames()
+            if canonical:
+                hosts.sort()
+            yield u'ungrouped', {u'hosts': hosts} if hosts else {}
+
+    @staticmethod
+    def _render_group(groupdata, children, hosts=None):
+        output = {}
+        if children:
+            output[u'children'] = children
+        if hosts is None:
+            hosts = list(_member_names(groupdata.hosts))
+        if hosts:
+            output[u'hosts'] = hosts
+        if groupdata._vars:
+            output[u'vars'] = groupdata._vars
         return output
+
+    def _ungrouped_hostnames(self):
+        """
+        In case of a valid but not standard inventory
+        you might have hosts without any group, or hosts still in
+        'ungrouped' while being member of other groups.
+        Returns the names of the hosts which should be rendered
+        as members of 'ungrouped'.
+        """
+        hostnames = []
+        ungrouped = self.groups.get(u'ungrouped')
+        if ungrouped is not None:
+            hostnames.extend(_member_names(host for host in ungrouped.hosts
+                                           if len(host.groups) == 1))
+        for host in self._groupless:
+            if isinstance(host, HostRange):
+                hostnames.extend(host)
+            else:
+                hostnames.append(host.name)
+        return hostnames
+
+
+def _load_partial_inventory(path):
+    """
+    Loads the inventory json at path, and returns its partial graph.
+    This is run in the worker processes of Inventory.load_inventoryfiles.
+    """
+    inventory = Inventory()
+    with open(path, 'r') as fp:
+        inventory.load_inventory_stream(fp)
+    return inventory._export_partial()
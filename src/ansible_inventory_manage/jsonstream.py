@@ -0,0 +1,235 @@
+"""
+Incremental JSON reading.
+
+An inventory json can be several hundred MB. The JSONStreamReader
+allows to walk the members of its objects one by one, decoding only
+the values the caller asks for, while reading the file object
+by chunks.
+The JSONBufferReader does the same on a bytes-like buffer, like
+a memory-mapped file, and can skip values without decoding them.
+"""
+import codecs
+import json
+import re
+
+WHITESPACE = ' \t\n\r'
+
+_STRING = br'"[^"\\]*(?:\\.[^"\\]*)*"'
+_SCALAR = br'[^",:{}\[\] \t\n\r]+'
+_WHITESPACE_RE = re.compile(br'[ \t\n\r]*')
+_STRING_RE = re.compile(_STRING, re.S)
+_TOKEN_RE = re.compile(br'["{}\[\]]')
+
+
+def _nested(depth):
+    """
+    Returns a regex matching the objects and arrays nested up to
+    depth levels: re can't match balanced brackets at any depth.
+    """
+    # The loops are unrolled (plain*(?:special plain*)*), so that
+    # there is a single way to match, and failing is linear.
+    plain = br'[^"{}\[\]]*'
+    content = plain + br'(?:' + _STRING + plain + br')*'
+    for _ in range(depth):
+        nested = br'(?:\{' + content + br'\}|\[' + content + br'\])'
+        content = (plain + br'(?:(?:' + _STRING + br'|' + nested + br')' +
+                   plain + br')*')
+    return nested
+
+
+# Most values are shallow, and are skipped with a single match.
+_VALUE_RE = re.compile(br'[ \t\n\r]*(' + _nested(4) + br'|' + _STRING +
+                       br'|' + _SCALAR + br')', re.S)
+_KEY_RE = re.compile(br'[ \t\n\r]*(' + _STRING + br')[ \t\n\r]*:', re.S)
+_NEXT_RE = re.compile(br'[ \t\n\r]*([,}])')
+
+
+class JSONStreamReader(object):
+    """
+    Walks a JSON document read from the file object fp.
+    fp can be opened in text or binary (utf-8) mode.
+    """
+
+    def __init__(self, fp, chunk_size=65536):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self._buffer = u''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    def _read(self, size=0):
+        """
+        Appends at least size (or chunk_size) characters to the buffer.
+        Returns False when the end of the file is reached.
+        """
+        if self._eof:
+            return False
+        chunk = self.fp.read(max(size, self.chunk_size))
+        if not isinstance(chunk, type(u'')):
+            chunk = self._utf8.decode(chunk, final=not chunk)
+        if not chunk:
+            self._eof = True
+            return False
+        # Drop what was already consumed, to keep memory bounded.
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next character,
+        or an empty string at the end of the document.
+        """
+        while True:
+            while self._pos < len(self._buffer):
+                char = self._buffer[self._pos]
+                if char not in WHITESPACE:
+                    return char
+                self._pos += 1
+            if not self._read():
+                return u''
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at offset %s, got %r" %
+                             (chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def read_value(self):
+        """ Decodes and returns the next JSON value """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+            else:
+                # A number at the end of the buffer might not be complete.
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            # Read at least as much as what's pending, so that
+            # decoding a large value stays linear.
+            self._read(len(self._buffer) - self._pos)
+
+    def iter_items(self):
+        """
+        Iterates over the keys of the next JSON object.
+        For each key yielded, the caller must consume its value
+        with read_value() or iter_items() before asking the next key.
+        """
+        self._expect(u'{')
+        if self._peek() == u'}':
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, type(u'')):
+                raise ValueError("Object keys must be strings")
+            self._expect(u':')
+            yield key
+            if self._expect(u',}') == u'}':
+                return
+
+
+class JSONBufferReader(object):
+    """
+    Walks a JSON document held in the utf-8 bytes-like buffer buf,
+    with the same interface as the JSONStreamReader.
+    skip_value() only scans the bytes of a value, with regular
+    expressions, to find where it ends.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        self._pos = 0
+
+    def _peek(self):
+        """
+        Skips whitespace and returns the next byte, or an empty
+        bytes string at the end of the document.
+        """
+        self._pos = _WHITESPACE_RE.match(self.buf, self._pos).end()
+        return self.buf[self._pos:self._pos + 1]
+
+    def _expect(self, chars):
+        char = self._peek()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at offset %s, got %r" %
+                             (chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def _skip_string(self, start):
+        match = _STRING_RE.match(self.buf, start)
+        if match is None:
+            raise ValueError("Unterminated string at offset %s" % start)
+        return match.end()
+
+    def skip_value(self):
+        """
+        Skips the next JSON value, without decoding it.
+        Returns its (start, end) offsets in the buffer.
+        """
+        match = _VALUE_RE.match(self.buf, self._pos)
+        if match is not None:
+            self._pos = match.end()
+            return match.start(1), self._pos
+        char = self._peek()
+        start = self._pos
+        if not char or char not in b'{[':
+            raise ValueError("Expected a value at offset %s" % start)
+        # Deeply nested value
+        depth = 0
+        while True:
+            match = _TOKEN_RE.search(self.buf, self._pos)
+            if match is None:
+                raise ValueError("Truncated value at offset %s" % start)
+            token = match.group()
+            if token == b'"':
+                self._pos = self._skip_string(match.start())
+                continue
+            self._pos = match.end()
+            depth += 1 if token in b'{[' else -1
+            if depth == 0:
+                return start, self._pos
+
+    def read_value(self):
+        """ Decodes and returns the next JSON value """
+        start, end = self.skip_value()
+        return json.loads(self.buf[start:end].decode('utf-8'))
+
+    def iter_items(self):
+        """
+        Iterates over the keys of the next JSON object.
+        For each key yielded, the caller must consume its value
+        with read_value(), skip_value() or iter_items() before
+        asking the next key.
+        """
+        self._expect(b'{')
+        if self._peek() == b'}':
+            self._pos += 1
+            return
+        while True:
+            match = _KEY_RE.match(self.buf, self._pos)
+            if match is None:
+                raise ValueError("Expected a key at offset %s" % self._pos)
+            key = match.group(1)
+            if b'\\' in key:
+                key = json.loads(key.decode('utf-8'))
+            else:
+                key = key[1:-1].decode('utf-8')
+            self._pos = match.end()
+            yield key
+            match = _NEXT_RE.match(self.buf, self._pos)
+            if match is None:
+                raise ValueError("Expected ',' or '}' at offset %s"
+                                 % self._pos)
+            self._pos = match.end()
+            if match.group(1) == b'}':
+                return
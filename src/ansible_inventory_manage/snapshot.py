@@ -0,0 +1,106 @@
+"""
+Binary snapshot files.
+
+A snapshot is a magic header, followed by sections, each prefixed
+by its length in bytes: arrays of 32 bits little-endian integers,
+string tables, or raw bytes.
+The SnapshotReader reads them from a bytes-like buffer, like a
+memory-mapped file, copying only what it decodes.
+See Inventory.save_snapshot for the sections of an inventory.
+"""
+from array import array
+import struct
+import sys
+
+MAGIC = b'AIMSNAP1'
+_LENGTH = struct.Struct('<I')
+
+
+def _int_array(data=b''):
+    values = array('i')
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        # Python 2
+        values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class SnapshotWriter(object):
+    """ Writes the sections of a snapshot into the binary file object fp """
+
+    def __init__(self, fp):
+        self.fp = fp
+        fp.write(MAGIC)
+
+    def write_bytes(self, data):
+        self.fp.write(_LENGTH.pack(len(data)))
+        self.fp.write(data)
+
+    def write_array(self, values):
+        values = array('i', values)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        if hasattr(values, 'tobytes'):
+            self.write_bytes(values.tobytes())
+        else:
+            # Python 2
+            self.write_bytes(values.tostring())
+
+    def write_blobs(self, blobs):
+        """ Writes the bytes blobs, and the offsets where they end """
+        offsets = [0]
+        for blob in blobs:
+            offsets.append(offsets[-1] + len(blob))
+        self.write_array(offsets)
+        self.write_bytes(b''.join(blobs))
+
+    def write_strings(self, strings):
+        self.write_blobs([string.encode('utf-8') for string in strings])
+
+
+class SnapshotReader(object):
+    """
+    Reads the sections of a snapshot from the buffer buf,
+    in the order they were written.
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+        if buf[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not an inventory snapshot")
+        self._pos = len(MAGIC)
+
+    def read_range(self):
+        """ Skips the next section, and returns its (start, end) offsets """
+        if self._pos + _LENGTH.size > len(self.buf):
+            raise ValueError("Truncated snapshot")
+        length, = _LENGTH.unpack_from(self.buf, self._pos)
+        start = self._pos + _LENGTH.size
+        self._pos = start + length
+        if self._pos > len(self.buf):
+            raise ValueError("Truncated snapshot")
+        return start, self._pos
+
+    def read_bytes(self):
+        start, end = self.read_range()
+        return self.buf[start:end]
+
+    def read_array(self):
+        return _int_array(self.read_bytes())
+
+    def read_blobs(self):
+        """
+        Returns the (start, end) offsets in the buffer
+        of the blobs written by write_blobs.
+        """
+        offsets = self.read_array()
+        base, _ = self.read_range()
+        return [(base + offsets[index], base + offsets[index + 1])
+                for index in range(len(offsets) - 1)]
+
+    def read_strings(self):
+        return [self.buf[start:end].decode('utf-8')
+                for start, end in self.read_blobs()]
@@ -1,6 +1,7 @@
 """ Global testing fixtures """
 import pytest
 import json
+from collections import OrderedDict
 import ansible_inventory_manage.inventory
 
 inventory_file = 'tests/small.json'
@@ -12,7 +13,8 @@ def inventoryloader():
     can be used for manipulations
     """
     with open(inventory_file, 'r') as fd:
-        fc =json.loads(fd.read())
+        # Keep the order of the file, on Python 2 too
+        fc = json.loads(fd.read(), object_pairs_hook=OrderedDict)
     inventoryloader = ansible_inventory_manage.inventory.Inventory()
     inventoryloader.load_inventoryjson(fc)
     return inventoryloader
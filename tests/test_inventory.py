@@ -1,8 +1,11 @@
 import copy
+import io
 import json
 import pytest
+from past.builtins import intern
 from ansible_inventory_manage.inventory import Host, Group, Inventory
-from ansible_inventory_manage.inventory import InventoryObject
+from ansible_inventory_manage.inventory import InventoryObject, OrderedSet
+from ansible_inventory_manage.inventory import InventoryJournal
 import ansible_inventory_manage.inventory
 
 
@@ -147,6 +150,98 @@ def test_merge_dicts_with_invalid_prios():
     with pytest.raises(TypeError):
         dict(ansible_inventory_manage.inventory.mergedicts(a, b, prios=('a', 'b')))
 
+def test_mergedicts_shares_untouched_values():
+    untouched = dict(certs=['a' * 10] * 10)
+    a = dict(big=untouched, common=dict(x=1), items=[1])
+    b = dict(common=dict(y=2), items=[2])
+    result = dict(ansible_inventory_manage.inventory.mergedicts(a, b))
+    assert result['big'] is untouched
+    assert result['common'] == dict(x=1, y=2)
+    assert result['items'] == [1, 2]
+    # inputs are left untouched
+    assert a['common'] == dict(x=1)
+    assert a['items'] == [1]
+
+def test_mergedicts_deep_nesting():
+    depth = 5000
+    a, b = {}, {}
+    lefta, leftb = a, b
+    for _ in range(depth):
+        lefta['k'], leftb['k'] = {}, {}
+        lefta, leftb = lefta['k'], leftb['k']
+    lefta['a'], leftb['b'] = 1, 2
+    result = dict(ansible_inventory_manage.inventory.mergedicts(a, b))
+    for _ in range(depth):
+        result = result['k']
+    assert result == dict(a=1, b=2)
+
+def test_mergedicts_many():
+    sources = [
+        (dict(a='first', nested=dict(x=1), items=[1]), 0),
+        (dict(a='second', nested=dict(y=2), items=[2], b='b'), 1),
+        (dict(a='third', nested=dict(x=3), items=[3]), 1),
+        (dict(a='dropped', c='c'), -999),
+    ]
+    result = dict(ansible_inventory_manage.inventory.mergedicts_many(sources))
+    assert result == dict(a='second', nested=dict(x=3, y=2),
+                          items=[1, 2, 3], b='b')
+
+@pytest.mark.parametrize("a,b,prios,expected", testmergedicts_data)
+def test_mergedicts_many_as_mergedicts(a, b, prios, expected):
+    sources = [(a, prios[0]), (b, prios[1])]
+    result = ansible_inventory_manage.inventory.mergedicts_many(sources)
+    assert dict(result) == expected
+
+def test_mergedicts_many_invalid_prios():
+    with pytest.raises(TypeError):
+        dict(ansible_inventory_manage.inventory.mergedicts_many([({}, 'a')]))
+
+def test_bitsets():
+    ids = [0, 3, 8, 15, 16, 200]
+    bits = ansible_inventory_manage.inventory._bitset_from_ids(ids, 201)
+    assert bits == sum(1 << index for index in ids)
+    assert ansible_inventory_manage.inventory._ids_from_bitset(bits) == ids
+    assert ansible_inventory_manage.inventory._ids_from_bitset(0) == []
+
+def test_split_pattern():
+    split = ansible_inventory_manage.inventory._split_pattern
+    assert split('web:&prod, !canary') == ['web', '&prod', '!canary']
+    assert split('web[1:3]:db') == ['web[1:3]', 'db']
+
+class TestOrderedSet(object):
+    def test_keeps_insertion_order(self):
+        items = OrderedSet(['c', 'a', 'b', 'a'])
+        assert list(items) == ['c', 'a', 'b']
+        assert len(items) == 3
+        assert items[0] == 'c'
+        assert items[-1] == 'b'
+
+    def test_add_discard(self):
+        items = OrderedSet()
+        items.add('a')
+        items.add('b')
+        items.add('a')
+        assert items == ['a', 'b']
+        items.discard('a')
+        items.discard('absent')
+        assert 'a' not in items
+        assert items == ['b']
+
+    def test_reorder(self):
+        items = OrderedSet(['a', 'b', 'c'])
+        InventoryObject.change_element_index(items, 2, 0)
+        assert items == ['c', 'a', 'b']
+        assert items.index('a') == 1
+
+    def test_index_out_of_range(self):
+        with pytest.raises(IndexError):
+            OrderedSet()[0]
+
+    def test_set_comparison(self):
+        assert OrderedSet(['a', 'b']) == set(['b', 'a'])
+        assert OrderedSet(['a', 'b']) != ['b', 'a']
+
+
 class TestInventoryObject(object):
     def test_change_element_index(self):
         assert ['b', 'a', 'c'] == \
@@ -208,6 +303,24 @@ class TestHost(object):
         assert len(groupa.hosts) == 0
         assert len(groupb.hosts) == 0
 
+    def test_no_instance_dict(self):
+        assert not hasattr(Host('a'), '__dict__')
+        assert not hasattr(Group('a'), '__dict__')
+
+    def test_shared_empty_sentinels(self):
+        a, b = Host('a'), Host('b')
+        assert a.groups is b.groups
+        assert a._vars is b._vars
+        with pytest.raises(TypeError):
+            a.groups.add(Group('g'))
+        a.set_var('x', 1)
+        assert b.vars == {}
+        assert a._vars is not b._vars
+        groupa = Group('ga')
+        groupa.add_host(a)
+        groupa.del_host(a)
+        assert a.groups is b.groups
+
     def test_update_hostvar(self):
         hosta = Host('hosta')
         hosta.set_var('a', 'valuea')
@@ -251,6 +364,12 @@ class TestGroup(object):
         a.set_vars(gvars)
         assert a.vars['babar'] == 'woot'
 
+    def test_set_layered_vars(self):
+        a = Group('a')
+        a.set_vars(dict(keep='me', port=1))
+        a.set_layered_vars([(dict(port=2), 1), (dict(port=3, extra=[1]), 1)])
+        assert a.vars == dict(keep='me', port=2, extra=[1])
+
     def test_create_with_no_groupname(self):
         with pytest.raises(Exception):
             Group()
@@ -420,10 +539,42 @@ class TestGroup(object):
         assert mid.children[0].name == 'child2'
 
     def test_has_cyle(self):
-        pass
+        a, b, c = Group('a'), Group('b'), Group('c')
+        a.add_child(b)
+        b.add_child(c)
+        with pytest.raises(Exception):
+            c.add_child(a)
+        with pytest.raises(Exception):
+            a.add_parent(c)
+        assert a not in c.children
+        assert c not in a.parents
 
     def test_has_no_cycle(self):
-        pass
+        """ Diamonds and reversed creation orders are fine """
+        groups = [Group('g%s' % index) for index in range(50)]
+        for parent, child in zip(groups[1:], groups):
+            parent.add_child(child)
+        top, bottom = Group('top'), Group('bottom')
+        groups[0].add_child(bottom)
+        groups[10].add_child(bottom)
+        top.add_child(groups[-1])
+        top.add_child(groups[25])
+        for parent, child in zip(groups[1:], groups):
+            assert parent._order < child._order
+        assert top._order < groups[-1]._order
+        assert groups[0]._order < bottom._order
+        with pytest.raises(Exception):
+            bottom.add_child(top)
+
+    def test_reorder_hierarchy(self):
+        c, d = Group('c'), Group('d')
+        c.add_child(d)
+        a, b = Group('a'), Group('b')
+        a.add_child(b)
+        b.add_child(c)
+        assert a._order < b._order < c._order < d._order
+        with pytest.raises(Exception):
+            d.add_child(a)
 
     def test_reorder_parents(self):
         parent1, parent2 = Group(name='par1'), Group(name='par2')
@@ -502,6 +653,25 @@ class TestGroup(object):
         assert g3.has_group("g2")
         assert not g3.has_group('u2')
 
+    def test_has_host_after_rename(self):
+        g1, h1 = Group('g1'), Host('h1')
+        g1.add_host(h1)
+        h1.name = 'h2'
+        assert g1.has_host('h2')
+        assert not g1.has_host('h1')
+        g1.del_host(h1)
+        assert not g1.has_host('h2')
+
+    def test_has_group_after_rename(self):
+        g1, g2, h1 = Group('g1'), Group('g2'), Host('h1')
+        g1.add_child(g2)
+        g1.add_host(h1)
+        g1.name = 'g3'
+        assert g2.has_group('g3')
+        assert not g2.has_group('g1')
+        assert h1.has_group('g3')
+        assert not h1.has_group('g1')
+
 
 
 # Inventory
@@ -532,6 +702,194 @@ class TestInventory(object):
         assert inventory.count_groups() == len(groups)
         assert inventory.count_hosts() == len(hosts)
 
+    @pytest.mark.parametrize("fname,groups,hosts", inventory_data)
+    def test_input_loadstream(self, fname, groups, hosts):
+        with open(fname, 'rb') as fd:
+            inventory = Inventory()
+            inventory.load_inventory_stream(fd, chunk_size=16)
+        assert inventory.count_groups() == len(groups)
+        assert inventory.count_hosts() == len(hosts)
+
+    def test_loadstream_vs_loadjson(self):
+        with open('tests/small.json', 'r') as fd:
+            expected = json.loads(fd.read())
+        with open('tests/small.json', 'r') as fd:
+            inventory = Inventory()
+            inventory.load_inventory_stream(fd, chunk_size=16)
+        assert inventory.write_output_json() == expected
+
+    def test_input_loadstream_meta_last(self):
+        content = u'''{
+            "web": {"hosts": ["web1"], "vars": {"port": 80}},
+            "_meta": {"hostvars": {"web1": {"ansible_host": "10.0.0.1"},
+                                   "db1": {}}}
+        }'''
+        inventory = Inventory()
+        inventory.load_inventory_stream(io.StringIO(content))
+        assert inventory.groups['web'].has_host('web1')
+        assert inventory.hosts['web1'].vars == {'ansible_host': '10.0.0.1'}
+        assert 'db1' in inventory.hosts
+
+    def test_loadmmap_vs_loadjson(self):
+        with open('tests/small.json', 'r') as fd:
+            expected = json.loads(fd.read())
+        inventory = Inventory()
+        inventory.load_inventory_mmap('tests/small.json')
+        assert inventory.write_output_json() == expected
+
+    def test_loadmmap_lazy_hostvars(self, tmpdir):
+        content = {
+            'web': {'hosts': ['web1', 'web2'], 'vars': {'port': 80}},
+            '_meta': {'hostvars': {'web1': {'ansible_host': '10.0.0.1'},
+                                   'web2': {'ansible_host': '10.0.0.2'}}},
+        }
+        path = tmpdir.join('lazy.json')
+        path.write(json.dumps(content))
+        inventory = Inventory()
+        inventory.load_inventory_mmap(str(path))
+        web1, web2 = inventory.hosts['web1'], inventory.hosts['web2']
+        assert not web1._vars.loaded and not web2._vars.loaded
+        assert inventory.groups['web'].has_host('web2')
+        output = io.StringIO()
+        inventory.write_output_stream(output)
+        assert not web1._vars.loaded
+        assert json.loads(output.getvalue())['_meta']['hostvars'] == \
+            content['_meta']['hostvars']
+        assert inventory.resolve_host_vars('web1') == \
+            {'ansible_host': '10.0.0.1', 'port': 80}
+        assert web1._vars.loaded and not web2._vars.loaded
+        web2.set_var('a', 1)
+        assert web2.vars == {'ansible_host': '10.0.0.2', 'a': 1}
+
+    def test_snapshot_roundtrip(self, tmpdir, inventoryloader):
+        inventoryloader.add_group('compute', {'hosts': ['node[01:20]'],
+                                              'vars': {'a': 1},
+                                              'priority': 3})
+        inventoryloader.add_host('node03', {'b': 2})
+        inventoryloader.del_host('node04')
+        inventoryloader.groups['glance_all'].reorder_children(1, 0)
+        path = str(tmpdir.join('inventory.snapshot'))
+        inventoryloader.save_snapshot(path)
+        inventory = Inventory()
+        inventory.load_snapshot(path)
+        assert inventory.write_output_json() == \
+            inventoryloader.write_output_json()
+        assert inventory.resolve_all_hostvars() == \
+            inventoryloader.resolve_all_hostvars()
+        assert inventory.groups['compute'].priority == 3
+        assert inventory.count_hosts() == inventoryloader.count_hosts()
+        assert inventory.find_host_range('node04') is None
+        assert inventory.host_ranges['node[01:20]']._members['node03'] is \
+            inventory.hosts['node03']
+        assert not inventory.has_cycle()
+        with pytest.raises(Exception):
+            inventory.add_group('all', {'parents': ['glance_api']})
+        with pytest.raises(Exception):
+            inventory.load_snapshot(path)
+
+    def test_snapshot_lazy_vars(self, tmpdir):
+        inventory = Inventory()
+        inventory.add_host('h1', {'a': 1})
+        inventory.add_host('h2', {'b': 2})
+        path = str(tmpdir.join('inventory.snapshot'))
+        inventory.save_snapshot(path)
+        inventory = Inventory()
+        inventory.load_snapshot(path)
+        assert inventory.hosts['h1']._vars == {'a': 1}
+        assert not inventory.hosts['h2']._vars.loaded
+        # a snapshot of a snapshot doesn't decode the vars
+        inventory.save_snapshot(path + '2')
+        assert not inventory.hosts['h2']._vars.loaded
+        assert inventory.hosts['h2'].vars == {'b': 2}
+        assert inventory.resolve_all_hostvars()['h2'] == {'b': 2}
+        bad = tmpdir.join('bad.snapshot')
+        bad.write('not a snapshot')
+        with pytest.raises(ValueError):
+            Inventory().load_snapshot(str(bad))
+
+    @pytest.mark.parametrize("processes", [1, 2])
+    def test_load_inventoryfiles(self, tmpdir, processes):
+        region1 = {
+            '_meta': {'hostvars': {'h1': {'a': 'region1'}, 'h2': {}}},
+            'all': {'children': ['web']},
+            'web': {'hosts': ['h1', 'h2'], 'vars': {'port': 80}},
+        }
+        region2 = {
+            '_meta': {'hostvars': {'h1': {'a': 'region2'}, 'h3': {}}},
+            'web': {'hosts': ['h3'], 'vars': {'port': 8080}},
+            'db': {'hosts': ['h1']},
+        }
+        paths = []
+        for index, content in enumerate([region1, region2]):
+            path = tmpdir.join('region%s.json' % index)
+            path.write(json.dumps(content))
+            paths.append(str(path))
+        inventory = Inventory()
+        inventory.load_inventoryfiles(paths, processes=processes)
+        assert sorted(inventory.hosts) == ['h1', 'h2', 'h3']
+        assert [host.name for host in inventory.groups['web'].hosts] == \
+            ['h1', 'h2', 'h3']
+        assert inventory.groups['db'].has_host('h1')
+        assert inventory.groups['all'].has_group('web')
+        # later sources win by default
+        assert inventory.hosts['h1'].vars == {'a': 'region2'}
+        assert inventory.groups['web'].vars == {'port': 8080}
+        inventory = Inventory()
+        inventory.load_inventoryfiles(paths, priorities=[5, 3],
+                                      processes=processes)
+        assert inventory.hosts['h1'].vars == {'a': 'region1'}
+        assert inventory.groups['web'].vars == {'port': 80}
+
+    def test_compact_inventory(self):
+        hostname = ''.join(['compact', 'host'])
+        varname = ''.join(['compact', 'var'])
+        inventory = Inventory(compact=True)
+        inventory.add_host(hostname, {varname: {varname: 1}})
+        inventory.add_group(''.join(['compact', 'group']),
+                            {'hosts': [hostname], 'vars': {varname: 2}})
+        host = inventory.hosts['compacthost']
+        assert host.name is intern('compacthost')
+        key = list(host.vars)[0]
+        assert key is intern('compactvar')
+        assert list(host.vars[key])[0] is key
+        group = inventory.groups['compactgroup']
+        assert group.name is intern('compactgroup')
+        assert list(group.vars)[0] is key
+
+    def test_dedup_inventory(self):
+        inventory = Inventory(dedup=True)
+        for hostname in ['h1', 'h2', 'h3']:
+            inventory.add_host(hostname, {'ansible_user': 'root', 'port': 22})
+        h1, h2, h3 = (inventory.hosts[name] for name in ['h1', 'h2', 'h3'])
+        assert h1._vars is h2._vars is h3._vars
+        assert h1.has_same_vars(h2)
+        h2.set_var('port', 2222)
+        assert not h1.has_same_vars(h2)
+        assert inventory.resolve_host_vars('h1') == \
+            {'ansible_user': 'root', 'port': 22}
+        h2.set_var('port', 22)
+        assert h1._vars is h2._vars
+        # Reading keeps them shared, writing in place copies them
+        assert h3.vars['port'] == 22
+        assert h1._vars is h3._vars
+        h3.vars['port'] = 23
+        assert h1.vars['port'] == 22
+        assert h1._vars is h2._vars
+        assert inventory.write_output_json()['_meta']['hostvars']['h3'] == \
+            {'ansible_user': 'root', 'port': 23}
+        assert copy.deepcopy(h1._vars) == h1._vars
+        inventory.add_group('g', {'vars': {'ansible_user': 'root',
+                                           'port': 22}})
+        assert inventory.groups['g'].has_same_vars(h1)
+        assert not Inventory().hosts and Inventory()._vars_pool is None
+
+    def test_loadjson_does_not_mutate_input(self):
+        with open('tests/small.json', 'r') as fd:
+            fc = json.loads(fd.read())
+        inventory = Inventory()
+        inventory.load_inventoryjson(fc)
+        assert '_meta' in fc
+
     def test_malformed_input(self):
         pass
 
@@ -585,6 +943,9 @@ class TestInventory(object):
         inventoryloader.rename_group('glance_api', 'glance_rocks')
         assert 'glance_rocks' in inventoryloader.groups
         assert 'glance_api' not in inventoryloader.groups
+        assert inventoryloader.groups['glance_all'].has_group('glance_rocks')
+        assert inventoryloader.hosts['localhost'].has_group('glance_rocks')
+        assert not inventoryloader.hosts['localhost'].has_group('glance_api')
 
     def test_priority(self, inventoryloader):
         """
@@ -595,6 +956,484 @@ class TestInventory(object):
         inventoryloader.add_group('glance_api',{'vars': {'management_bridge':'br_woot'}})
         assert 'br_woot' == inventoryloader.groups['glance_api'].vars.get('management_bridge')
 
+    def test_graph(self, inventoryloader):
+        graph = inventoryloader.get_graph()
+        assert inventoryloader.get_graph() is graph
+        all_id = graph.group_ids['all']
+        glance_id = graph.group_ids['glance_all']
+        api_id = graph.group_ids['glance_api']
+        assert all_id < glance_id < api_id
+        assert glance_id in graph.children_of(all_id)
+        assert list(graph.parents_of(api_id)) == [glance_id]
+        assert [graph.hosts[hostid].name for hostid in graph.hosts_of(api_id)] \
+            == ['localhost']
+        localhost_id = graph.host_ids['localhost']
+        assert list(graph.groups_of(localhost_id)) == [api_id]
+        assert sorted(inventoryloader.get_group_hosts('all')) == \
+            ['localhost', 'localhost2']
+        assert inventoryloader.get_group_hosts('glance_registry') == \
+            ['localhost2']
+
+    def test_graph_is_rebuilt_on_change(self, inventoryloader):
+        graph = inventoryloader.get_graph()
+        inventoryloader.add_host('localhost3')
+        inventoryloader.groups['glance_api'].add_host(
+            inventoryloader.hosts['localhost3'])
+        assert inventoryloader.get_graph() is not graph
+        assert inventoryloader.get_group_hosts('glance_all') == \
+            ['localhost', 'localhost2', 'localhost3']
+        inventoryloader.del_host('localhost3')
+        assert inventoryloader.get_group_hosts('glance_all') == \
+            ['localhost', 'localhost2']
+
+    def test_graph_is_kept_on_vars_change(self, inventoryloader):
+        graph = inventoryloader.get_graph()
+        inventoryloader.groups['glance_api'].set_var('a', 1)
+        inventoryloader.update_host('localhost', {'b': 2})
+        inventoryloader.hosts['localhost2'].vars['c'] = 3
+        inventoryloader.set_group_priority('glance_all', 5)
+        with inventoryloader.batch():
+            inventoryloader.groups['glance_all'].set_vars({'d': 4})
+        assert inventoryloader.get_graph() is graph
+        inventoryloader.rename_host('localhost', 'localhost3')
+        assert inventoryloader.get_graph() is not graph
+
+    def test_generation(self, inventoryloader):
+        generation = inventoryloader._generation
+        inventoryloader.groups['glance_api'].set_var('a', 1)
+        assert inventoryloader._generation > generation
+        generation = inventoryloader._generation
+        inventoryloader.rename_host('localhost', 'localhost3')
+        assert inventoryloader._generation > generation
+        generation = inventoryloader._generation
+        inventoryloader.write_output_json()
+        inventoryloader.resolve_all_hostvars()
+        assert inventoryloader._generation == generation
+        removed = inventoryloader.hosts['localhost2']
+        inventoryloader.del_host('localhost2')
+        generation = inventoryloader._generation
+        removed.set_var('a', 1)
+        assert inventoryloader._generation == generation
+
+    def test_pattern_hosts(self):
+        inventory = Inventory()
+        for index in range(20):
+            inventory.add_host('h%02d' % index)
+        inventory.add_group('web', {'hosts': ['h%02d' % i for i in range(10)]})
+        inventory.add_group('prod', {'hosts': ['h%02d' % i
+                                               for i in range(5, 15)]})
+        inventory.add_group('canary', {'hosts': ['h07']})
+        inventory.add_group('all', {'children': ['web', 'prod', 'canary']})
+        assert inventory.get_pattern_hosts('web:&prod:!canary') == \
+            ['h05', 'h06', 'h08', 'h09']
+        assert inventory.get_pattern_hosts('!canary:&web') == \
+            ['h%02d' % i for i in range(10) if i != 7]
+        assert inventory.get_pattern_hosts('canary,h19') == ['h07', 'h19']
+        assert inventory.get_pattern_hosts('all') == \
+            ['h%02d' % i for i in range(20)]
+        assert inventory.get_pattern_hosts('*:!web:!prod:!canary') == \
+            ['h%02d' % i for i in range(15, 20)]
+        assert inventory.get_pattern_hosts('unknown') == []
+
+    def test_select(self):
+        inventory = Inventory()
+        for name in ['web01', 'web02', 'web03', 'db01', 'db02', 'webdb']:
+            inventory.add_host(name)
+        inventory.add_group('webservers', {'hosts': ['web01', 'web02', 'web03']})
+        inventory.add_group('web_canary', {'hosts': ['web02']})
+        inventory.add_group('dbservers', {'hosts': ['db01', 'db02']})
+        select = inventory.get_pattern_hosts
+        assert [host.name for host in inventory.select('db*')] == \
+            ['db01', 'db02']
+        assert isinstance(inventory.select('db01')[0], Host)
+        # globs match groups and hosts
+        assert select('web*') == ['web01', 'web02', 'web03', 'webdb']
+        assert select('web_*') == ['web02']
+        assert select('~web0[13]') == ['web01', 'web03']
+        assert select('~.*db') == ['db01', 'db02', 'webdb']
+        assert select('~web\\d+$') == ['web01', 'web02', 'web03']
+        assert select('~web01|db') == ['web01', 'db01', 'db02']
+        assert select('~db0\\|?1') == ['db01']
+        assert select('webservers[0]') == ['web01']
+        assert select('webservers[-1]') == ['web03']
+        assert select('webservers[1:2]') == ['web02', 'web03']
+        assert select('webservers[1:]') == ['web02', 'web03']
+        assert select('webservers[5]') == []
+        # like in ansible, a numeric [x] is a subscript, not a glob
+        assert select('web0[1]') == []
+        assert select('web0[!2]') == ['web01', 'web03']
+        assert select('webservers:dbservers:&~.*0[12]:!web_canary') == \
+            ['web01', 'db01', 'db02']
+        assert select('nomatch*') == []
+
+    def test_literal_prefix(self):
+        prefix = ansible_inventory_manage.inventory._literal_prefix
+        assert prefix('web*') == 'web'
+        assert prefix('*web') == ''
+        assert prefix('~web\\d+') == 'web'
+        assert prefix('~webs?') == 'web'
+        assert prefix('db01') == 'db01'
+
+    def test_group_bitset_is_transitive(self, inventoryloader):
+        graph = inventoryloader.get_graph()
+        bits = graph.group_bitset(graph.group_ids['glance_all'])
+        assert bits == graph.pattern_bitset('glance_api:glance_registry')
+        assert graph.hostnames(bits) == ['localhost', 'localhost2']
+
+    def test_diff(self, inventoryloader):
+        with open('tests/small.json', 'r') as fd:
+            content = json.loads(fd.read())
+        other = Inventory()
+        other.load_inventoryjson(content)
+        assert not inventoryloader.diff(other)
+        other.rename_host('localhost', 'renamedhost')
+        other.rename_group('glance_api', 'glance_apis')
+        other.add_host('newhost', {'a': 1})
+        other.add_group('newgroup', {'hosts': ['newhost', 'localhost2']})
+        other.groups['glance_all'].del_child(other.groups['glance_registry'])
+        other.hosts['localhost2'].set_var('ansible_connection', 'ssh')
+        other.hosts['localhost2'].set_var('new', True)
+        diff = inventoryloader.diff(other)
+        assert diff
+        assert diff.hosts_added == ['newhost']
+        assert diff.hosts_removed == []
+        assert diff.hosts_renamed == [('localhost', 'renamedhost')]
+        assert diff.groups_added == ['newgroup']
+        assert diff.groups_renamed == [('glance_api', 'glance_apis')]
+        assert diff.children_added == []
+        assert diff.children_removed == [('glance_all', 'glance_registry')]
+        assert sorted(diff.members_added) == \
+            [('newgroup', 'localhost2'), ('newgroup', 'newhost')]
+        assert diff.members_removed == []
+        assert diff.hostvars_changed == {'localhost2': {
+            'added': {'new': True}, 'removed': {},
+            'changed': {'ansible_connection': ('local', 'ssh')}}}
+        assert diff.groupvars_changed == {}
+        reverse = other.diff(inventoryloader)
+        assert reverse.hosts_removed == ['newhost']
+        assert reverse.members_removed == diff.members_added
+
+    def test_diff_host_ranges(self):
+        old, new = Inventory(), Inventory()
+        old.add_group('compute', {'hosts': ['node[001:500]'],
+                                  'vars': {'a': 1}})
+        new.add_group('compute', {'hosts': ['node[001:500]']})
+        new.add_host('node042', {'b': 2})
+        new.del_host('node100')
+        diff = old.diff(new)
+        assert diff.hosts_removed == ['node100']
+        assert diff.hostvars_changed == {'node042': {
+            'added': {'b': 2}, 'removed': {}, 'changed': {}}}
+        assert diff.groupvars_changed == {'compute': {
+            'added': {}, 'removed': {'a': 1}, 'changed': {}}}
+        assert diff.members_removed == [('compute', 'node100')]
+        assert diff.members_added == []
+
+    def test_diff_compares_changed_content(self, monkeypatch):
+        old, new, same = Inventory(), Inventory(), Inventory()
+        for inventory in (old, new, same):
+            inventory.add_host('db1')
+            inventory.add_group('web', {'hosts': ['web[1:50]'],
+                                        'vars': {'a': 1}})
+            inventory.add_group('db', {'hosts': ['db1'], 'vars': {'b': 1}})
+            for index in range(50):
+                inventory.add_host('host%s' % index, {'c': index})
+        new.hosts['host7'].set_var('c', 0)
+        new.groups['db'].set_var('b', 2)
+        compared = []
+        vars_changes = ansible_inventory_manage.inventory._vars_changes
+
+        def counted(oldvars, newvars):
+            compared.append(oldvars)
+            return vars_changes(oldvars, newvars)
+        monkeypatch.setattr(ansible_inventory_manage.inventory,
+                            '_vars_changes', counted)
+        diff = old.diff(new)
+        assert diff.hostvars_changed == {'host7': {
+            'added': {}, 'removed': {}, 'changed': {'c': (7, 0)}}}
+        assert diff.groupvars_changed == {'db': {
+            'added': {}, 'removed': {}, 'changed': {'b': (1, 2)}}}
+        # Only the objects hashing differently are compared
+        assert compared == [{'b': 1}, {'c': 7}]
+        assert not hasattr(diff, '_compared')
+        del compared[:]
+        assert not old.diff(same)
+        assert compared == []
+
+    @staticmethod
+    def _journaled_edits(inventory):
+        inventory.add_group('compute', {'hosts': ['node[01:10]'],
+                                        'vars': {'a': 1}})
+        inventory.add_host('node03', {'b': 2})
+        inventory.del_host('node04')
+        inventory.rename_host('localhost', 'renamedhost')
+        inventory.rename_group('glance_api', 'glance_apis')
+        inventory.groups['glance_all'].add_child(inventory.groups['compute'])
+        inventory.groups['glance_all'].reorder_children(2, 0)
+        inventory.hosts['localhost2'].set_var('ansible_connection', 'ssh')
+        inventory.groups['compute'].vars = {'c': 3}
+        inventory.convert_group('glance_registry', 'registry')
+        inventory.del_group('glance_all', reparent_groups=True)
+
+    def test_journal_replay(self, tmpdir, inventoryloader):
+        path = str(tmpdir.join('inventory.snapshot'))
+        inventoryloader.save_snapshot(path)
+        appended = io.StringIO()
+        journal = inventoryloader.start_journal(InventoryJournal(appended))
+        self._journaled_edits(inventoryloader)
+        assert len(journal) == 11
+        assert list(journal)[5] == {
+            'target': ['group', 'glance_all'], 'op': 'add_child',
+            'args': [['group', 'compute']], 'kwargs': {}, 'refs': [0]}
+        assert inventoryloader.stop_journal() is journal
+        written = io.StringIO()
+        journal.write(written)
+        for fp in (written, appended):
+            fp.seek(0)
+            inventory = Inventory()
+            inventory.load_snapshot(path)
+            InventoryJournal.read(fp).replay(inventory)
+            assert inventory.write_output_json() == \
+                inventoryloader.write_output_json()
+            assert inventory.resolve_all_hostvars() == \
+                inventoryloader.resolve_all_hostvars()
+
+    def test_journal_undo(self, inventoryloader):
+        # The output references the vars, which are modified in place.
+        output = copy.deepcopy(inventoryloader.write_output_json())
+        hostvars = inventoryloader.resolve_all_hostvars()
+        appended = io.StringIO()
+        journal = inventoryloader.start_journal(InventoryJournal(appended))
+        self._journaled_edits(inventoryloader)
+        journal.undo()
+        assert inventoryloader.groups['glance_all'].has_group('registry')
+        journal.undo(len(journal))
+        assert inventoryloader.write_output_json() == output
+        assert inventoryloader.resolve_all_hostvars() == hostvars
+        assert inventoryloader.hosts['localhost'].has_group('glance_api')
+        assert not inventoryloader.has_cycle()
+        with pytest.raises(Exception):
+            journal.undo()
+        # Replaying the undo markers skips the entries undone
+        self._journaled_edits(inventoryloader)
+        journal.undo(2)
+        appended.seek(0)
+        replayed = InventoryJournal.read(appended)
+        assert len(replayed) == len(journal) == 9
+        with pytest.raises(Exception):
+            replayed.undo()
+        inventory = Inventory()
+        inventory.load_inventoryjson(output)
+        replayed.replay(inventory)
+        assert inventory.write_output_json() == \
+            inventoryloader.write_output_json()
+
+    def test_batch(self, inventoryloader):
+        def edit(inventory):
+            inventory.add_group('compute', {'hosts': ['node[01:10]'],
+                                            'vars': {'a': 1},
+                                            'parents': ['glance_all']})
+            inventory.add_host('node03', {'b': 2})
+            inventory.add_group('compute', {'hosts': ['node[01:10]',
+                                                      'localhost'],
+                                            'vars': {'c': 3}})
+            inventory.groups['glance_api'].add_child(
+                inventory.groups['glance_registry'])
+            inventory.hosts['localhost2'].set_vars({'d': 4})
+            inventory.hosts['localhost2'].add_group(
+                inventory.groups['compute'])
+            inventory.del_host('node04')
+        with open('tests/small.json', 'r') as fd:
+            content = json.loads(fd.read())
+        inventory = Inventory()
+        with inventory.batch():
+            inventory.load_inventoryjson(content)
+            # Not applied yet
+            assert not inventory.groups['glance_api'].hosts
+            edit(inventory)
+        edit(inventoryloader)
+        assert inventory.write_output_json() == \
+            inventoryloader.write_output_json()
+        assert inventory.resolve_all_hostvars() == \
+            inventoryloader.resolve_all_hostvars()
+        assert inventory.hosts['node03'].has_group('compute')
+        assert [group.name for group in inventory.hosts['localhost'].groups] \
+            == ['glance_api', 'compute']
+        with pytest.raises(Exception):
+            with inventory.batch():
+                inventory.start_journal()
+
+    def test_batch_rollback(self, inventoryloader):
+        output = copy.deepcopy(inventoryloader.write_output_json())
+        hostvars = inventoryloader.resolve_all_hostvars()
+        groups = inventoryloader.groups
+        with pytest.raises(Exception):
+            with inventoryloader.batch():
+                inventoryloader.add_group('newgroup', {'hosts': ['localhost'],
+                                                       'vars': {'a': 1}})
+                groups['glance_api'].add_host(inventoryloader.hosts['localhost2'])
+                inventoryloader.hosts['localhost'].set_var('b', 2)
+                groups['glance_all'].set_vars({'management_bridge': 'x'})
+                groups['glance_api'].add_child(groups['glance_all'])
+        assert inventoryloader.write_output_json() == output
+        assert inventoryloader.resolve_all_hostvars() == hostvars
+        assert not inventoryloader.has_cycle()
+        assert inventoryloader.hosts['localhost2'].groups == \
+            [groups['glance_registry']]
+        with pytest.raises(KeyError):
+            with inventoryloader.batch():
+                groups['glance_api'].add_host(inventoryloader.hosts['localhost2'])
+                inventoryloader.groups['missing']
+        assert inventoryloader.write_output_json() == output
+        assert inventoryloader._batch is None
+        assert inventoryloader._journal is None
+
+    def test_journal_failed_entry(self, inventoryloader):
+        journal = inventoryloader.start_journal()
+        before = inventoryloader.write_output_json()
+        with pytest.raises(Exception):
+            inventoryloader.add_group('glance_api',
+                                      {'children': ['newgroup', 'all']})
+        assert len(journal) == 0
+        assert 'newgroup' not in inventoryloader.groups
+        assert inventoryloader.write_output_json() == before
+        with pytest.raises(Exception):
+            inventoryloader.start_journal()
+        with pytest.raises(Exception):
+            inventoryloader.load_inventory_mmap('tests/small.json')
+
+    def test_has_cycle(self, inventoryloader):
+        assert not inventoryloader.has_cycle()
+        with pytest.raises(Exception):
+            inventoryloader.add_group('glance_api', {'children': ['all']})
+        assert not inventoryloader.has_cycle()
+        # Bypass the checks
+        api = inventoryloader.groups['glance_api']
+        api.children.add(inventoryloader.groups['all'])
+        inventoryloader.groups['all'].parents.add(api)
+        assert inventoryloader.has_cycle()
+
+    def test_load_nested_groups(self):
+        """ Children defined before their parents """
+        depth = 10000
+        content = dict(('g%s' % index, {'children': ['g%s' % (index - 1)]})
+                       for index in range(1, depth))
+        content['g0'] = {'hosts': ['h1']}
+        content['_meta'] = {'hostvars': {'h1': {}}}
+        inventory = Inventory()
+        inventory.load_inventoryjson(content)
+        assert not inventory.has_cycle()
+        inventory.groups['g%s' % (depth - 1)].set_var('a', 'top')
+        assert inventory.resolve_host_vars('h1') == {'a': 'top'}
+
+    def test_host_range(self):
+        inventory = Inventory()
+        inventory.add_group('compute', {'hosts': ['node[001:100]',
+                                                  'gpu[a:b]-[0:4:2]']})
+        inventory.add_host('db1')
+        assert len(inventory.hosts) == 1
+        assert len(inventory.host_ranges) == 2
+        assert inventory.count_hosts() == 107
+        assert list(inventory.host_ranges['gpu[a:b]-[0:4:2]']) == \
+            ['gpua-0', 'gpua-2', 'gpua-4', 'gpub-0', 'gpub-2', 'gpub-4']
+        assert inventory.has_host('node042')
+        assert not inventory.has_host('node42')
+        assert not inventory.has_host('gpua-1')
+        assert inventory.groups['compute'].has_host('node100')
+        assert inventory.get_pattern_hosts('compute[0]') == ['node001']
+        assert inventory.get_pattern_hosts('gpub*') == \
+            ['gpub-0', 'gpub-2', 'gpub-4']
+        output = inventory.write_output_json()
+        assert len(output['_meta']['hostvars']) == 107
+        assert output['compute']['hosts'][:2] == ['node001', 'node002']
+        assert output['ungrouped'] == {'hosts': ['db1']}
+        with pytest.raises(Exception):
+            inventory.add_host('node[090:110]')
+
+    def test_host_range_materialize(self):
+        inventory = Inventory()
+        inventory.add_host('node[1:10]', {'a': 1})
+        inventory.add_group('compute', {'hosts': ['node[1:10]']})
+        assert inventory.resolve_host_vars('node3') == {'a': 1}
+        assert not inventory.hosts
+        inventory.add_host('node3', {'b': 2})
+        assert inventory.hosts['node3'].vars == {'a': 1, 'b': 2}
+        assert inventory.hosts['node3'].has_group('compute')
+        assert 'node3' not in inventory.host_ranges['node[1:10]']
+        assert inventory.count_hosts() == 10
+        inventory.add_group('extra', {'hosts': ['node[1:10]']})
+        assert inventory.hosts['node3'].has_group('extra')
+        inventory.del_host('node4')
+        assert inventory.count_hosts() == 9
+        assert inventory.get_group_hosts('compute') == \
+            ['node3', 'node1', 'node2', 'node5', 'node6',
+             'node7', 'node8', 'node9', 'node10']
+        assert [host.name for host in inventory.select('node1*')] == \
+            ['node1', 'node10']
+        assert set(inventory.hosts) == set(['node3'])
+
+    def test_select_host_range(self):
+        inventory = Inventory()
+        inventory.add_host('web[01:05]', {'a': 1})
+        inventory.add_group('web', {'hosts': ['web[01:05]'],
+                                    'vars': {'port': 80}})
+        generation = inventory._generation
+        before = inventory.content_hash()
+        web = inventory.select('web')
+        assert [host.name for host in web] == \
+            ['web01', 'web02', 'web03', 'web04', 'web05']
+        assert not inventory.hosts
+        assert inventory._generation == generation
+        assert inventory.content_hash() == before
+        assert web[1].vars == {'a': 1}
+        assert web[1].has_group('web')
+        assert list(web[1].groups) == [inventory.groups['web']]
+        with pytest.raises(TypeError):
+            web[1].vars['port'] = 8080
+        # Modifying a member materializes it
+        web[1].set_var('port', 8080)
+        assert list(inventory.hosts) == ['web02']
+        assert web[1].materialize() is inventory.hosts['web02']
+        assert inventory.select('web02') == [inventory.hosts['web02']]
+        assert inventory.resolve_host_vars('web02') == {'a': 1, 'port': 8080}
+        assert copy.copy(web[0]).name == 'web01'
+
+    def test_host_range_member_in_group(self):
+        inventory = Inventory()
+        inventory.add_host('web[01:50]')
+        inventory.add_group('web', {'hosts': ['web[01:50]'],
+                                    'vars': {'port': 80}})
+        inventory.add_group('g', {'hosts': ['web05']})
+        assert inventory.get_group_hosts('g') == ['web05']
+        assert inventory.hosts['web05'].has_group('web')
+        assert 'web05' in inventory.get_group_hosts('web')
+        assert inventory.count_hosts() == 50
+        assert inventory.resolve_host_vars('web05') == {'port': 80}
+        inventory = Inventory()
+        inventory.load_inventoryjson({
+            'web': {'hosts': ['web[01:03]']},
+            'g': {'hosts': ['web02']},
+        })
+        assert inventory.get_group_hosts('g') == ['web02']
+        assert inventory.count_hosts() == 3
+
+    def test_host_range_loadstream(self):
+        content = {
+            'web': {'hosts': ['web[01:03]']},
+            '_meta': {'hostvars': {'web02': {'port': 22}}},
+        }
+        inventory = Inventory()
+        # json.dumps returns bytes on Python 2
+        inventory.load_inventory_stream(io.StringIO(
+            json.dumps(content).encode('utf-8').decode('utf-8')))
+        assert list(inventory.hosts) == ['web02']
+        assert inventory.get_group_hosts('web') == ['web02', 'web01', 'web03']
+        inventory = Inventory()
+        inventory.load_inventoryjson(content)
+        assert list(inventory.hosts) == ['web02']
+        assert inventory.resolve_host_vars('web02') == {'port': 22}
+        assert inventory.count_hosts() == 3
+
     #Group manipulation: Delete
     def test_delete_group(self, inventoryloader):
         """
@@ -632,6 +1471,24 @@ class TestInventory(object):
         inventoryloader.del_group('glance_api', reparent_vars=True)
         assert 'management_bridge' in inventoryloader.groups['glance_all'].vars
 
+    def test_delete_groups(self, inventoryloader):
+        """
+        Ensures several groups are deleted at once, their members
+        moving to the closest groups which are kept
+        """
+        journal = inventoryloader.start_journal()
+        output = copy.deepcopy(inventoryloader.write_output_json())
+        inventoryloader.del_groups(['glance_api', 'glance_all', 'missing'],
+                                   reparent_groups=True, reparent_hosts=True)
+        assert 'glance_all' not in inventoryloader.groups
+        assert 'glance_api' not in inventoryloader.groups
+        assert inventoryloader.groups['glance_registry'].has_group('all')
+        assert inventoryloader.groups['all'].has_host('localhost')
+        assert inventoryloader.hosts['localhost'].groups == \
+            [inventoryloader.groups['all']]
+        journal.undo()
+        assert inventoryloader.write_output_json() == output
+
     #Group manipulation: Update/Delete: convert
     def test_convert_to_newgroup(self, inventoryloader):
         """
@@ -738,12 +1595,188 @@ class TestInventory(object):
         output_inv = inventoryloader.write_output_json()
         assert input_inv == output_inv
 
-    def test_flatten_inventory(self):
+    @pytest.mark.parametrize("fname", ['tests/simple.json', 'tests/small.json'])
+    def test_roundtrip(self, fname):
+        with open(fname, 'r') as fd:
+            fc = json.loads(fd.read())
+        inventory = Inventory()
+        inventory.load_inventoryjson(fc)
+        assert inventory.write_output_json() == fc
+
+    @pytest.mark.parametrize("chunk_size", [1, 1000])
+    def test_output_stream(self, inventoryloader, chunk_size):
+        inventoryloader.add_host('superhost')
+        fp = io.StringIO()
+        inventoryloader.write_output_stream(fp, chunk_size)
+        output = json.loads(fp.getvalue())
+        assert output == inventoryloader.write_output_json()
+        assert 'superhost' in output['ungrouped']['hosts']
+
+    def test_output_does_not_mutate(self):
+        inventory = Inventory()
+        inventory.add_host('superhost')
+        inventory.add_group('awesome')
+        inventory.groups['awesome'].add_host(inventory.hosts['superhost'])
+        inventory.write_output_stream(io.StringIO())
+        output = inventory.write_output_json()
+        assert 'all' not in inventory.groups
+        assert 'ungrouped' not in inventory.groups
+        assert output['ungrouped'] == {}
+        assert output['all'] == {'children': ['ungrouped']}
+        assert list(inventory.hosts['superhost'].groups) == \
+            [inventory.groups['awesome']]
+
+    def test_flatten_inventory(self, inventoryloader):
         """
         Resolves the structure back to only hosts,
         merging variables along the way
         """
-        pass
+        inventoryloader.groups['all'].set_vars({'a': 'all', 'b': 'all'})
+        inventoryloader.groups['glance_all'].set_vars({'b': 'glance_all'})
+        inventoryloader.update_host('localhost', {'c': 'host'})
+        hostvars = inventoryloader.resolve_all_hostvars()
+        assert hostvars['localhost'] == {
+            'ansible_connection': 'local',
+            'management_bridge': 'br-mgmt',
+            'a': 'all', 'b': 'glance_all', 'c': 'host'}
+        assert hostvars['localhost2'] == {
+            'ansible_connection': 'local', 'a': 'all', 'b': 'glance_all'}
+        assert inventoryloader.resolve_host_vars('localhost') == \
+            hostvars['localhost']
+
+    def test_flatten_priorities(self):
+        inventory = Inventory()
+        inventory.add_host('h1', {'port': 'host'})
+        inventory.add_group('parent', {'vars': {'port': 'parent'},
+                                       'priority': 10})
+        inventory.add_group('child', {'vars': {'port': 'child'},
+                                      'parents': ['parent'],
+                                      'hosts': ['h1']})
+        assert inventory.resolve_host_vars('h1') == {'port': 'parent'}
+        inventory.set_group_priority('parent', 0)
+        assert inventory.resolve_host_vars('h1') == {'port': 'host'}
+
+    def test_flatten_priorities_per_var(self):
+        inventory = Inventory()
+        inventory.add_host('h1')
+        inventory.add_group('a', {'vars': {'y': 'a', 'd': {'p': 'a'}},
+                                  'hosts': ['h1']})
+        inventory.add_group('b', {'vars': {'z': 'b', 'd': {'q': 'b'}},
+                                  'priority': 10, 'hosts': ['h1']})
+        inventory.add_group('c', {'vars': {'y': 'c', 'd': {'p': 'c'}},
+                                  'priority': 5, 'hosts': ['h1']})
+        expected = {'y': 'c', 'z': 'b', 'd': {'p': 'c', 'q': 'b'}}
+        assert inventory.resolve_host_vars('h1') == expected
+        # The same, inherited through parents
+        inventory.add_host('h2')
+        inventory.add_group('child', {'parents': ['a', 'b', 'c'],
+                                      'hosts': ['h2']})
+        assert inventory.resolve_host_vars('h2') == expected
+        # Through a single parent, and under the host vars
+        inventory.add_host('h3', {'y': 'h3', 'd': {'q': 'h3', 'r': 'h3'}})
+        inventory.add_group('leaf', {'parents': ['child'], 'hosts': ['h3']})
+        assert inventory.resolve_host_vars('h3') == {
+            'y': 'c', 'z': 'b', 'd': {'p': 'c', 'q': 'b', 'r': 'h3'}}
+        inventory.set_group_priority('c', 0)
+        assert inventory.resolve_host_vars('h1')['y'] == 'c'
+        inventory.set_group_priority('a', 1)
+        assert inventory.resolve_host_vars('h2')['y'] == 'a'
+        assert inventory.resolve_host_vars('h2')['d'] == {'p': 'a', 'q': 'b'}
+
+    def test_flatten_lists(self):
+        """ Lists are concatenated from 'all' down to the host """
+        inventory = Inventory()
+        inventory.add_host('h1', {'pkgs': ['host']})
+        inventory.add_group('all', {'vars': {'pkgs': ['all']}})
+        inventory.add_group('group', {'vars': {'pkgs': ['group']},
+                                      'hosts': ['h1']})
+        assert inventory.resolve_host_vars('h1') == {
+            'pkgs': ['all', 'group', 'host']}
+        # 'all' is inherited once through both groups
+        inventory.add_group('other', {'vars': {'pkgs': ['other']},
+                                      'hosts': ['h1']})
+        inventory.add_host('h2')
+        inventory.groups['group'].add_host(inventory.hosts['h2'])
+        inventory.groups['other'].add_host(inventory.hosts['h2'])
+        hostvars = inventory.resolve_all_hostvars()
+        assert hostvars['h1'] == {'pkgs': ['all', 'group', 'other', 'host']}
+        assert hostvars['h2'] == {'pkgs': ['all', 'group', 'other']}
+        # In the same order as mergedicts
+        assert dict(ansible_inventory_manage.inventory.mergedicts(
+            {'pkgs': ['all']}, {'pkgs': ['group']})) == \
+            {'pkgs': ['all', 'group']}
+
+    def test_flatten_last_group_wins(self):
+        inventory = Inventory()
+        inventory.add_host('h1')
+        inventory.add_group('first', {'vars': {'a': 'first'}, 'hosts': ['h1']})
+        inventory.add_group('second', {'vars': {'a': 'second'}, 'hosts': ['h1']})
+        assert inventory.resolve_host_vars('h1') == {'a': 'second'}
+        inventory.hosts['h1'].reorder_groups(1, 0)
+        assert inventory.resolve_host_vars('h1') == {'a': 'first'}
+
+    def test_flatten_all_with_parents(self):
+        """ The parents of 'all' don't inherit from it """
+        inventory = Inventory()
+        inventory.add_host('h')
+        inventory.add_group('all', {'hosts': ['h'], 'vars': {'a': 'all'}})
+        inventory.add_group('top', {'vars': {'a': 'top', 'b': 'top'}})
+        inventory.groups['top'].add_child(inventory.groups['all'])
+        assert not inventory.has_cycle()
+        assert inventory.resolve_host_vars('h') == {'a': 'all', 'b': 'top'}
+        inventory.add_group('x', {'vars': {'c': 'x'}, 'parents': ['top']})
+        inventory.convert_group('x', 'all')
+        assert inventory.resolve_host_vars('h') == {
+            'a': 'all', 'b': 'top', 'c': 'x'}
+
+    def test_flatten_invalidates_subtree_only(self, inventoryloader):
+        hostvars = inventoryloader.resolve_all_hostvars()
+        localhost = inventoryloader.hosts['localhost']
+        localhost2 = inventoryloader.hosts['localhost2']
+        cached = localhost2._resolved
+        inventoryloader.groups['glance_api'].set_var('api', 'yes')
+        assert localhost._resolved is None
+        assert localhost2._resolved is cached
+        assert inventoryloader.groups['glance_registry']._resolved is not None
+        hostvars = inventoryloader.resolve_all_hostvars()
+        assert hostvars['localhost']['api'] == 'yes'
+        assert 'api' not in hostvars['localhost2']
+
+    def test_flatten_invalidation_on_edits(self, inventoryloader):
+        inventoryloader.add_group('extra', {'vars': {'a': 'extra'}})
+        inventoryloader.resolve_all_hostvars()
+        inventoryloader.groups['extra'].add_host(
+            inventoryloader.hosts['localhost2'])
+        assert inventoryloader.resolve_host_vars('localhost2')['a'] == 'extra'
+        inventoryloader.groups['extra'].add_parent(
+            inventoryloader.groups['glance_registry'])
+        inventoryloader.groups['glance_registry'].set_var('b', 'registry')
+        assert inventoryloader.resolve_host_vars('localhost2')['b'] == 'registry'
+        inventoryloader.update_host('localhost2', {'a': 'host'}, prio=0)
+        assert inventoryloader.resolve_host_vars('localhost2')['a'] == 'host'
+        inventoryloader.groups['extra'].del_host(
+            inventoryloader.hosts['localhost2'])
+        inventoryloader.set_group_priority('extra', 5)
+        assert inventoryloader.resolve_host_vars('localhost2')['a'] == 'host'
+
+    def test_flatten_implicit_all(self):
+        inventory = Inventory()
+        inventory.add_host('h1')
+        inventory.add_group('orphan', {'hosts': ['h1']})
+        inventory.add_host('h2')
+        inventory.add_group('all', {'vars': {'a': 'all'}})
+        assert inventory.resolve_host_vars('h1') == {'a': 'all'}
+        assert inventory.resolve_host_vars('h2') == {'a': 'all'}
+        inventory.groups['all'].set_var('a', 'changed')
+        assert inventory.resolve_host_vars('h1') == {'a': 'changed'}
+        assert inventory.resolve_host_vars('h2') == {'a': 'changed'}
+        inventory.del_group('all')
+        assert inventory.resolve_host_vars('h1') == {}
+
+    def test_flatten_does_not_share_vars(self, inventoryloader):
+        hostvars = inventoryloader.resolve_host_vars('localhost')
+        hostvars['ansible_connection'] = 'ssh'
+        assert inventoryloader.hosts['localhost'].vars['ansible_connection'] == 'local'
 
     def test_output_has_hostvars(self):
         inventory = Inventory()
@@ -780,6 +1813,263 @@ class TestInventory(object):
         assert 'superhost' in output['awesome'].get('hosts', [])
         assert 'superhost' not in output['ungrouped'].get('hosts', [])
 
+    def test_output_ungrouped_follows_changes(self, inventoryloader):
+        def ungrouped():
+            return inventoryloader.write_output_json()['ungrouped'].get(
+                'hosts', [])
+        assert ungrouped() == []
+        journal = inventoryloader.start_journal()
+        inventoryloader.del_group('glance_api')
+        inventoryloader.add_host('web[1:2]')
+        assert ungrouped() == ['localhost', 'web1', 'web2']
+        inventoryloader.groups['glance_registry'].add_host(
+            inventoryloader.host_ranges['web[1:2]'])
+        inventoryloader.del_host('localhost')
+        assert ungrouped() == []
+        journal.undo(3)
+        assert ungrouped() == ['localhost']
+        journal.undo()
+        assert ungrouped() == []
+        inventoryloader.stop_journal()
+        with pytest.raises(Exception):
+            with inventoryloader.batch():
+                inventoryloader.add_host('newhost')
+                inventoryloader.groups['glance_api'].add_host(
+                    inventoryloader.hosts['newhost'])
+                inventoryloader.hosts['localhost'].del_group(
+                    inventoryloader.groups['glance_api'])
+                assert ungrouped() == ['localhost']
+                raise Exception
+        assert ungrouped() == []
+
+    def test_ungrouped_vars(self):
+        inventory = Inventory()
+        inventory.add_special_groups()
+        inventory.groups['ungrouped'].set_vars({'u': 1})
+        inventory.groups['all'].set_vars({'a': 1})
+        inventory.add_host('lonely')
+        inventory.add_host('web[1:2]')
+        assert inventory.resolve_host_vars('lonely') == {'a': 1, 'u': 1}
+        assert inventory.resolve_all_hostvars()['web2'] == {'a': 1, 'u': 1}
+        inventory.groups['ungrouped'].set_var('u', 2)
+        assert inventory.resolve_host_vars('lonely') == {'a': 1, 'u': 2}
+        inventory.groups['all'].set_var('a', 2)
+        assert inventory.resolve_host_vars('lonely') == {'a': 2, 'u': 2}
+        # Left in 'ungrouped', but rendered in the other group only
+        inventory.add_group('web', {'hosts': ['lonely']})
+        inventory.groups['ungrouped'].add_host(inventory.hosts['lonely'])
+        assert inventory.resolve_host_vars('lonely') == {'a': 2}
+        inventory.del_group('web')
+        assert inventory.resolve_host_vars('lonely') == {'a': 2, 'u': 2}
+
+    def test_ungrouped_pattern(self):
+        inventory = Inventory()
+        inventory.add_host('lonely')
+        inventory.add_host('web[1:2]')
+        inventory.add_host('grouped')
+        inventory.add_group('g', {'hosts': ['grouped']})
+        expected = inventory.write_output_json()['ungrouped']['hosts']
+        assert inventory.get_pattern_hosts('ungrouped') == expected
+        inventory.add_special_groups()
+        inventory.groups['ungrouped'].add_host(inventory.hosts['grouped'])
+        assert inventory.write_output_json()['ungrouped']['hosts'] == expected
+        assert inventory.get_pattern_hosts('ungrouped') == expected
+        assert inventory.get_pattern_hosts('ungrouped:&g') == []
+        assert inventory.get_group_hosts('ungrouped') == expected
+
+    def test_ungrouped_has_host(self):
+        inventory = Inventory()
+        inventory.add_special_groups()
+        inventory.add_host('lonely')
+        inventory.add_host('web[1:2]')
+        inventory.add_host('grouped')
+        inventory.add_group('g', {'hosts': ['grouped']})
+        ungrouped = inventory.groups['ungrouped']
+        assert ungrouped.has_host('lonely')
+        assert ungrouped.has_host('web2')
+        assert not ungrouped.has_host('grouped')
+        assert not ungrouped.has_host('unknown')
+        ungrouped.add_host(inventory.hosts['grouped'])
+        assert not ungrouped.has_host('grouped')
+        inventory.groups['g'].del_host(inventory.hosts['grouped'])
+        assert ungrouped.has_host('grouped')
+        assert inventory.groups['g'].has_host('web1') is False
+
+    def test_output_canonical(self, inventoryloader):
+        shuffled = Inventory()
+        shuffled.load_inventoryjson({
+            'glance_registry': {'hosts': ['localhost2']},
+            'all': {'children': ['ungrouped', 'glance_all']},
+            'glance_all': {'children': ['glance_registry', 'glance_api']},
+            'glance_api': {'hosts': ['localhost'], 'vars': dict(
+                inventoryloader.groups['glance_api'].vars)},
+            'ungrouped': {},
+            '_meta': {'hostvars': {
+                'localhost2': {'ansible_connection': 'local'},
+                'localhost': {'ansible_connection': 'local'}}}})
+        outputs = []
+        for inventory in (inventoryloader, shuffled):
+            fp = io.StringIO()
+            inventory.write_output_stream(fp, canonical=True)
+            outputs.append(fp.getvalue())
+            assert json.loads(fp.getvalue()) == \
+                inventory.write_output_json(canonical=True)
+            assert inventory.write_output_json(
+                canonical=True)['all']['children'] == \
+                sorted(inventory.write_output_json()['all']['children'])
+        assert outputs[0] == outputs[1]
+        assert inventoryloader.content_hash() == shuffled.content_hash()
+
+    def test_content_hash(self, inventoryloader):
+        before = inventoryloader.content_hash()
+        group = inventoryloader.groups['glance_api']
+        grouphash = group.content_hash()
+        journal = inventoryloader.start_journal()
+        group.set_var('a', 1)
+        inventoryloader.rename_host('localhost2', 'newhost')
+        assert group.content_hash() != grouphash
+        assert inventoryloader.content_hash() != before
+        fresh = Inventory()
+        fresh.load_inventoryjson(inventoryloader.write_output_json())
+        assert fresh.content_hash() == inventoryloader.content_hash()
+        assert fresh.hosts['newhost'].content_hash() == \
+            inventoryloader.hosts['newhost'].content_hash()
+        journal.undo(2)
+        assert group.content_hash() == grouphash
+        assert inventoryloader.content_hash() == before
+        inventoryloader.stop_journal()
+        with inventoryloader.batch():
+            inventoryloader.groups['glance_all'].add_host(
+                inventoryloader.hosts['localhost'])
+        assert inventoryloader.content_hash() != before
+        inventoryloader.hosts['localhost'].del_group(
+            inventoryloader.groups['glance_all'])
+        assert inventoryloader.content_hash() == before
+
+    def test_content_hash_tracking(self, inventoryloader):
+        # Nothing to update: the changes aren't tracked
+        for index in range(100):
+            inventoryloader.add_host('tmp%s' % index)
+            inventoryloader.del_host('tmp%s' % index)
+        assert inventoryloader._stale is None
+        before = inventoryloader.content_hash()
+        inventoryloader.add_host('tmp')
+        assert inventoryloader.hosts['tmp'] in inventoryloader._stale
+        assert inventoryloader.content_hash() != before
+        host = inventoryloader.hosts['tmp']
+        inventoryloader.del_host('tmp')
+        # Forgotten right away, and its hash removed from the sum
+        assert host not in inventoryloader._stale
+        assert host._digest is None
+        assert inventoryloader.content_hash() == before
+        inventoryloader.hosts['localhost'].set_var('a', 1)
+        fresh = Inventory()
+        fresh.load_inventoryjson(inventoryloader.write_output_json())
+        assert fresh._stale is None
+        assert fresh.content_hash() == inventoryloader.content_hash()
+
+    def test_content_hash_rendered(self):
+        def same(first, second):
+            assert first.write_output_bytes(canonical=True) == \
+                second.write_output_bytes(canonical=True)
+            return first.content_hash() == second.content_hash()
+
+        ranged, expanded = Inventory(), Inventory()
+        ranged.add_host('web[1:3]', {'a': 1})
+        ranged.add_group('g', {'hosts': ['web[1:3]']})
+        for name in ('web1', 'web2', 'web3'):
+            expanded.add_host(name, {'a': 1})
+        expanded.add_group('g', {'hosts': ['web1', 'web2', 'web3']})
+        assert same(ranged, expanded)
+        # Materialized after being hashed
+        ranged.get_host('web2')
+        assert same(ranged, expanded)
+        ranged.del_host('web3')
+        expanded.del_host('web3')
+        assert same(ranged, expanded)
+        ranged.host_ranges['web[1:3]'].set_var('a', 2)
+        assert ranged.content_hash() != expanded.content_hash()
+        expanded.hosts['web1'].set_var('a', 2)
+        expanded.hosts['web2'].set_var('a', 2)
+        assert ranged.content_hash() != expanded.content_hash()
+        ranged.hosts['web2'].set_var('a', 2)
+        assert same(ranged, expanded)
+        # The special groups, rendered whether defined or not
+        implicit, explicit = Inventory(), Inventory()
+        implicit.add_host('lonely')
+        explicit.add_special_groups()
+        explicit.add_host('lonely')
+        explicit.add_group('web', {'hosts': ['lonely']})
+        explicit.groups['ungrouped'].add_host(explicit.hosts['lonely'])
+        implicit.add_group('web', {'hosts': ['lonely']})
+        assert same(implicit, explicit)
+
+    def test_output_cached(self, inventoryloader):
+        output = inventoryloader.write_output_bytes()
+        assert inventoryloader.write_output_bytes() is output
+        assert json.loads(output.decode('utf-8')) == \
+            inventoryloader.write_output_json()
+        inventoryloader.write_output_json().pop('_meta')
+        assert '_meta' in inventoryloader.write_output_json()
+        inventoryloader.hosts['localhost'].set_var('a', 1)
+        assert inventoryloader.write_output_bytes() != output
+        assert inventoryloader.write_output_json()['_meta']['hostvars'][
+            'localhost']['a'] == 1
+
+    @pytest.mark.parametrize("partial_render", [False, True])
+    def test_output_cached_vars_in_place(self, partial_render):
+        inventory = Inventory(partial_render=partial_render)
+        inventory.add_host('zz')
+        inventory.write_output_json()
+        inventory.hosts['zz'].vars['k'] = 2
+        assert inventory.write_output_json()['_meta']['hostvars'][
+            'zz'] == {'k': 2}
+        inventory.add_group('web', {'hosts': ['zz'], 'vars': {'a': 1}})
+        before = inventory.content_hash()
+        inventory.resolve_host_vars('zz')
+        inventory.write_output_bytes()
+        inventory.groups['web'].vars['a'] = 3
+        output = json.loads(inventory.write_output_bytes().decode('utf-8'))
+        assert output['web']['vars'] == {'a': 3}
+        assert inventory.content_hash() != before
+        assert inventory.resolve_host_vars('zz') == {'a': 3, 'k': 2}
+        # Reading the vars doesn't invalidate anything
+        graph = inventory.get_graph()
+        output = inventory.write_output_bytes()
+        before = inventory.content_hash()
+        assert inventory.groups['web'].vars == {'a': 3}
+        assert inventory.hosts['zz'].vars.get('k') == 2
+        assert inventory.get_graph() is graph
+        assert inventory.write_output_bytes() is output
+        assert inventory.content_hash() == before
+
+    @pytest.mark.parametrize("canonical", [False, True])
+    def test_output_partial_render(self, canonical):
+        inventories = Inventory(), Inventory(partial_render=True)
+        with open('tests/small.json', 'r') as fd:
+            fc = json.loads(fd.read())
+        for inventory in inventories:
+            inventory.load_inventoryjson(fc)
+        edits = [
+            lambda inventory: inventory.add_host('web[1:3]'),
+            lambda inventory: inventory.groups['glance_api'].add_host(
+                inventory.host_ranges['web[1:3]']),
+            lambda inventory: inventory.del_host('web2'),
+            lambda inventory: inventory.rename_host('localhost', 'newhost'),
+            lambda inventory: inventory.groups['glance_all'].set_var('a', 1),
+            lambda inventory: inventory.del_group('glance_registry'),
+            lambda inventory: inventory.rename_group('glance_api', 'api'),
+        ]
+        for edit in edits:
+            outputs = []
+            for inventory in inventories:
+                edit(inventory)
+                outputs.append(inventory.write_output_bytes(canonical))
+            assert outputs[0] == outputs[1]
+            fp = io.StringIO()
+            inventories[1].write_output_stream(fp, canonical=canonical)
+            assert fp.getvalue().encode('utf-8') == outputs[1]
+
     def test_output_vs_expectations(self):
         """ Computes the number of groups, and compares
         to expected value
@@ -0,0 +1,76 @@
+import io
+import json
+import pytest
+from ansible_inventory_manage.jsonstream import JSONBufferReader
+from ansible_inventory_manage.jsonstream import JSONStreamReader
+
+
+document = {
+    "a": {"nested": [1, 2.5, "three", None, True]},
+    "b": 1234567,
+    "c": u"\u00e9t\u00e9",
+    "d": {},
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 65536])
+def test_read_whole_values(chunk_size):
+    # json.dumps returns bytes on Python 2
+    fp = io.StringIO(json.dumps(document).encode('utf-8').decode('utf-8'))
+    reader = JSONStreamReader(fp, chunk_size)
+    result = {}
+    for key in reader.iter_items():
+        result[key] = reader.read_value()
+    assert result == document
+
+
+@pytest.mark.parametrize("chunk_size", [1, 65536])
+def test_nested_iteration_from_bytes(chunk_size):
+    fp = io.BytesIO(json.dumps(document).encode('utf-8'))
+    reader = JSONStreamReader(fp, chunk_size)
+    keys = []
+    for key in reader.iter_items():
+        if key == 'a':
+            for subkey in reader.iter_items():
+                keys.append(subkey)
+                reader.read_value()
+        else:
+            keys.append(key)
+            reader.read_value()
+    assert sorted(keys) == ['b', 'c', 'd', 'nested']
+
+
+def test_empty_object():
+    reader = JSONStreamReader(io.StringIO(u' { } '))
+    assert list(reader.iter_items()) == []
+
+
+def test_truncated_document():
+    reader = JSONStreamReader(io.StringIO(u'{"a": [1, 2'), 2)
+    with pytest.raises(ValueError):
+        for key in reader.iter_items():
+            reader.read_value()
+
+
+def test_not_an_object():
+    reader = JSONStreamReader(io.StringIO(u'[1, 2]'))
+    with pytest.raises(ValueError):
+        list(reader.iter_items())
+
+
+def test_buffer_skip_values():
+    content = dict(document, e={"s": u"\\\"}]", "l": [[], {}]})
+    buf = json.dumps(content).encode('utf-8')
+    reader = JSONBufferReader(buf)
+    result = {}
+    for key in reader.iter_items():
+        start, end = reader.skip_value()
+        result[key] = json.loads(buf[start:end].decode('utf-8'))
+    assert result == content
+
+
+def test_buffer_truncated_document():
+    reader = JSONBufferReader(b'{"a": [1, {"b": 2]')
+    with pytest.raises(ValueError):
+        for key in reader.iter_items():
+            reader.skip_value()
@@ -21,6 +21,17 @@ class TestNames(object):
         assert validate.is_valid_host('9')
         assert validate.is_valid_host('9')
 
+    def test_valid_host_ranges(self):
+        assert validate.is_valid_host_range('web[01:50].example.com')
+        assert validate.is_valid_host_range('rack[1:4]-node[a:f]')
+        assert validate.is_valid_host_range('node[0:20:2]')
+        assert not validate.is_valid_host_range('web01')
+        assert not validate.is_valid_host_range('web[01:5]')
+        assert not validate.is_valid_host_range('web[5:1]')
+        assert not validate.is_valid_host_range('web[1:c]')
+        assert not validate.is_valid_host_range('$[1:2]')
+        assert not validate.is_valid_host_range()
+
     def test_valid_groupnames(self):
         assert validate.is_valid_name('a')
         assert not validate.is_valid_name()